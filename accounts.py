@@ -0,0 +1,94 @@
+import os
+import re
+
+# Gmail accounts and their storage shards. The original single account,
+# 'default', keeps token.json and the temp/ folder. Every other account has
+# its token in tokens/<name>.json and its emails, indexes and checkpoints in
+# temp_accounts/<name>/, so accounts sync and answer independently. The
+# shards sit next to temp/ rather than inside it, so clearing the default
+# account's folder leaves the other accounts alone; shards from before, in
+# temp/accounts/<name>/, are moved there when first used.
+
+DEFAULT_ACCOUNT = 'default'
+DEFAULT_TOKEN = 'token.json'
+DEFAULT_FOLDER = 'temp'
+TOKENS_FOLDER = 'tokens'
+ACCOUNTS_SUFFIX = '_accounts'
+# Where the shards used to be, inside the default account's folder
+LEGACY_SUBFOLDER = 'accounts'
+# Names end up in paths, so only plain ones are accepted
+NAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.@+-]{0,99}$')
+
+def check_account(name):
+    if not isinstance(name, str) or not NAME_RE.match(name):
+        raise ValueError(f"Invalid account name: {name!r}")
+    return name
+
+def token_path(account=DEFAULT_ACCOUNT):
+    if check_account(account) == DEFAULT_ACCOUNT:
+        return DEFAULT_TOKEN
+    return os.path.join(TOKENS_FOLDER, account + '.json')
+
+def accounts_root(base=DEFAULT_FOLDER):
+    # Folder holding the shards of every account but the default one
+    return os.path.normpath(base) + ACCOUNTS_SUFFIX
+
+def _move_legacy(account, base):
+    legacy = os.path.join(base, LEGACY_SUBFOLDER, account)
+    folder = os.path.join(accounts_root(base), account)
+    if os.path.isdir(legacy) and not os.path.exists(folder):
+        os.makedirs(accounts_root(base), exist_ok=True)
+        try:
+            os.rename(legacy, folder)
+            print(f"[+] Moved account '{account}' from {legacy} to {folder}")
+        except OSError as e:
+            # Another process moved it first, or the folder is in use
+            if not os.path.isdir(folder):
+                print(f"[!] Could not move {legacy}: {e}")
+                return legacy
+    return folder
+
+def account_folder(account=DEFAULT_ACCOUNT, base=DEFAULT_FOLDER):
+    if check_account(account) == DEFAULT_ACCOUNT:
+        return base
+    return _move_legacy(account, base)
+
+def list_accounts(base=DEFAULT_FOLDER):
+    # Accounts with a token or with synced emails, default first
+    names = set()
+    if os.path.exists(DEFAULT_TOKEN) or os.path.isdir(base):
+        names.add(DEFAULT_ACCOUNT)
+    if os.path.isdir(TOKENS_FOLDER):
+        names.update(name[:-len('.json')] for name in os.listdir(TOKENS_FOLDER) if name.endswith('.json'))
+    legacy = os.path.join(base, LEGACY_SUBFOLDER)
+    if os.path.isdir(legacy):
+        for name in os.listdir(legacy):
+            if NAME_RE.match(name) and name != DEFAULT_ACCOUNT:
+                _move_legacy(name, base)
+        try:
+            os.rmdir(legacy)
+        except OSError:
+            pass
+    shards = accounts_root(base)
+    if os.path.isdir(shards):
+        names.update(name for name in os.listdir(shards) if os.path.isdir(os.path.join(shards, name)))
+    names = {name for name in names if NAME_RE.match(name)}
+    return sorted(names, key=lambda name: (name != DEFAULT_ACCOUNT, name))
+
+def resolve_accounts(value, base=DEFAULT_FOLDER):
+    # Request or CLI value -> list of account names: None for the default
+    # account, a name, a comma-separated string or list of names, or 'all'
+    if value is None or value == '':
+        return [DEFAULT_ACCOUNT]
+    if value == 'all':
+        return list_accounts(base)
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not value:
+        raise ValueError("accounts must be a name, a list of names or 'all'")
+    names = []
+    for name in value:
+        name = check_account(name.strip() if isinstance(name, str) else name)
+        if name not in names:
+            names.append(name)
+    return names
@@ -0,0 +1,116 @@
+import os
+import re
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+# Persistent cache of Gemini answers. Entries are keyed on the model, the
+# normalized question and a fingerprint of the emails retrieved for it, so an
+# answer stops matching as soon as any of those emails change. Old entries
+# are dropped by TTL and the least recently used ones beyond max_entries.
+
+CACHE_FILE = 'answers.db'
+DEFAULT_TTL = 24 * 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+def normalize_query(query):
+    return re.sub(r'\s+', ' ', query.strip().lower()).rstrip('?!. ')
+
+def retrieval_fingerprint(emails):
+    digest = hashlib.sha1()
+    for email in emails:
+        body = email.get('body') or email.get('snippet') or ''
+        parts = [email.get('id'), email.get('subject'), email.get('date'), hashlib.sha1(body.encode('utf-8')).hexdigest()]
+        if email.get('summary'):
+            # Summary prompts change when a summary is added
+            parts.append(email['summary'].get('hash'))
+        digest.update(json.dumps(parts).encode('utf-8'))
+    return digest.hexdigest()
+
+def cache_key(model_id, query, emails):
+    raw = json.dumps([model_id, normalize_query(query), retrieval_fingerprint(emails)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+class AnswerCache:
+    def __init__(self, folder='temp', max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # The folder may have been removed by /cleanup since the last call
+        if conn is None or not os.path.exists(os.path.join(self.folder, CACHE_FILE)):
+            os.makedirs(self.folder, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.folder, CACHE_FILE), timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    model_id TEXT,
+                    query TEXT,
+                    answer TEXT,
+                    created REAL,
+                    last_used REAL
+                )
+            """)
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT answer, created FROM answers WHERE key = ?", (key,)).fetchone()
+        if row and now - row[1] > self.ttl:
+            with conn:
+                conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            row = None
+        self._count(row is not None)
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key, model_id, query, answer):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, model_id, normalize_query(query), answer, now, now))
+            conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl,))
+            conn.execute("""
+                DELETE FROM answers WHERE key IN (
+                    SELECT key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM answers")
+
+    def stats(self):
+        entries = self._conn().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
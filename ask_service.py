@@ -0,0 +1,363 @@
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email_loader import MailboxCache
+from email_index import open_index, select_emails, fuse_rankings, DEFAULT_TOP_K
+from email_embeddings import SemanticIndex, semantic_enabled, open_semantic_index, shared_embedder
+from prompt_builder import build_prompt
+from rate_limiter import Scheduler, RateLimitExceeded
+from gemini_models import GEMINI_MODELS, scheduler as shared_scheduler
+from answer_cache import AnswerCache, cache_key
+from gemini_client import get_model, cache_context
+from email_store import matches, to_timestamp
+from map_reduce import MapReduce
+from chat_session import SessionStore
+from accounts import DEFAULT_ACCOUNT, account_folder, list_accounts, resolve_accounts
+from metrics import span, count, record_value, in_context
+
+# The /ask pipeline shared by the Flask and asyncio servers: mailbox cache,
+# retrieval, prompt building, answer cache and rate limiting. The servers
+# only translate HTTP requests into these calls. Every account is a
+# separate shard with its own mailbox and indexes; a question can target one
+# account or fan out over several and merge what each retrieves.
+
+# Longest a request may queue for its rate limit before getting a 429
+MAX_QUEUE_WAIT = 60
+# Map-reduce answers make many calls, each may queue longer
+MAX_MAP_REDUCE_WAIT = 600
+
+class AskError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+def number_field(data, key, default=None, cast=int, minimum=0):
+    # A numeric request field, AskError(400) when it isn't one
+    value = data.get(key)
+    if value is None:
+        return default
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        value = cast(value)
+        if not value >= minimum:
+            raise ValueError
+    except (TypeError, ValueError, OverflowError):
+        raise AskError(400, f"{key} must be a number of at least {minimum}")
+    return value
+
+class MailboxShard:
+    # One account's mailbox and retrieval indexes
+    def __init__(self, account, folder):
+        self.account = account
+        self.folder = folder
+        # Mailbox loaded once and refreshed incrementally when the store changes
+        self.mailbox = MailboxCache(folder)
+        # Retrieval indexes, reopened only when the mailbox changes
+        self._retrieval = {'generation': None, 'index': None, 'semantic': None}
+        self._retrieval_lock = threading.Lock()
+        # Background semantic index rebuild, and the mailbox it has to run
+        # again for once done
+        self._semantic_running = False
+        self._semantic_pending = None
+
+    def retrieval_indexes(self, emails):
+        with self._retrieval_lock:
+            if self._retrieval['generation'] != self.mailbox.generation:
+                self._retrieval['index'] = open_index(self.folder, emails)
+                self._retrieval['generation'] = self.mailbox.generation
+                if semantic_enabled():
+                    self._refresh_semantic(emails)
+            return self._retrieval['index'], self._retrieval['semantic']
+
+    def _refresh_semantic(self, emails):
+        # Called with _retrieval_lock held. Embedding new emails can wait
+        # minutes on the rate limit, so the semantic index is rebuilt in the
+        # background and questions use the previous one (or none) until it
+        # is ready. One rebuild at a time; mailbox changes meanwhile get one
+        # more pass after it.
+        if self._semantic_running:
+            self._semantic_pending = emails
+            return
+        self._semantic_running = True
+        threading.Thread(target=self._build_semantic, args=(emails,), name=f"semantic-{self.account}",
+                         daemon=True).start()
+
+    def _build_semantic(self, emails):
+        while emails is not None:
+            try:
+                if self._retrieval['semantic'] is None:
+                    # The vectors cached on disk serve questions meanwhile
+                    cached = SemanticIndex(self.folder, shared_embedder())
+                    with self._retrieval_lock:
+                        self._retrieval['semantic'] = cached
+                index = open_semantic_index(emails, self.folder)
+                with self._retrieval_lock:
+                    self._retrieval['semantic'] = index
+            except Exception as e:
+                print(f"[!] [{self.account}] Semantic index not updated: {e}")
+            with self._retrieval_lock:
+                emails, self._semantic_pending = self._semantic_pending, None
+                if emails is None:
+                    self._semantic_running = False
+
+    def select(self, query, top_k):
+        emails = self.mailbox.emails()
+        if not emails:
+            return []
+        index, semantic = self.retrieval_indexes(emails)
+        return select_emails(query, emails, top_k, index, semantic, self.mailbox.by_id(), newest_first=True)
+
+class AskService:
+    def __init__(self, models, folder='temp', model_factory=get_model, body_loader=None, context_cache=cache_context,
+                 scheduler=None):
+        self.models = models
+        self.model_ids = [m['id'] for m in models]
+        self.model_factory = model_factory
+        # Uploads a session's mailbox context once, None to always resend it
+        self.context_cache = context_cache
+        # Multi-turn sessions, see chat_session.py
+        self.sessions = SessionStore()
+        # Fills in the bodies of lazily synced emails before they go into a
+        # prompt, called as body_loader(emails, account=name)
+        self.body_loader = body_loader
+        # Shared by all requests so calls are paced to the model limits. Models
+        # from the shared table also share their buckets with the summaries,
+        # embeddings and everything else calling Gemini in this process.
+        if scheduler is None:
+            scheduler = shared_scheduler if all(m in GEMINI_MODELS for m in models) else Scheduler(models)
+        self.scheduler = scheduler
+        # Answers to repeated questions over unchanged emails, for all accounts
+        self.answer_cache = AnswerCache(folder)
+        self.folder = folder
+        # Account name -> MailboxShard, opened on first use
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+
+    def shard(self, account=DEFAULT_ACCOUNT):
+        with self._shards_lock:
+            if account not in self._shards:
+                self._shards[account] = MailboxShard(account, account_folder(account, self.folder))
+            return self._shards[account]
+
+    @property
+    def mailbox(self):
+        return self.shard().mailbox
+
+    def accounts(self, data):
+        # Accounts a request targets: "account" (one name) or "accounts"
+        # (names or "all"), the default account when neither is given
+        try:
+            names = resolve_accounts(data.get('accounts', data.get('account')), self.folder)
+        except ValueError as e:
+            raise AskError(400, str(e))
+        known = list_accounts(self.folder)
+        unknown = [name for name in names if name != DEFAULT_ACCOUNT and name not in known]
+        if unknown:
+            raise AskError(404, f"Unknown account: {', '.join(unknown)}")
+        if not names:
+            raise AskError(400, "No accounts set up")
+        return names
+
+    def cleanup(self, data):
+        # Deletes the downloaded emails of the accounts a request targets,
+        # only the default account's folder (answer cache included) when it
+        # names none. Returns the accounts cleared.
+        names = self.accounts(data)
+        for name in names:
+            shutil.rmtree(account_folder(name, self.folder), ignore_errors=True)
+            with self._shards_lock:
+                self._shards.pop(name, None)
+        return names
+
+    def account_list(self):
+        return [{'account': name, 'folder': account_folder(name, self.folder)} for name in list_accounts(self.folder)]
+
+    def model_limits(self, model_id):
+        return next((m['limits'] for m in self.models if m['id'] == model_id), {})
+
+    def _require(self, data):
+        model_id = data.get('model_id')
+        query = data.get('query')
+        if not model_id or not query:
+            raise AskError(400, "model_id and query are required")
+        return model_id, query
+
+    def _select(self, query, data):
+        # Only send the emails relevant to this question
+        top_k = number_field(data, 'top_k', DEFAULT_TOP_K, minimum=1)
+        shards = [self.shard(account) for account in self.accounts(data)]
+        with span('retrieval', accounts=len(shards)):
+            if len(shards) == 1:
+                selected = shards[0].select(query, top_k)
+            else:
+                # Every account retrieves its own top k, the rankings are fused
+                select = in_context(lambda shard: shard.select(query, top_k))
+                with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                    ranked = list(pool.map(select, shards))
+                by_key = {(shard.account, email['id']): {**email, 'account': shard.account}
+                          for shard, emails in zip(shards, ranked) for email in emails}
+                rankings = [[(shard.account, email['id']) for email in emails] for shard, emails in zip(shards, ranked)]
+                selected = [by_key[key] for key in fuse_rankings(rankings, top_k)]
+        if not selected:
+            raise AskError(400, "No emails loaded")
+        if self.body_loader:
+            with span('load_bodies'):
+                selected = self._load_bodies(selected, shards[0].account)
+        return selected
+
+    def _load_bodies(self, emails, account):
+        # Bodies are fetched per account, keeping the relevance order
+        groups = {}
+        for email in emails:
+            groups.setdefault(email.get('account', account), []).append(email)
+        loaded = {}
+        for name, group in groups.items():
+            for email, filled in zip(group, self.body_loader(group, account=name)):
+                loaded[id(email)] = {**filled, 'account': name} if 'account' in email else filled
+        return [loaded[id(email)] for email in emails]
+
+    def _session(self, model_id, data):
+        session_id = data.get('session_id')
+        if not session_id:
+            return self.sessions.create(model_id, self.model_limits(model_id),
+                                        number_field(data, 'max_prompt_tokens', minimum=1),
+                                        self.context_cache, bool(data.get('summaries', False)))
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise AskError(404, "Unknown or expired session")
+        if session.model_id != model_id:
+            raise AskError(400, f"Session {session_id} was started with {session.model_id}")
+        return session
+
+    def prepare(self, data):
+        # Validates the request, retrieves the relevant emails and builds the
+        # prompt. Raises AskError for bad requests.
+        model_id, query = self._require(data)
+        if data.get('session_id') or data.get('session'):
+            return self._prepare_turn(model_id, query, data)
+
+        selected = self._select(query, data)
+
+        # Generate the prompt within the model's token budget, optionally
+        # from the ingest-time summaries instead of the bodies
+        summaries = bool(data.get('summaries', False))
+        with span('build_prompt'):
+            prompt, stats = build_prompt(query, selected, self.model_limits(model_id),
+                                         number_field(data, 'max_prompt_tokens', minimum=1),
+                                         summaries=summaries)
+        record_value('prompt_tokens', stats['estimated_tokens'])
+
+        # Serve repeated questions over the same emails from the cache
+        use_cache = data.get('cache', True)
+        key = cache_key(model_id, ('summaries:' if summaries else '') + query, selected)
+        cached = self.answer_cache.get(key) if use_cache else None
+        if use_cache:
+            count('answer_cache_hits' if cached is not None else 'answer_cache_misses')
+
+        return {
+            'model_id': model_id,
+            'query': query,
+            'prompt': prompt,
+            'stats': stats,
+            'key': key,
+            'use_cache': use_cache,
+            'cached': cached,
+        }
+
+    def _prepare_turn(self, model_id, query, data):
+        # A question within a session: sends only what the session hasn't
+        # seen yet, never served from the answer cache
+        session = self._session(model_id, data)
+        selected = self._select(query, data)
+        with span('build_prompt', session=True):
+            contents, message, ids, stats = session.prepare(query, selected)
+        record_value('prompt_tokens', stats['estimated_tokens'])
+        return {
+            'model_id': model_id,
+            'query': query,
+            'prompt': contents,
+            'stats': stats,
+            'key': None,
+            'use_cache': False,
+            'cached': None,
+            'session': session,
+            'session_id': session.id,
+            'message': message,
+            'ids': ids,
+        }
+
+    def _rate_limited(self, error):
+        return AskError(429, str(error), {'Retry-After': str(int(error.wait) + 1)})
+
+    def _fallback(self, ctx, data):
+        # A session's context lives with its model, so sessions never switch
+        return data.get('fallback', False) and ctx.get('session') is None
+
+    def acquire(self, ctx, data):
+        # Waits for rate limit headroom, optionally on another model, and
+        # returns the id of the model to call
+        try:
+            max_wait = number_field(data, 'max_wait', MAX_QUEUE_WAIT, float)
+            with span('rate_limit_wait'):
+                return self.scheduler.acquire(ctx['model_id'], ctx['stats']['estimated_tokens'],
+                                              fallback=self._fallback(ctx, data), max_wait=max_wait,
+                                              candidates=self.model_ids)
+        except RateLimitExceeded as e:
+            raise self._rate_limited(e)
+
+    async def acquire_async(self, ctx, data):
+        try:
+            max_wait = number_field(data, 'max_wait', MAX_QUEUE_WAIT, float)
+            with span('rate_limit_wait'):
+                return await self.scheduler.acquire_async(ctx['model_id'], ctx['stats']['estimated_tokens'],
+                                                          fallback=self._fallback(ctx, data), max_wait=max_wait,
+                                              candidates=self.model_ids)
+        except RateLimitExceeded as e:
+            raise self._rate_limited(e)
+
+    def map_reduce(self, data):
+        # Answers over every email matching the optional since/until/sender/
+        # category filters rather than the top-k retrieved ones. Uses the
+        # ingest-time summaries where available unless "summaries" is false.
+        # Blocks for the whole map and reduce phases.
+        model_id, query = self._require(data)
+        try:
+            since, until = to_timestamp(data.get('since')), to_timestamp(data.get('until'))
+        except ValueError as e:
+            raise AskError(400, f"Invalid date: {e}")
+        category = data.get('category')
+        accounts = self.accounts(data)
+        emails = []
+        for account in accounts:
+            for email in self.shard(account).mailbox.emails():
+                if matches(email, since, until, data.get('sender')) and (
+                        not category or (email.get('summary') or {}).get('category') == category):
+                    emails.append({**email, 'account': account} if len(accounts) > 1 else email)
+        if not emails:
+            raise AskError(400, "No emails match")
+
+        runner = MapReduce(model_id, self.model(model_id), self.scheduler, self.model_limits(model_id),
+                           cache=self.answer_cache if data.get('cache', True) else None,
+                           max_tokens=number_field(data, 'max_prompt_tokens', minimum=1),
+                           max_wait=number_field(data, 'max_wait', MAX_MAP_REDUCE_WAIT, float),
+                           summaries=bool(data.get('summaries', True)))
+        try:
+            answer, stats = runner.answer(query, emails)
+        except RateLimitExceeded as e:
+            raise self._rate_limited(e)
+        return {"response": answer, "model_id": model_id, "map_reduce": stats}
+
+    def model(self, model_id, ctx=None):
+        session = ctx.get('session') if ctx else None
+        if session is not None and session.model is not None:
+            return session.model
+        return self.model_factory(model_id)
+
+    def finish(self, ctx, answer):
+        if ctx.get('session') is not None:
+            ctx['session'].record(ctx['message'], ctx['ids'], answer)
+        elif ctx['use_cache']:
+            self.answer_cache.put(ctx['key'], ctx['model_id'], ctx['query'], answer)
@@ -0,0 +1,703 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tempfile
+import base64
+import asyncio
+import statistics
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from fake_gmail import FakeGmailService, iter_mailbox, generate_message
+import gmail_fetch
+import metrics
+import email_store
+from gmail_fetch import fetch_messages, execute_with_retry, MAX_WORKERS
+from email_index import EmailIndex, select_emails, DEFAULT_TOP_K
+from email_embeddings import SemanticIndex, HashingEmbedder
+from prompt_builder import build_prompt, estimate_tokens, compact_email, dump_compact, shard_emails
+from rate_limiter import Scheduler
+from mime_text import decode_message
+from email_store import open_store, BACKENDS, HEADER_FIELDS, SCAN_WORKERS, SqliteStore
+from fake_gemini import FakeGenerativeModel, fake_model_factory, fake_context_cache
+
+# Offline benchmarks against local stand-ins for the Google services. Every
+# benchmark returns a flat dict of numbers; main() prints them, can run them
+# over several mailbox sizes (--sizes 1k,10k,100k), save them as JSON
+# (--json) and compare them with an earlier run (--compare) to catch
+# regressions. --error-rate makes the fakes answer a share of calls with
+# 429s, so the retry and pacing paths are measured too.
+
+def bench_fetch(count=1000, latency=0.05, workers=MAX_WORKERS, serial_sample=50, error_rate=0.0, **_):
+    service = FakeGmailService.synthetic(count, latency=latency, error_rate=error_rate)
+    ids = list(service.order)
+
+    # Serial baseline is extrapolated from a sample, a full run takes too long
+    sample = ids[:serial_sample]
+    start = time.perf_counter()
+    for msg_id in sample:
+        execute_with_retry(service.users().messages().get(userId='me', id=msg_id, format='full'))
+    serial_rate = len(sample) / (time.perf_counter() - start)
+
+    service.calls = 0
+    start = time.perf_counter()
+    fetched = sum(1 for _, detail, _ in fetch_messages(lambda: service, ids, max_workers=workers) if detail)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'messages': count,
+        'latency': latency,
+        'workers': workers,
+        'serial_msgs_per_sec': round(serial_rate, 1),
+        'batched_msgs_per_sec': round(fetched / elapsed, 1),
+        'batched_seconds': round(elapsed, 3),
+        'round_trips': service.calls,
+        'errors_injected': service.errors_injected,
+    }
+
+def bench_download(count=1000, latency=0.05, workers=MAX_WORKERS, error_rate=0.0, **_):
+    from ed import download_emails
+
+    service = FakeGmailService.synthetic(count, latency=latency, error_rate=error_rate)
+    metrics.reset()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            written = sum(1 for line in download_emails(service, service_factory=lambda: service, max_workers=workers)
+                          if line.startswith(b"Downloaded"))
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    return {
+        'messages': count,
+        'latency': latency,
+        'workers': workers,
+        'written': written,
+        'seconds': round(elapsed, 3),
+        'msgs_per_sec': round(written / elapsed, 1),
+        'round_trips': service.calls,
+        'errors_injected': service.errors_injected,
+        'retries': metric_total('gmail_retries'),
+        'store_mb_written': round(metric_total('store_bytes_written') / 1e6, 2),
+        'batch_p95_ms': metrics.snapshot()['latency'].get('gmail_batch', {}).get('p95_ms', 0),
+    }
+
+def metric_total(name):
+    return metrics.snapshot()['counters'].get(name, {}).get('total', 0)
+
+def bench_twophase(count=1000, latency=0.05, workers=MAX_WORKERS, bandwidth=1000000, k=DEFAULT_TOP_K, error_rate=0.0,
+                   **_):
+    # Full sync versus a metadata-only sync plus lazy bodies for one question
+    from ed import download_emails, fill_bodies
+
+    result = {'messages': count, 'latency': latency, 'workers': workers, 'bandwidth': bandwidth}
+    cwd = os.getcwd()
+    for bodies in ('full', 'lazy'):
+        service = FakeGmailService.synthetic(count, latency=latency, bandwidth=bandwidth, error_rate=error_rate)
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                start = time.perf_counter()
+                for _ in download_emails(service, service_factory=lambda: service, max_workers=workers, bodies=bodies):
+                    pass
+                result[f'{bodies}_sync_seconds'] = round(time.perf_counter() - start, 3)
+                result[f'{bodies}_sync_mb'] = round(service.bytes_sent / 1e6, 2)
+
+                if bodies == 'lazy':
+                    emails = list(open_store('temp').iter_emails())
+                    selected = select_emails(QUERIES[0], emails, k, EmailIndex('temp'))
+                    service.bytes_sent = 0
+                    start = time.perf_counter()
+                    fill_bodies(selected, service_factory=lambda: service, max_workers=workers)
+                    result['lazy_fill_ms'] = round((time.perf_counter() - start) * 1000, 1)
+                    result['lazy_fill_kb'] = round(service.bytes_sent / 1e3, 1)
+            finally:
+                os.chdir(cwd)
+    result['sync_speedup'] = round(result['full_sync_seconds'] / result['lazy_sync_seconds'], 1)
+    result['sync_bytes_ratio'] = round(result['full_sync_mb'] / max(result['lazy_sync_mb'], 0.01), 1)
+    return result
+
+QUERIES = [
+    "which invoices are due this week",
+    "summarize my meeting notes",
+    "what did billing@vendor.com send about payment",
+    "any shipping or delivery updates for my order",
+    "contract review schedule",
+    "summarize my recent emails",
+]
+
+def synthetic_emails(count):
+    from ed import build_email_data
+
+    return [build_email_data(msg['id'], msg) for msg in iter_mailbox(count)]
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def legacy_decode_message(payload):
+    # The decoder before the MIME walker, kept as the baseline: top-level
+    # parts only, first text/plain or raw text/html
+    if 'data' in payload.get('body', {}):
+        return base64.urlsafe_b64decode(payload['body']['data'] + '==').decode('utf-8', errors='ignore')
+    for part in payload.get('parts', []):
+        if part.get('mimeType') in ('text/plain', 'text/html') and part['body'].get('data'):
+            return base64.urlsafe_b64decode(part['body']['data'] + '==').decode('utf-8', errors='ignore')
+    return ""
+
+def bench_mime(count=1000, rounds=3, oversized_every=100, **_):
+    payloads = [msg['payload'] for msg in iter_mailbox(count)]
+    # A few newsletters with multi-megabyte HTML bodies
+    huge = "<html><body>" + "<div><p>weekly digest &amp; offers</p></div>" * 50000 + "</body></html>"
+    encoded = base64.urlsafe_b64encode(huge.encode('utf-8')).decode('ascii').rstrip('=')
+    for i in range(0, count, oversized_every):
+        payloads[i] = {'mimeType': 'text/html', 'headers': [], 'body': {'size': len(huge), 'data': encoded}}
+    input_bytes = sum(len(json.dumps(p)) for p in payloads)
+
+    result = {'messages': count, 'input_mb': round(input_bytes / 1e6, 2)}
+    for name, decode in (('legacy', legacy_decode_message), ('walker', decode_message)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            bodies = [decode(p) for p in payloads]
+        elapsed = (time.perf_counter() - start) / rounds
+        result[f'{name}_msgs_per_sec'] = round(count / elapsed, 1)
+        result[f'{name}_mb_per_sec'] = round(input_bytes / 1e6 / elapsed, 1)
+        result[f'{name}_empty'] = sum(1 for b in bodies if not b.strip())
+        result[f'{name}_raw_html'] = sum(1 for b in bodies if '<html' in b.lower())
+        result[f'{name}_body_tokens'] = sum(estimate_tokens(b) for b in bodies)
+    return result
+
+def bench_load(count=1000, workers=SCAN_WORKERS, **_):
+    # workers defaults to the fetch default (4) from the command line; with
+    # a single CPU the parallel scans can't beat the serial one
+    # Full list load versus streaming scans, per storage backend
+    from email_loader import load_emails_from_temp
+
+    emails = synthetic_emails(count)
+    sender = emails[0]['from']
+    result = {'messages': count, 'workers': workers}
+
+    def measure(run):
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return round(seconds, 3), round(peak / 1e6, 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend, cls in BACKENDS.items():
+            store = cls(os.path.join(tmp, backend))
+            store.put_many(emails)
+            runs = {}
+            if backend == 'sqlite':
+                # load_emails_from_temp opens the default store; it would
+                # migrate a JSON folder into one first
+                runs['load_emails'] = lambda: load_emails_from_temp(store.folder)
+            runs.update({
+                'list': lambda: list(store.iter_emails()),
+                'scan_serial': lambda: sum(1 for _ in store.scan(workers=1)),
+                'scan': lambda: sum(1 for _ in store.scan(workers=workers)),
+                'scan_processes': lambda: sum(1 for _ in store.scan(workers=workers, processes=True)),
+                'scan_headers': lambda: sum(1 for _ in store.scan(HEADER_FIELDS, workers=workers)),
+                'scan_sender': lambda: sum(1 for _ in store.scan(sender=sender, workers=workers)),
+            })
+            for name, run in runs.items():
+                seconds, peak_mb = measure(run)
+                result[f'{backend}_{name}_seconds'] = seconds
+                result[f'{backend}_{name}_peak_mb'] = peak_mb
+            store.close()
+    return result
+
+def bench_retrieval(count=1000, k=DEFAULT_TOP_K, rounds=20, **_):
+    emails = synthetic_emails(count)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = EmailIndex(tmp)
+        start = time.perf_counter()
+        index.rebuild(emails)
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        prompt_chars = []
+        for _ in range(rounds):
+            for query in QUERIES:
+                start = time.perf_counter()
+                selected = select_emails(query, emails, k, index)
+                latencies.append((time.perf_counter() - start) * 1000)
+                prompt_chars.append(len(json.dumps(selected)))
+        index.close()
+
+    return {
+        'messages': count,
+        'top_k': k,
+        'index_build_seconds': round(build_seconds, 3),
+        'index_emails_per_sec': round(count / build_seconds, 1),
+        'query_ms_p50': round(statistics.median(latencies), 2),
+        'query_ms_p95': round(percentile(latencies, 95), 2),
+        'full_prompt_chars': len(json.dumps(emails)),
+        'topk_prompt_chars': int(statistics.mean(prompt_chars)),
+    }
+
+def bench_semantic(count=1000, k=DEFAULT_TOP_K, rounds=20, **_):
+    emails = synthetic_emails(count)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SemanticIndex(tmp, HashingEmbedder())
+        start = time.perf_counter()
+        index.update(emails)
+        embed_seconds = time.perf_counter() - start
+
+        # Reopening must reuse the cached vectors
+        start = time.perf_counter()
+        reopened = SemanticIndex(tmp, HashingEmbedder())
+        reembedded = reopened.update(emails)
+        reload_seconds = time.perf_counter() - start
+
+        latencies = []
+        for _ in range(rounds):
+            for query in QUERIES:
+                start = time.perf_counter()
+                reopened.search(query, k)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'messages': count,
+        'top_k': k,
+        'embed_seconds': round(embed_seconds, 3),
+        'cached_reload_seconds': round(reload_seconds, 3),
+        'reembedded': reembedded,
+        'query_ms_p50': round(statistics.median(latencies), 2),
+        'query_ms_p95': round(percentile(latencies, 95), 2),
+    }
+
+def bench_prompt(count=1000, rounds=20, **_):
+    emails = synthetic_emails(count)
+    # Tight (Gemma 3) and roomy (Gemini 2.0 Flash) token budgets
+    budgets = {'gemma-3': {'tokens_per_minute': 15000}, 'gemini-2.0-flash-001': {'tokens_per_minute': 1000000}}
+    result = {'messages': count, 'raw_prompt_tokens': estimate_tokens(json.dumps(emails))}
+    for model_id, limits in budgets.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            prompt, stats = build_prompt(QUERIES[0], emails, limits)
+        result[f'{model_id}_build_ms'] = round((time.perf_counter() - start) * 1000 / rounds, 2)
+        result[f'{model_id}_prompt_tokens'] = stats['estimated_tokens']
+        result[f'{model_id}_emails'] = stats['emails_included']
+    return result
+
+async def asgi_call(app, method, path, payload):
+    # Runs one request through an ASGI app in-process, returns (status, body)
+    body = json.dumps(payload).encode('utf-8')
+    received = []
+    result = {}
+
+    async def receive():
+        if received:
+            await asyncio.sleep(3600)
+        received.append(True)
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            result['body'] = result.get('body', b'') + message.get('body', b'')
+
+    await app({'type': 'http', 'method': method, 'path': path, 'headers': []}, receive, send)
+    return result.get('status'), result.get('body', b'')
+
+def bench_ask(count=1000, latency=0.05, workers=MAX_WORKERS, requests=200, concurrency=100, error_rate=0.0, **_):
+    # Load test of the ask servers against the fake model: the asyncio app
+    # with `concurrency` questions in flight versus `workers` blocking threads
+    from ask_service import AskService
+    from gemini_email_agent_async import create_app
+    from rate_limiter import is_rate_limit_error
+
+    # Limits high enough that pacing doesn't hide the serving overhead
+    models = [{'id': 'fake-model', 'limits': {'requests_per_minute': 10 ** 6, 'tokens_per_minute': 10 ** 9}}]
+    questions = [{'model_id': 'fake-model', 'query': QUERIES[i % len(QUERIES)], 'cache': False}
+                 for i in range(requests)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = open_store(tmp)
+        store.put_many(synthetic_emails(count))
+        store.close()
+        factory = fake_model_factory(latency, error_rate)
+        service = AskService(models, folder=tmp, model_factory=factory, context_cache=None)
+        service.prepare(dict(questions[0]))  # warm the mailbox and retrieval indexes
+
+        def ask_blocking(data):
+            # Like the Flask route: a 429 from the model is passed on
+            start = time.perf_counter()
+            ctx = service.prepare(data)
+            model_id = service.acquire(ctx, data)
+            try:
+                service.model(model_id).generate_content(ctx['prompt'])
+                ok = True
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                service.scheduler.penalize(model_id)
+                ok = False
+            return ok, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            thread_results = list(pool.map(ask_blocking, questions))
+        thread_seconds = time.perf_counter() - start
+        thread_latencies = [seconds for _, seconds in thread_results]
+
+        app = create_app(service, max_concurrent=concurrency)
+
+        async def run():
+            async def one(data):
+                start = time.perf_counter()
+                status, _ = await asgi_call(app, 'POST', '/ask', data)
+                return status, time.perf_counter() - start
+            return await asyncio.gather(*(one(data) for data in questions))
+
+        start = time.perf_counter()
+        results = asyncio.run(run())
+        async_seconds = time.perf_counter() - start
+
+    async_latencies = [seconds for _, seconds in results]
+    return {
+        'messages': count,
+        'model_latency': latency,
+        'requests': requests,
+        'threads': workers,
+        'threaded_ok': sum(1 for ok, _ in thread_results if ok),
+        'threaded_req_per_sec': round(requests / thread_seconds, 1),
+        'threaded_p50_ms': round(statistics.median(thread_latencies) * 1000, 1),
+        'threaded_p95_ms': round(percentile(thread_latencies, 95) * 1000, 1),
+        'concurrency': concurrency,
+        'async_ok': sum(1 for status, _ in results if status == 200),
+        'async_429': sum(1 for status, _ in results if status == 429),
+        'async_req_per_sec': round(requests / async_seconds, 1),
+        'async_p50_ms': round(statistics.median(async_latencies) * 1000, 1),
+        'async_p95_ms': round(percentile(async_latencies, 95) * 1000, 1),
+        'errors_injected': sum(model.errors_injected for model in factory.models.values()),
+    }
+
+def bench_summaries(count=1000, latency=0.05, error_rate=0.0, **_):
+    # The ingest summary stage against the fake model (first run, then an
+    # incremental rerun), and the size of the whole mailbox as prompt input
+    # from bodies versus from summaries
+    from email_summaries import summarize_emails, SUMMARY_MODEL
+
+    models = [{'id': SUMMARY_MODEL, 'limits': {'requests_per_minute': 10 ** 6, 'tokens_per_minute': 10 ** 9}}]
+    result = {'messages': count}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = open_store(tmp)
+        store.put_many(synthetic_emails(count))
+        model = FakeGenerativeModel(SUMMARY_MODEL, latency, error_rate=error_rate)
+        for run in ('first', 'rerun'):
+            calls = model.calls
+            start = time.perf_counter()
+            for _ in summarize_emails(store, model=model, scheduler=Scheduler(models)):
+                pass
+            result[f'{run}_seconds'] = round(time.perf_counter() - start, 3)
+            result[f'{run}_model_calls'] = model.calls - calls
+        emails = list(store.scan())
+        store.close()
+
+    limits = {'tokens_per_minute': 1000000}
+    for name, summaries in (('bodies', False), ('summaries', True)):
+        result[f'{name}_tokens'] = sum(estimate_tokens(dump_compact(compact_email(email, summaries=summaries)))
+                                       for email in emails)
+        result[f'{name}_shards'] = len(shard_emails(emails, limits, summaries=summaries))
+    return result
+
+def bench_session(count=1000, turns=8, **_):
+    # Input tokens of a conversation asked as separate questions versus one
+    # session, with the context resent and with it uploaded as cached content
+    from ask_service import AskService
+
+    models = [{'id': 'fake-model', 'limits': {'requests_per_minute': 10 ** 6, 'tokens_per_minute': 10 ** 9}}]
+    questions = [QUERIES[i % len(QUERIES)] for i in range(turns)]
+    result = {'messages': count, 'turns': turns}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = open_store(tmp)
+        store.put_many(synthetic_emails(count))
+        store.close()
+        factory = fake_model_factory(0)
+        for mode, context_cache in (('stateless', None), ('session', None),
+                                    ('cached_session', fake_context_cache(factory))):
+            service = AskService(models, folder=tmp, model_factory=factory, context_cache=context_cache)
+            # Large enough a prompt for the context to qualify for caching
+            data = {'model_id': 'fake-model', 'top_k': 200, 'max_prompt_tokens': 100000, 'cache': False}
+            if mode != 'stateless':
+                data['session'] = True
+            tokens = []
+            start = time.perf_counter()
+            for query in questions:
+                ctx = service.prepare(dict(data, query=query))
+                answer = service.model(service.acquire(ctx, data), ctx).generate_content(ctx['prompt']).text
+                service.finish(ctx, answer)
+                tokens.append(ctx['stats']['estimated_tokens'])
+                if ctx.get('session_id'):
+                    data['session_id'] = ctx['session_id']
+            result[f'{mode}_tokens'] = sum(tokens)
+            result[f'{mode}_followup_tokens'] = round(statistics.mean(tokens[1:])) if turns > 1 else 0
+            result[f'{mode}_seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+def bench_storage(count=1000, workers=SCAN_WORKERS, body_scale=10, **_):
+    # SQLite size and read times with bodies stored as text versus
+    # compressed, and the size of the store and search index together. Each
+    # body is joined with the next body_scale - 1 ones, closer to the length
+    # of real mail than the short synthetic bodies.
+    emails = synthetic_emails(count)
+    bodies = [email['body'] for email in emails]
+    for i, email in enumerate(emails):
+        email['body'] = "\n\n".join(bodies[(i + n) % count] for n in range(body_scale))
+    ids = [email['id'] for email in emails[::max(1, count // 200)]]
+    result = {'messages': count, 'body_kb': round(sum(len(e['body']) for e in emails) / count / 1e3, 1),
+              'attachments': sum(len(e.get('attachments', [])) for e in emails)}
+    previous = email_store.BODY_COMPRESSION
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for mode in ('none', 'zlib'):
+                email_store.BODY_COMPRESSION = mode
+                store = SqliteStore(os.path.join(tmp, mode))
+                start = time.perf_counter()
+                for i in range(0, count, 1000):
+                    store.put_many(emails[i:i + 1000])
+                result[f'{mode}_write_seconds'] = round(time.perf_counter() - start, 3)
+                store.compact()
+                result[f'{mode}_db_mb'] = round(store.size() / 1e6, 2)
+                index = EmailIndex(store.folder)
+                index.rebuild(emails)
+                index.close()
+                result[f'{mode}_index_mb'] = round(index.size() / 1e6, 2)
+                result[f'{mode}_total_mb'] = round((store.size() + index.size()) / 1e6, 2)
+                runs = {
+                    'scan': lambda: sum(1 for _ in store.scan(workers=workers)),
+                    'scan_headers': lambda: sum(1 for _ in store.scan(HEADER_FIELDS, workers=workers)),
+                    'get': lambda: [store.get(msg_id) for msg_id in ids],
+                }
+                for name, run in runs.items():
+                    start = time.perf_counter()
+                    run()
+                    result[f'{mode}_{name}_seconds'] = round(time.perf_counter() - start, 3)
+                store.close()
+    finally:
+        email_store.BODY_COMPRESSION = previous
+    result['size_ratio'] = round(result['zlib_db_mb'] / max(result['none_db_mb'], 0.01), 2)
+    result['total_size_ratio'] = round(result['zlib_total_mb'] / max(result['none_total_mb'], 0.01), 2)
+    return result
+
+def bench_daemon(count=1000, latency=0.05, changes=50, rate=5.0, idle=10.0, error_rate=0.0, **_):
+    # Freshness of the background sync: new mail arrives at `rate` messages
+    # per second and the lag until each one is in the store is measured,
+    # with adaptive polling and with push notifications. Gmail calls are
+    # counted while mail arrives and over `idle` quiet seconds after.
+    from ed import sync_emails
+    from sync_jobs import JobManager
+    from sync_daemon import SyncDaemon
+
+    result = {'messages': count, 'changes': changes, 'rate': rate}
+    for mode in ('poll', 'push'):
+        service = FakeGmailService.synthetic(count, latency=latency, error_rate=error_rate)
+        with tempfile.TemporaryDirectory() as tmp:
+            jobs = JobManager(lambda job: sync_emails(service, service_factory=lambda: service, store=open_store(tmp)))
+            daemon = SyncDaemon('bench', jobs, lambda: service, tmp, min_interval=0.5, max_interval=8.0,
+                                topic='local' if mode == 'push' else None, min_gap=0.2)
+            service.subscribe(daemon.notify)
+            daemon.start()
+            while daemon.stats['syncs'] == 0 and not daemon.last_error:
+                time.sleep(0.05)
+            store = open_store(tmp)
+            calls = service.calls
+            added = {}
+            seen = {}
+            for n in range(changes):
+                msg = generate_message(count + n)
+                service.add_message(msg)
+                added[msg['id']] = time.perf_counter()
+                deadline = time.perf_counter() + 1 / rate
+                # Check what arrived meanwhile
+                while time.perf_counter() < deadline:
+                    for msg_id in [m for m in added if m not in seen]:
+                        if store.get(msg_id) is not None:
+                            seen[msg_id] = time.perf_counter()
+                    time.sleep(0.01)
+            deadline = time.perf_counter() + 30
+            while len(seen) < len(added) and time.perf_counter() < deadline:
+                for msg_id in [m for m in added if m not in seen]:
+                    if store.get(msg_id) is not None:
+                        seen[msg_id] = time.perf_counter()
+                time.sleep(0.01)
+            busy_calls = service.calls - calls
+            calls = service.calls
+            time.sleep(idle)
+            daemon.stop(timeout=10)
+            store.close()
+        lags = [seen[msg_id] - added[msg_id] for msg_id in seen]
+        result[f'{mode}_synced'] = len(seen)
+        result[f'{mode}_lag_ms_p50'] = round(percentile(lags, 50) * 1000, 1) if lags else None
+        result[f'{mode}_lag_ms_p95'] = round(percentile(lags, 95) * 1000, 1) if lags else None
+        result[f'{mode}_syncs'] = daemon.stats['syncs']
+        result[f'{mode}_busy_calls'] = busy_calls
+        result[f'{mode}_idle_calls'] = service.calls - calls
+    return result
+
+BENCHMARKS = {
+    'fetch': bench_fetch,
+    'download': bench_download,
+    'twophase': bench_twophase,
+    'retrieval': bench_retrieval,
+    'semantic': bench_semantic,
+    'prompt': bench_prompt,
+    'mime': bench_mime,
+    'load': bench_load,
+    'ask': bench_ask,
+    'session': bench_session,
+    'summaries': bench_summaries,
+    'storage': bench_storage,
+    'daemon': bench_daemon,
+}
+
+# The core stages: sync throughput, load time, MIME decoding, prompt size
+# and /ask latency and throughput
+SUITE = ['download', 'load', 'mime', 'prompt', 'ask']
+
+# Result keys by suffix: higher is better (1) or lower is better (-1).
+# Other values (sizes, counts) are only reported when they change.
+DIRECTIONS = [('_per_sec', 1), ('_speedup', 1), ('_ok', 1), ('_seconds', -1), ('_ms', -1), ('_mb', -1), ('_kb', -1),
+              ('_ms_p50', -1), ('_ms_p95', -1), ('_429', -1), ('retries', -1)]
+
+# Timing changes smaller than this many seconds are noise, whatever the ratio
+NOISE_SECONDS = 0.005
+
+def direction(key):
+    for suffix, sign in DIRECTIONS:
+        if key.endswith(suffix) or key == suffix[1:]:
+            return sign
+    return 0
+
+def is_noise(key, old, new):
+    if key.endswith('_ms') or '_ms_' in key:
+        return abs(new - old) / 1000 < NOISE_SECONDS
+    if key.endswith('seconds'):
+        return abs(new - old) < NOISE_SECONDS
+    return False
+
+def parse_size(value):
+    # 1000, 10k, 1m
+    value = value.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    return int(float(value[:-1] if scale > 1 else value) * scale)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare_results(results, baseline, tolerance):
+    # Returns (regressions, changes) as lines; a timing or rate metric is a
+    # regression when it got worse by more than tolerance
+    regressions, changes = [], []
+    for run, result in results.items():
+        old_result = baseline.get(run)
+        if old_result is None:
+            continue
+        for key, new in result.items():
+            old = old_result.get(key)
+            if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or old == new:
+                continue
+            change = (new - old) / abs(old) if old else float('inf')
+            line = f"{run} {key}: {old} -> {new} ({change:+.0%})"
+            sign = direction(key)
+            if sign and -sign * change > tolerance and not is_noise(key, old, new):
+                regressions.append(line)
+            elif not sign:
+                changes.append(line)
+    return regressions, changes
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', nargs='*', default=list(BENCHMARKS),
+                        help="Benchmarks to run, or 'suite' for " + ", ".join(SUITE))
+    parser.add_argument('--messages', default=1000, type=int, help='Size of the synthetic mailbox')
+    parser.add_argument('--sizes', default=None,
+                        help='Comma separated mailbox sizes to run every benchmark at, e.g. 1k,10k,100k')
+    parser.add_argument('--latency', default=0.05, type=float, help='Simulated round-trip latency in seconds')
+    parser.add_argument('--workers', default=MAX_WORKERS, type=int, help='Number of concurrent batch requests')
+    parser.add_argument('--bandwidth', default=1000000, type=int, help='Simulated Gmail bytes per second per connection')
+    parser.add_argument('--requests', default=200, type=int, help='Questions sent by the ask load test')
+    parser.add_argument('--concurrency', default=100, type=int, help='Questions in flight in the ask load test')
+    parser.add_argument('--gmail-quota', default=0, type=int,
+                        help='Gmail quota units per minute to pace syncs to (0: unpaced, the fake has no quota)')
+    parser.add_argument('--error-rate', default=0.0, type=float,
+                        help='Share of fake Gmail and Gemini calls answered with a 429')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Relative slowdown of a timing or rate metric reported as a regression')
+    args = parser.parse_args()
+    gmail_fetch.USER_QUOTA_PER_MINUTE = args.gmail_quota
+
+    names = []
+    for name in args.bench:
+        for bench in SUITE if name == 'suite' else [name]:
+            if bench not in BENCHMARKS:
+                parser.error(f"unknown benchmark {bench}, choose from: suite, {', '.join(BENCHMARKS)}")
+            if bench not in names:
+                names.append(bench)
+    sizes = [parse_size(size) for size in args.sizes.split(',')] if args.sizes else [args.messages]
+
+    results = {}
+    for count in sizes:
+        for name in names:
+            run = f"{name}@{count}" if args.sizes else name
+            results[run] = BENCHMARKS[name](count=count, latency=args.latency, workers=args.workers,
+                                            bandwidth=args.bandwidth, requests=args.requests,
+                                            concurrency=args.concurrency, error_rate=args.error_rate)
+            print(f"[{run}] " + ", ".join(f"{k}={v}" for k, v in results[run].items()))
+
+    settings = {key: value for key, value in vars(args).items() if key not in ('bench', 'json', 'compare', 'tolerance')}
+    if args.json:
+        report = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'settings': settings,
+            },
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"[+] Results written to {args.json}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        differing = {key: (baseline['meta']['settings'].get(key), value) for key, value in settings.items()
+                     if baseline['meta']['settings'].get(key) != value}
+        if differing:
+            print(f"[!] Baseline was run with other settings: {differing}")
+        regressions, changes = compare_results(results, baseline['results'], args.tolerance)
+        for line in changes:
+            print(f"[+] Changed: {line}")
+        for line in regressions:
+            print(f"[!] Regression: {line}")
+        print(f"[+] Compared with {args.compare} ({baseline['meta'].get('commit')}): "
+              f"{len(regressions)} regressions beyond {args.tolerance:.0%}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import time
+import uuid
+import datetime
+import threading
+from prompt_builder import pack_emails, prompt_budget, estimate_tokens, truncate_tokens, dump_compact
+
+# Multi-turn question sessions. The emails retrieved for the first question
+# become the session's context and are sent only once: follow-ups carry the
+# new question plus any newly relevant emails, with the earlier turns as chat
+# history. Contexts large enough are uploaded as Gemini cached content so
+# follow-ups don't pay for them again; otherwise the context stays the
+# unchanged first turn of every request, which the API can reuse through its
+# implicit prefix caching.
+
+# Share of the prompt budget the first context may take, the rest is left
+# for follow-up emails and history
+CONTEXT_SHARE = 0.5
+# A follow-up adds the best retrieved emails the session hasn't seen, at
+# most this many and within this share of the budget (older turns are
+# dropped to make room)
+FOLLOWUP_EMAILS = 5
+FOLLOWUP_SHARE = 0.25
+# Gemini only caches contexts at least this large
+CONTEXT_CACHE_MIN_TOKENS = 32768
+# Idle sessions expire after this many seconds
+SESSION_TTL = 30 * 60
+MAX_SESSIONS = 1000
+
+CONTEXT_TEMPLATE = "Answer my questions using these emails:\n\n{emails}"
+MORE_EMAILS_TEMPLATE = "More emails that may be relevant:\n\n{emails}\n\n{query}"
+
+class ChatSession:
+    def __init__(self, model_id, limits=None, max_tokens=None, cache_factory=None, ttl=SESSION_TTL, summaries=False):
+        self.id = uuid.uuid4().hex
+        self.model_id = model_id
+        self.budget = prompt_budget(limits, max_tokens)
+        # cache_factory(model_id, contents, ttl) -> (model, handle), see gemini_client.cache_context
+        self.cache_factory = cache_factory
+        self.ttl = ttl
+        # Send emails that have an ingest-time summary as that summary
+        self.summaries = summaries
+        self.context = None
+        self.context_ids = []
+        # [{'message', 'answer', 'ids', 'tokens'}], oldest first
+        self.turns = []
+        # Model answering on top of the cached context, None when not cached
+        self.model = None
+        self._cache = None
+        self._cache_expires = 0
+        self.created = time.time()
+        self.last_used = self.created
+        self._lock = threading.Lock()
+
+    @property
+    def expired(self):
+        return time.time() - self.last_used > self.ttl
+
+    def _sent_ids(self):
+        ids = set(self.context_ids)
+        for turn in self.turns:
+            ids.update(turn['ids'])
+        return ids
+
+    def _cache_context(self):
+        if self.cache_factory is None or estimate_tokens(self.context) < CONTEXT_CACHE_MIN_TOKENS:
+            return
+        try:
+            self.model, self._cache = self.cache_factory(
+                self.model_id, [{'role': 'user', 'parts': [self.context]}], self.ttl)
+            self._cache_expires = time.time() + self.ttl
+        except Exception as e:
+            print(f"[!] Context caching unavailable for {self.model_id}, resending it instead: {e}")
+
+    def _keep_cache_alive(self):
+        # Extends the cached context while the session is in use, or falls
+        # back to sending it when that fails
+        if self._cache is None or self._cache_expires - time.time() > self.ttl / 2:
+            return
+        try:
+            self._cache.update(ttl=datetime.timedelta(seconds=self.ttl))
+            self._cache_expires = time.time() + self.ttl
+        except Exception as e:
+            print(f"[!] Cached context for session {self.id} expired, resending it: {e}")
+            self.model = None
+            self._cache = None
+
+    def _history_tokens(self):
+        return sum(turn['tokens'] for turn in self.turns)
+
+    def contents(self, message):
+        # The request contents for message: the context (unless cached), the
+        # earlier turns and the new message
+        contents = []
+        for turn in self.turns:
+            contents.append({'role': 'user', 'parts': [turn['message']]})
+            contents.append({'role': 'model', 'parts': [turn['answer']]})
+        contents.append({'role': 'user', 'parts': [message]})
+        if self.model is None:
+            first = contents[0]['parts'][0]
+            contents[0] = {'role': 'user', 'parts': [self.context + "\n\n" + first]}
+        return contents
+
+    def prepare(self, query, emails):
+        # Returns (contents, message, ids, stats) for the next question;
+        # emails are the ones retrieved for it, in relevance order. Pass
+        # message and ids back to record() with the answer.
+        with self._lock:
+            self.last_used = time.time()
+            query = truncate_tokens(query, self.budget // 8)
+            if self.context is None:
+                packed, truncated, _ = pack_emails(emails, int(self.budget * CONTEXT_SHARE), self.summaries)
+                self.context_ids = [email['id'] for email in emails[:len(packed)]]
+                self.context = CONTEXT_TEMPLATE.format(emails=dump_compact(packed))
+                self._cache_context()
+                message, ids = query, []
+                new_emails = len(packed)
+            else:
+                self._keep_cache_alive()
+                base = 0 if self.model is not None else estimate_tokens(self.context)
+                room = self.budget - base - estimate_tokens(MORE_EMAILS_TEMPLATE + query)
+                # Forget the oldest turns until a follow-up has room for new emails
+                while self.turns and room - self._history_tokens() < self.budget * FOLLOWUP_SHARE:
+                    self.turns.pop(0)
+                sent = self._sent_ids()
+                fresh = [email for email in emails[:FOLLOWUP_EMAILS] if email['id'] not in sent]
+                room = min(room - self._history_tokens(), int(self.budget * FOLLOWUP_SHARE))
+                packed, truncated, _ = pack_emails(fresh, max(0, room), self.summaries)
+                ids = [email['id'] for email in fresh[:len(packed)]]
+                message = MORE_EMAILS_TEMPLATE.format(emails=dump_compact(packed), query=query) if packed else query
+                new_emails = len(packed)
+
+            contents = self.contents(message)
+            stats = {
+                'emails_included': new_emails,
+                'context_emails': len(self._sent_ids()) + len(ids),
+                'bodies_truncated': truncated,
+                'history_turns': len(self.turns),
+                'context_cached': self.model is not None,
+                'estimated_tokens': sum(estimate_tokens(c['parts'][0]) for c in contents),
+                'budget_tokens': self.budget,
+            }
+            return contents, message, ids, stats
+
+    def record(self, message, ids, answer):
+        with self._lock:
+            self.turns.append({'message': message, 'answer': answer, 'ids': ids,
+                               'tokens': estimate_tokens(message) + estimate_tokens(answer)})
+            self.last_used = time.time()
+
+    def close(self):
+        if self._cache is not None:
+            try:
+                self._cache.delete()
+            except Exception:
+                pass
+            self._cache = None
+            self.model = None
+
+    def to_dict(self):
+        return {
+            'session_id': self.id,
+            'model_id': self.model_id,
+            'turns': len(self.turns),
+            'context_emails': len(self._sent_ids()),
+            'context_cached': self.model is not None,
+            'created': self.created,
+            'last_used': self.last_used,
+        }
+
+class SessionStore:
+    # Open sessions by id, shared by the request threads
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, model_id, limits=None, max_tokens=None, cache_factory=None, summaries=False):
+        session = ChatSession(model_id, limits, max_tokens, cache_factory, self.ttl, summaries)
+        with self._lock:
+            closed = self._prune()
+            if len(self.sessions) >= self.max_sessions:
+                oldest = min(self.sessions.values(), key=lambda s: s.last_used)
+                closed.append(self.sessions.pop(oldest.id))
+            self.sessions[session.id] = session
+        for old in closed:
+            old.close()
+        return session
+
+    def _prune(self):
+        expired = [s for s in self.sessions.values() if s.expired]
+        for session in expired:
+            del self.sessions[session.id]
+        return expired
+
+    def get(self, session_id):
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None and session.expired:
+                del self.sessions[session_id]
+                session.close()
+                return None
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+        return session is not None
+
+    def list(self):
+        with self._lock:
+            for session in self._prune():
+                session.close()
+            return [s.to_dict() for s in sorted(self.sessions.values(), key=lambda s: s.last_used, reverse=True)]
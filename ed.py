@@ -1,200 +1,574 @@
 import os
 import json
+import time
 import argparse
-import base64
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from gmail_fetch import (fetch_messages, list_unique_messages, execute_with_retry, user_quota, is_not_found,
+                         MAX_WORKERS)
+from gmail_sync import HistoryExpired, SyncCheckpoint, get_history_id, list_history_changes
+from email_store import open_store
+from email_index import EmailIndex
+from sync_jobs import JobManager
+from sync_daemon import SyncDaemon, decode_push, route_notification, verify_push, PUSH_TOPIC, PUSH_TOKEN, PUSH_AUDIENCE
+from mime_text import decode_message, list_attachments
+from email_summaries import summarize_emails, keep_summary
+from accounts import DEFAULT_ACCOUNT, token_path, account_folder, list_accounts, resolve_accounts
+from metrics import snapshot as metrics_snapshot
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
-def authenticate_gmail():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token_file:
-            token_file.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
-
-def decode_message(payload):
-    if 'data' in payload.get('body', {}):
-        raw_data = payload['body']['data']
-        decoded_bytes = base64.urlsafe_b64decode(raw_data + '==')
-        return decoded_bytes.decode('utf-8', errors='ignore')
-    elif 'parts' in payload:
-        parts = payload['parts']
-        for part in parts:
-            if part.get('mimeType') == 'text/plain':
-                raw_data = part['body'].get('data')
-                if raw_data:
-                    decoded_bytes = base64.urlsafe_b64decode(raw_data + '==')
-                    return decoded_bytes.decode('utf-8', errors='ignore')
-            elif part.get('mimeType') == 'text/html':
-                raw_data = part['body'].get('data')
-                if raw_data:
-                    decoded_bytes = base64.urlsafe_b64decode(raw_data + '==')
-                    return decoded_bytes.decode('utf-8', errors='ignore')
-    return ""
+# Credentials are loaded once per account and process and only refreshed when expired
+_creds = {}
+_creds_lock = threading.Lock()
+
+def get_credentials(account=DEFAULT_ACCOUNT):
+    path = token_path(account)
+    with _creds_lock:
+        creds = _creds.get(account)
+        if creds is None and os.path.exists(path):
+            creds = Credentials.from_authorized_user_file(path, SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as token_file:
+                token_file.write(creds.to_json())
+        _creds[account] = creds
+        return creds
+
+def authenticate_gmail(account=DEFAULT_ACCOUNT):
+    # Gmail clients aren't thread-safe, so each thread builds its own from
+    # the shared credentials
+    return build('gmail', 'v1', credentials=get_credentials(account))
 
 def list_labels(service):
     results = service.users().labels().list(userId='me').execute()
     labels = [label['name'] for label in results.get('labels', [])]
     print("Labels:", labels)
 
-def download_emails(service, max_results=None, showlog=False):
-    os.makedirs('temp', exist_ok=True)
-    all_messages = []
-    next_page_token = None
-    total_emails = 0
+def build_email_data(msg_id, msg_detail):
+    payload = msg_detail.get('payload', {})
+    headers = payload.get('headers', [])
+
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "No Subject")
+    from_ = next((h['value'] for h in headers if h['name'] == 'From'), "Unknown Sender")
+    to = next((h['value'] for h in headers if h['name'] == 'To'), "Unknown Recipient")
+    date = next((h['value'] for h in headers if h['name'] == 'Date'), "Unknown Date")
+    snippet = msg_detail.get('snippet', '')
+    body = decode_message(payload)
+
+    email_data = {
+        'id': msg_id,
+        'subject': subject,
+        'from': from_,
+        'to': to,
+        'date': date,
+        'snippet': snippet,
+        'body': body,
+        'labels': msg_detail.get('labelIds', [])
+    }
+    # Names, types and sizes only, attachments themselves aren't downloaded
+    attachments = list_attachments(payload)
+    if attachments:
+        email_data['attachments'] = attachments
+    return email_data
+
+# Emails are buffered and written to the store in bulk
+WRITE_BATCH = 500
+
+# Body modes: 'full' downloads whole messages during the sync, 'lazy' only
+# headers and snippet (format=metadata). Lazily synced emails are marked
+# body_pending and their bodies are fetched by fill_bodies() when retrieval
+# picks them for a prompt.
+BODY_MODES = ('full', 'lazy')
+BODY_PENDING = 'body_pending'
+
+# Store meta key of the messages an incremental sync failed to download,
+# fetched again first by the next one
+RETRY_IDS = 'retryIds'
+
+def fetch_format(bodies):
+    if bodies not in BODY_MODES:
+        raise ValueError(f"Unknown body mode: {bodies}")
+    return 'metadata' if bodies == 'lazy' else 'full'
+
+def build_synced_email(store, msg_id, msg_detail, bodies):
+    email_data = build_email_data(msg_id, msg_detail)
+    existing = store.get(msg_id)
+    if bodies == 'lazy':
+        # Keep a body downloaded earlier rather than replacing it with a stub
+        if existing and not existing.get(BODY_PENDING):
+            email_data['body'] = existing.get('body', '')
+            if existing.get('attachments'):
+                email_data['attachments'] = existing['attachments']
+        else:
+            email_data[BODY_PENDING] = True
+    # A summary stays valid as long as the content it was made from
+    return keep_summary(email_data, existing)
+
+def save_emails(store, index, emails):
+    store.put_many(emails)
+    index.add_many(emails)
+
+def remove_emails(store, index, msg_ids):
+    store.delete(msg_ids)
+    index.remove(msg_ids)
+
+def download_emails(service, max_results=None, showlog=False, service_factory=None, max_workers=MAX_WORKERS, store=None,
+                    bodies='full'):
+    store = store or open_store()
+    index = EmailIndex(store.folder)
+    pending = []
+
+    # Progress is checkpointed so a sync that dies part way (token refresh,
+    # quota, network) picks up where it stopped on the next run
+    checkpoint = SyncCheckpoint(store.folder)
+    resumed = checkpoint.begin({'max_results': max_results, 'bodies': bodies})
 
-    # Fetch all labels
-    labels_response = service.users().labels().list(userId='me').execute()
-    labels = labels_response.get('labels', [])
+    def flush():
+        save_emails(store, index, pending)
+        checkpoint.mark_fetched([email['id'] for email in pending])
+        pending.clear()
 
     try:
-        # Loop through all labels
-        for label in labels:
-            label_id = label['id']
-            label_name = label['name']
-            label_message_count = 0  # To count emails per label
-
-            print(f"Fetching emails for label: {label_name}")
-
-            # Fetch messages for this label with pagination
-            while True:
-                response = service.users().messages().list(
-                    userId='me',
-                    maxResults=min(max_results, 5000000) if max_results else 5000000,
-                    labelIds=[label_id],
-                    pageToken=next_page_token
-                ).execute()
-
-                messages = response.get('messages', [])
-                all_messages.extend(messages)
-                label_message_count += len(messages)
-
-                # Check for the next page token
-                next_page_token = response.get('nextPageToken', None)
-                if not next_page_token or (max_results and len(all_messages) >= max_results):
-                    break
-
-            # Print total emails for this label
-            print(f"Total emails for label {label_name}: {label_message_count}")
-            total_emails += label_message_count
-
-            # Stop if max_results is reached
-            if max_results and len(all_messages) >= max_results:
-                break
-
-        # Print grand total emails
-        if max_results:
-            print(f"Grand total emails fetched: {total_emails}/{max_results}")
+        # Record the history id before listing so changes made during the sync
+        # are picked up by the next incremental run
+        history_id = checkpoint.history_id if resumed else None
+        if history_id is None:
+            history_id = checkpoint.history_id = get_history_id(service)
+
+        if checkpoint.listing_done():
+            all_messages, _, _, total_listed = checkpoint.listing()
+            if max_results:
+                all_messages = all_messages[:max_results]
         else:
-            print(f"Grand total emails fetched: {total_emails}")
-
-        # Limit the number of emails if max_results is set
-        if max_results:
-            all_messages = all_messages[:max_results]
-
-        for i, msg in enumerate(all_messages):
-            msg_detail = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-            payload = msg_detail.get('payload', {})
-            headers = payload.get('headers', [])
-
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "No Subject")
-            from_ = next((h['value'] for h in headers if h['name'] == 'From'), "Unknown Sender")
-            to = next((h['value'] for h in headers if h['name'] == 'To'), "Unknown Recipient")
-            date = next((h['value'] for h in headers if h['name'] == 'Date'), "Unknown Date")
-            snippet = msg_detail.get('snippet', '')
-            body = decode_message(payload)
-
-            email_data = {
-                'id': msg['id'],
-                'subject': subject,
-                'from': from_,
-                'to': to,
-                'date': date,
-                'snippet': snippet,
-                'body': body
-            }
-
-            with open(f'temp/email_{i+1}.json', 'w') as f:
-                json.dump(email_data, f, indent=2)
+            # Fetch all labels
+            labels_response = execute_with_retry(service.users().labels().list(userId='me'))
+            labels = labels_response.get('labels', [])
+
+            # List every label once, keeping a single entry per message
+            all_messages, total_listed = list_unique_messages(service, labels, max_results, checkpoint)
+            checkpoint.finish_listing()
+        skipped = total_listed - len(all_messages)
+        print(f"Grand total emails listed: {total_listed}, unique: {len(all_messages)}"
+              f" ({skipped} duplicate fetches avoided)")
+        yield f"Listed {len(all_messages)} unique emails ({skipped} duplicates across labels skipped)\n".encode("utf-8")
+
+        done = checkpoint.fetched_ids() if resumed else set()
+        if done:
+            log_message = f"Resuming sync: {len(done)} of {len(all_messages)} emails already downloaded\n"
+            print(log_message)
+            yield log_message.encode("utf-8")
+
+        # Fetch message details in concurrent batches instead of one get per message
+        message_ids = [msg['id'] for msg in all_messages if msg['id'] not in done]
+        fetched = fetch_messages(service_factory or (lambda: service), message_ids, fetch_format(bodies),
+                                 max_workers=max_workers if service_factory else 1, quota=user_quota(store.folder))
+        failed = []
+        for i, (msg_id, msg_detail, error) in enumerate(fetched, start=len(all_messages) - len(message_ids)):
+            if error is not None:
+                if is_not_found(error):
+                    # Deleted since it was listed
+                    checkpoint.mark_fetched([msg_id])
+                else:
+                    failed.append(msg_id)
+                log_message = f"Failed to download email {i+1} ({msg_id}): {error}\n"
+                print(log_message)
+                yield log_message.encode("utf-8")
+                continue
+
+            email_data = build_synced_email(store, msg_id, msg_detail, bodies)
+            subject, from_, to = email_data['subject'], email_data['from'], email_data['to']
+
+            pending.append(email_data)
+            if len(pending) >= WRITE_BATCH:
+                flush()
 
             log_message = f"Downloaded email {i+1}: {subject} from {from_} to {to}\n"
             if showlog:
                 print(log_message)
             yield log_message.encode("utf-8")
+        flush()
+
+        if failed:
+            # Not a complete mirror yet: the checkpoint stays, so the next
+            # run fetches only the emails that failed
+            log_message = f"{len(failed)} emails failed to download. Run the sync again to fetch them.\n"
+            print(log_message)
+            yield log_message.encode("utf-8")
+            return
+
+        # Only a complete mirror can be the base for incremental syncs
+        if not max_results:
+            listed = {msg['id'] for msg in all_messages}
+            remove_emails(store, index, set(store.ids()) - listed)
+            store.set_meta(RETRY_IDS, [])
+            store.set_meta('historyId', history_id)
+        checkpoint.clear()
+
+    except Exception as e:
+        log_message = f"Sync interrupted: {e}. Run it again to resume where it stopped.\n"
+        print(log_message)
+        yield log_message.encode("utf-8")
+        raise
+    finally:
+        if pending:
+            flush()
+        checkpoint.close()
+
+def sync_history(service, store, showlog=False, service_factory=None, max_workers=MAX_WORKERS, bodies='full'):
+    index = EmailIndex(store.folder)
+    start_history_id = store.get_meta('historyId')
+    added, deleted, relabeled, history_id = list_history_changes(service, start_history_id)
+    # Emails the last sync failed to download, unless they are gone since
+    retry = set(store.get_meta(RETRY_IDS, [])) - deleted
+    added |= retry
+    print(f"History since {start_history_id}: {len(added)} added ({len(retry)} retried), {len(deleted)} deleted, "
+          f"{len(relabeled)} relabeled")
+
+    remove_emails(store, index, deleted)
+    for msg_id in deleted:
+        log_message = f"Deleted email {msg_id}\n"
+        if showlog:
+            print(log_message)
+        yield log_message.encode("utf-8")
+
+    for msg_id, label_ids in relabeled.items():
+        email_data = store.get(msg_id)
+        if email_data is None:
+            # Not mirrored locally yet, download it in full
+            added.add(msg_id)
+            continue
+        email_data['labels'] = label_ids
+        store.upsert(email_data)
+        log_message = f"Relabeled email {msg_id}: {', '.join(label_ids)}\n"
+        if showlog:
+            print(log_message)
+        yield log_message.encode("utf-8")
+
+    pending = []
+    fetched = fetch_messages(service_factory or (lambda: service), sorted(added), fetch_format(bodies),
+                             max_workers=max_workers if service_factory else 1, quota=user_quota(store.folder))
+    failed = []
+    for msg_id, msg_detail, error in fetched:
+        if error is not None:
+            if not is_not_found(error):
+                failed.append(msg_id)
+            log_message = f"Failed to download email {msg_id}: {error}\n"
+            print(log_message)
+            yield log_message.encode("utf-8")
+            continue
+
+        email_data = build_synced_email(store, msg_id, msg_detail, bodies)
+        pending.append(email_data)
+
+        log_message = f"Downloaded email {msg_id}: {email_data['subject']} from {email_data['from']} to {email_data['to']}\n"
+        if showlog:
+            print(log_message)
+        yield log_message.encode("utf-8")
+
+    save_emails(store, index, pending)
+    # The history id moves on, the failed emails are fetched again next time
+    store.set_meta(RETRY_IDS, sorted(failed))
+    store.set_meta('historyId', history_id)
+
+def sync_emails(service, max_results=None, showlog=False, service_factory=None, max_workers=MAX_WORKERS, full=False, store=None,
+                bodies='full', summarize=False):
+    # Syncs the mailbox, then with summarize runs the summary stage over
+    # new and changed emails
+    store = store or open_store()
+    yield from sync_mailbox(service, max_results, showlog, service_factory, max_workers, full, store, bodies)
+    if summarize:
+        try:
+            yield from summarize_emails(store, showlog)
+        except Exception as e:
+            # The sync itself succeeded, summaries are picked up next time
+            log_message = f"Summaries stopped: {e}\n"
+            print(log_message)
+            yield log_message.encode("utf-8")
 
+def sync_mailbox(service, max_results, showlog, service_factory, max_workers, full, store, bodies):
+    # Apply history deltas when a previous full sync exists, otherwise (or
+    # once the history window has expired) download everything
+    # An interrupted full sync is finished first
+    checkpoint = SyncCheckpoint(store.folder)
+    interrupted = checkpoint.pending()
+    checkpoint.close()
+    if not full and not max_results and not interrupted and store.get_meta('historyId'):
+        try:
+            yield from sync_history(service, store, showlog, service_factory, max_workers, bodies)
+            return
+        except HistoryExpired:
+            log_message = "History window expired, falling back to a full sync\n"
+            print(log_message)
+            yield log_message.encode("utf-8")
+    yield from download_emails(service, max_results, showlog, service_factory, max_workers, store, bodies)
+
+def fill_bodies(emails, service_factory=None, folder=None, max_workers=MAX_WORKERS, account=DEFAULT_ACCOUNT):
+    # Second phase of a lazy sync: downloads the bodies of the given emails
+    # of an account that don't have one yet, stores them and returns the
+    # emails with bodies in place. Emails keep their snippet if Gmail can't
+    # be reached.
+    missing = [email['id'] for email in emails if email.get(BODY_PENDING)]
+    if not missing:
+        return emails
+    folder = folder or account_folder(account)
+    try:
+        fetched = {msg_id: build_email_data(msg_id, msg_detail)
+                   for msg_id, msg_detail, error in fetch_messages(service_factory or partial(authenticate_gmail, account),
+                                                                   missing, max_workers=max_workers,
+                                                                   quota=user_quota(folder))
+                   if error is None}
     except Exception as e:
-        print(f"An error occurred: {str(e)}")
+        print(f"[!] Could not download email bodies: {e}")
+        return emails
+    if fetched:
+        store = open_store(folder)
+        index = EmailIndex(folder)
+        save_emails(store, index, list(fetched.values()))
+        index.close()
+        store.close()
+    return [fetched.get(email['id'], email) for email in emails]
+
+def run_sync_job(job):
+    # Runs in the job's thread, so it builds its own Gmail client. The job's
+    # mailbox is the account name.
+    params = job.params
+    factory = partial(authenticate_gmail, job.mailbox)
+    return sync_emails(factory(), params.get('max'), params.get('showdownloadlog', False),
+                       service_factory=factory, max_workers=int(params.get('workers', MAX_WORKERS)),
+                       full=params.get('full', False), store=open_store(account_folder(job.mailbox)),
+                       bodies=params.get('bodies', 'full'), summarize=params.get('summarize', False))
+
+# Accounts synced at the same time. Each stays under its own Gmail quota
+# (see gmail_fetch.user_quota); the cap bounds the load on this machine
+# and the project-wide quota.
+MAX_CONCURRENT_SYNCS = int(os.getenv('MAX_CONCURRENT_SYNCS', 3))
+
+# One sync per account at a time, shared by every client that asks for it
+jobs = JobManager(run_sync_job, max_running=MAX_CONCURRENT_SYNCS)
+
+# Background sync daemons by account, see sync_daemon.py
+daemons = {}
+
+def start_daemons(accounts, max_workers=MAX_WORKERS, bodies='full', summarize=False):
+    # Keeps the accounts in sync until the process exits. Their syncs run as
+    # jobs, so they show up in /jobs and never overlap a requested sync.
+    params = {'workers': max_workers, 'bodies': bodies, 'summarize': summarize}
+    for account in accounts:
+        if account not in daemons:
+            daemons[account] = SyncDaemon(account, jobs, partial(authenticate_gmail, account),
+                                          account_folder(account), params).start()
+    print(f"[+] Background sync running for {', '.join(accounts)}")
+    if PUSH_TOPIC and not (PUSH_TOKEN or PUSH_AUDIENCE):
+        print("[!] GMAIL_PUSH_TOKEN or GMAIL_PUSH_AUDIENCE is not set, /gmail/push refuses notifications")
+    return [daemons[account] for account in accounts]
+
+def sync_accounts(accounts, max_results=None, showlog=False, max_workers=MAX_WORKERS, full=False, bodies='full',
+                  summarize=False, concurrency=MAX_CONCURRENT_SYNCS):
+    # CLI sync of several accounts side by side, log lines prefixed with the account
+    def run(account):
+        factory = partial(authenticate_gmail, account)
+        try:
+            for log_message in sync_emails(factory(), max_results, showlog, service_factory=factory,
+                                           max_workers=max_workers, full=full,
+                                           store=open_store(account_folder(account)), bodies=bodies,
+                                           summarize=summarize):
+                print(f"[{account}] {log_message.decode('utf-8')}")
+        except Exception as e:
+            print(f"[!] [{account}] Sync failed: {e}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, accounts))
 
 class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("utf-8"))
+        self.wfile.write(data)
+        self.wfile.write(b"\r\n")
+        self.wfile.flush()
+
+    def stream_log(self, job, since=0):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Job-Id', job.id)
+        self.end_headers()
+        try:
+            for line in job.follow(since):
+                # Blank keepalive lines keep idle connections open during long listings
+                self.write_chunk((line if line is not None else "\n").encode("utf-8"))
+            # Send the final chunk
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, the job keeps running
+            pass
+
     def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == '/gmail/push':
+            # Gmail push notifications, delivered by a Pub/Sub push subscription
+            if not verify_push(parse_qs(url.query).get('token', [None])[0], self.headers.get('Authorization')):
+                return self.send_json(403, {'error': 'Push notification not authenticated'})
+            content_length = int(self.headers.get('Content-Length', 0))
+            try:
+                notification = decode_push(json.loads(self.rfile.read(content_length) or b'{}'))
+            except ValueError:
+                notification = None
+            if notification is None:
+                return self.send_json(400, {'error': 'Not a Gmail notification'})
+            # Acknowledged either way, Pub/Sub would redeliver it otherwise
+            queued = route_notification(list(daemons.values()), notification)
+            return self.send_json(200, {'queued': queued})
         if self.path == '/download-emails':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            params = json.loads(post_data)
+            content_length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(content_length) or b'{}')
+            try:
+                accounts = resolve_accounts(params.get('accounts', params.get('account')))
+            except ValueError as e:
+                return self.send_json(400, {'error': str(e)})
 
-            max_results = params.get('max', None)
-            showlog = params.get('showdownloadlog', False)
+            if len(accounts) > 1:
+                # Several accounts sync side by side as separate jobs
+                started = []
+                for account in accounts:
+                    job, created = jobs.start(account, params)
+                    started.append({**job.to_dict(), 'created': created})
+                return self.send_json(202, started)
 
-            try:
-                service = authenticate_gmail()
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/plain; charset=utf-8')
-                self.send_header('Transfer-Encoding', 'chunked')
-                self.end_headers()
-
-                # Call the download_emails function and stream logs to the client
-                for chunk in download_emails(service, max_results, showlog):
-                    chunk_size = f"{len(chunk):X}\r\n".encode("utf-8")
-                    self.wfile.write(chunk_size)
-                    self.wfile.write(chunk)
-                    self.wfile.write(b"\r\n")
-                    self.wfile.flush()
-
-                # Send the final chunk
-                self.wfile.write(b"0\r\n\r\n")
-            except Exception as e:
-                error_message = f"Error: {str(e)}\n".encode("utf-8")
-                chunk_size = f"{len(error_message):X}\r\n".encode("utf-8")
-                self.wfile.write(chunk_size)
-                self.wfile.write(error_message)
-                self.wfile.write(b"\r\n")
-                self.wfile.write(b"0\r\n\r\n")
+            # Start a sync job, or attach to the one already running for this account
+            job, created = jobs.start(accounts[0], params)
+            if not created:
+                print(f"[+] Attached client to running sync job {job.id}")
+            if params.get('wait', True):
+                # Stream the job log to the client like a direct sync did
+                self.stream_log(job)
+            else:
+                self.send_json(202, {**job.to_dict(), 'created': created})
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = parse_qs(url.query)
+        if parts == ['jobs']:
+            self.send_json(200, jobs.list())
+        elif parts == ['accounts']:
+            self.send_json(200, account_status())
+        elif parts == ['daemon']:
+            self.send_json(200, [daemon.to_dict() for daemon in daemons.values()])
+        elif parts == ['metrics']:
+            # Gmail list/batch latency, messages fetched per second, retries,
+            # store writes and bytes written, across all sync jobs
+            self.send_json(200, metrics_snapshot())
+        elif len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = jobs.get(parts[1])
+            if job is None:
+                self.send_json(404, {'error': f"Unknown job {parts[1]}"})
+            elif len(parts) == 2:
+                self.send_json(200, job.to_dict())
+            elif parts[2] == 'logs':
+                since = int(query.get('since', ['0'])[0])
+                if query.get('follow', ['true'])[0].lower() == 'true':
+                    self.stream_log(job, since)
+                else:
+                    lines, position = job.lines(since)
+                    self.send_json(200, {'lines': lines, 'next': position, 'status': job.status})
+            else:
+                self.send_json(404, {'error': 'Not found'})
         else:
-            self.send_response(404)
-            self.end_headers()
+            self.send_json(404, {'error': 'Not found'})
+
+def account_status():
+    running = {job['mailbox']: job['id'] for job in jobs.list() if job['status'] in ('queued', 'running')}
+    status = []
+    for account in list_accounts():
+        store = open_store(account_folder(account))
+        status.append({'account': account, 'folder': store.folder, 'emails': store.count(),
+                       'sync_job': running.get(account),
+                       'daemon': daemons[account].status if account in daemons else None})
+        store.close()
+    return status
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--max', default='no limit', help='Max number of emails to download')
     parser.add_argument('--showdownloadlog', default='false', help='Show download log')
     parser.add_argument('--server', default=None, help='Start server at specified port')
+    parser.add_argument('--full', default='false', help='Re-download everything instead of applying history deltas')
+    parser.add_argument('--workers', default=MAX_WORKERS, type=int, help='Number of concurrent batch requests')
+    parser.add_argument('--bodies', default='full', choices=BODY_MODES,
+                        help='Download bodies during the sync (full) or only when a question needs them (lazy)')
+    parser.add_argument('--summarize', default='false',
+                        help='Summarize new and changed emails with a cheap Gemini model after the sync')
+    parser.add_argument('--account', default=DEFAULT_ACCOUNT,
+                        help="Account to sync: a name, comma-separated names or 'all' to sync several side by side")
+    parser.add_argument('--daemon', default='false',
+                        help='Keep the accounts in sync in the background (alongside --server if given)')
     args = parser.parse_args()
 
     max_results = None if args.max.lower() == 'no limit' or args.max.lower() == 'infinity' else int(args.max)
     showlog = args.showdownloadlog.lower() == 'true'
 
+    if args.daemon.lower() == 'true':
+        start_daemons(resolve_accounts(args.account), args.workers, args.bodies, args.summarize.lower() == 'true')
+        if not args.server:
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                for daemon in daemons.values():
+                    daemon.stop(timeout=5)
+            return
+
     if args.server:
         port = int(args.server)
-        server = HTTPServer(('0.0.0.0', port), RequestHandler)
+        server = ThreadingHTTPServer(('0.0.0.0', port), RequestHandler)
         print(f"Starting server on port {port}...")
         server.serve_forever()
     else:
-        service = authenticate_gmail()
+        accounts = resolve_accounts(args.account)
+        full = args.full.lower() == 'true'
+        summarize = args.summarize.lower() == 'true'
+        if len(accounts) > 1:
+            print(f"[+] Syncing {len(accounts)} accounts, {MAX_CONCURRENT_SYNCS} at a time: {', '.join(accounts)}")
+            sync_accounts(accounts, max_results, showlog, args.workers, full, args.bodies, summarize)
+            return
+        account = accounts[0]
+        factory = partial(authenticate_gmail, account)
+        service = factory()
         list_labels(service)
-        for log_message in download_emails(service, max_results, showlog):
-            print(log_message.decode("utf-8"))
+        try:
+            for log_message in sync_emails(service, max_results, showlog, service_factory=factory,
+                                           max_workers=args.workers, full=full,
+                                           store=open_store(account_folder(account)), bodies=args.bodies,
+                                           summarize=summarize):
+                print(log_message.decode("utf-8"))
+        except Exception as e:
+            print(f"[!] Sync failed: {e}")
 
 if __name__ == '__main__':
     main()
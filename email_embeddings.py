@@ -0,0 +1,205 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+import threading
+import numpy as np
+import google.generativeai as genai
+from rate_limiter import RateLimitExceeded, is_rate_limit_error
+from gemini_models import scheduler
+
+# Semantic retrieval: every email is embedded once and the vectors are cached
+# on disk (temp/vectors.npy, memory-mapped on load) keyed by message id and
+# a hash of the embedded text, so only new or changed emails are embedded.
+
+EMBEDDING_MODEL = 'embedding-001'
+VECTORS_FILE = 'vectors.npy'
+VECTORS_META_FILE = 'vectors.meta'
+# embed_content accepts up to 100 texts per request
+EMBED_BATCH = 100
+MAX_EMBED_CHARS = 8000
+# Longest an embedding call waits for its rate limit; once the daily quota
+# is used up the wait is hours and RateLimitExceeded is raised instead
+EMBED_MAX_WAIT = 120
+
+def embedding_text(email):
+    body = email.get('body') or email.get('snippet') or ''
+    return f"Subject: {email.get('subject', '')}\nFrom: {email.get('from', '')}\n\n{body}"[:MAX_EMBED_CHARS]
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class GeminiEmbedder:
+    def __init__(self, model_id=EMBEDDING_MODEL, max_wait=EMBED_MAX_WAIT):
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        self.model_id = model_id[len('models/'):] if model_id.startswith('models/') else model_id
+        self.model = f"models/{self.model_id}"
+        self.name = self.model
+        # Paced by the process-wide scheduler, so the per-minute and daily
+        # limits from gemini_models.py hold across index reopens
+        self.max_wait = max_wait
+
+    def embed(self, texts, task_type='retrieval_document'):
+        vectors = []
+        for start in range(0, len(texts), EMBED_BATCH):
+            scheduler.acquire(self.model_id, max_wait=self.max_wait)
+            try:
+                res = genai.embed_content(model=self.model, content=texts[start:start + EMBED_BATCH],
+                                          task_type=task_type)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    scheduler.penalize(self.model_id)
+                raise
+            vectors.extend(res['embedding'])
+        return np.asarray(vectors, dtype=np.float32)
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared_embedder(model_id=EMBEDDING_MODEL):
+    # One Gemini embedder per model and process
+    with _shared_lock:
+        if model_id not in _shared:
+            _shared[model_id] = GeminiEmbedder(model_id)
+        return _shared[model_id]
+
+class HashingEmbedder:
+    # Deterministic local stand-in for the Gemini embedder (feature hashing
+    # of word unigrams and bigrams), for tests and offline benchmarks
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts, task_type='retrieval_document'):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for token in words + [a + ' ' + b for a, b in zip(words, words[1:])]:
+                h = zlib.crc32(token.encode('utf-8'))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return vectors
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class SemanticIndex:
+    def __init__(self, folder='temp', embedder=None):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.embedder = embedder or shared_embedder()
+        self.ids = []
+        self.hashes = []
+        self.matrix = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        meta_path = os.path.join(self.folder, VECTORS_META_FILE)
+        vectors_path = os.path.join(self.folder, VECTORS_FILE)
+        if not os.path.exists(meta_path) or not os.path.exists(vectors_path):
+            return
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            matrix = np.load(vectors_path, mmap_mode='r')
+            if meta.get('model') != self.embedder.name:
+                raise ValueError(f"vectors were made by {meta.get('model')}")
+            if matrix.shape[0] != len(meta['ids']):
+                raise ValueError("vector cache is out of step with its metadata")
+            self.ids, self.hashes, self.matrix = meta['ids'], meta['hashes'], matrix
+        except Exception as e:
+            print(f"[!] Ignoring vector cache: {e}")
+
+    def _save(self):
+        vectors_path = os.path.join(self.folder, VECTORS_FILE)
+        meta_path = os.path.join(self.folder, VECTORS_META_FILE)
+        # np.save appends .npy to names without it, so write to a .npy temp file
+        tmp_path = os.path.join(self.folder, 'vectors.tmp.npy')
+        np.save(tmp_path, np.ascontiguousarray(self.matrix, dtype=np.float32))
+        os.replace(tmp_path, vectors_path)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'model': self.embedder.name, 'ids': self.ids, 'hashes': self.hashes}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        self.matrix = np.load(vectors_path, mmap_mode='r')
+
+    def update(self, emails):
+        # Embeds emails that are new or whose text changed and drops vectors
+        # of emails that no longer exist. Returns the number embedded. When
+        # embedding stops part way (out of quota, network), the batches
+        # already embedded are saved anyway and the next update carries on
+        # from there.
+        with self._lock:
+            cached = {msg_id: (row, h) for row, (msg_id, h) in enumerate(zip(self.ids, self.hashes))}
+            texts = {email['id']: embedding_text(email) for email in emails}
+            hashes = {msg_id: content_hash(text) for msg_id, text in texts.items()}
+            stale = [msg_id for msg_id, h in hashes.items() if cached.get(msg_id, (None, None))[1] != h]
+            if not stale and len(cached) == len(hashes):
+                return 0
+
+            if stale:
+                print(f"[+] Embedding {len(stale)} emails...")
+            embedded = {}
+            try:
+                for start in range(0, len(stale), EMBED_BATCH):
+                    batch = stale[start:start + EMBED_BATCH]
+                    vectors = normalize(self.embedder.embed([texts[msg_id] for msg_id in batch]))
+                    embedded.update(zip(batch, vectors))
+            finally:
+                if embedded or set(cached) != set(hashes):
+                    self._merge(cached, hashes, embedded)
+            return len(embedded)
+
+    def _merge(self, cached, hashes, embedded):
+        # New vectors where there are some, otherwise the cached ones (an
+        # email whose text changed keeps its old vector and hash until it
+        # is embedded again). Emails with neither are left out for now.
+        ids = [msg_id for msg_id in hashes if msg_id in embedded or msg_id in cached]
+        if embedded:
+            dim = len(next(iter(embedded.values())))
+        else:
+            dim = self.matrix.shape[1] if self.matrix is not None else 0
+        matrix = np.empty((len(ids), dim), dtype=np.float32)
+        kept = [(row, cached[msg_id][0]) for row, msg_id in enumerate(ids) if msg_id not in embedded]
+        if kept:
+            rows, sources = zip(*kept)
+            matrix[list(rows)] = self.matrix[list(sources)]
+        new_rows = [(row, msg_id) for row, msg_id in enumerate(ids) if msg_id in embedded]
+        if new_rows:
+            rows, new_ids = zip(*new_rows)
+            matrix[list(rows)] = np.stack([embedded[msg_id] for msg_id in new_ids])
+
+        self.ids = ids
+        self.hashes = [hashes[msg_id] if msg_id in embedded else cached[msg_id][1] for msg_id in ids]
+        self.matrix = matrix
+        self._save()
+
+    def search(self, query, k=20):
+        if self.matrix is None or not self.ids:
+            return []
+        try:
+            query_vector = normalize(self.embedder.embed([query], task_type='retrieval_query'))[0]
+        except RateLimitExceeded as e:
+            # Out of embedding quota, the full-text ranking answers alone
+            print(f"[!] Semantic search skipped: {e}")
+            return []
+        scores = self.matrix @ query_vector
+        k = min(k, len(self.ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+def semantic_enabled():
+    return os.getenv("EMAIL_SEMANTIC", "false").lower() == "true"
+
+def open_semantic_index(emails, folder='temp', embedder=None):
+    index = SemanticIndex(folder, embedder or shared_embedder())
+    try:
+        index.update(emails)
+    except RateLimitExceeded as e:
+        # Searches the emails embedded so far, the rest are embedded on a
+        # later refresh
+        print(f"[!] Semantic index not updated: {e}")
+    return index
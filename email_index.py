@@ -0,0 +1,180 @@
+import os
+import re
+import sqlite3
+import threading
+from email.utils import parsedate_to_datetime
+
+# Full-text index over downloaded emails (SQLite FTS5, ranked with BM25), so
+# only the emails relevant to a question are put in the prompt.
+
+INDEX_FILE = 'index.db'
+DEFAULT_TOP_K = 20
+
+# BM25 column weights: subject, from, to, date, body
+WEIGHTS = (4.0, 2.0, 1.0, 0.5, 1.0)
+
+# The FTS table is contentless: the text lives in the store only. Rows of a
+# contentless table can't be deleted without their original text, so deleted
+# and replaced emails leave stale entries behind (hidden by the join with
+# docs) until open_index rebuilds the index once they outnumber STALE_RATIO
+# of the live ones.
+STALE_RATIO = 0.25
+STALE_MIN = 1000
+
+STOPWORDS = set('''
+a about all am an and any are as at be been but by can did do does email emails for from get got had has
+have how i if in is it its me my of on or our show so tell than that the their them then there these they
+this to was we were what when where which who why will with would you your
+'''.split())
+
+def match_query(query):
+    # Turn a free-form question into an FTS5 OR query of quoted terms so
+    # punctuation and FTS operators in user input can't break the syntax
+    terms = [t for t in re.findall(r"\w+", query.lower()) if t not in STOPWORDS]
+    return " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+
+def email_sort_key(email):
+    try:
+        return parsedate_to_datetime(email.get('date', '')).timestamp()
+    except Exception:
+        return 0
+
+class EmailIndex:
+    def __init__(self, folder='temp'):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, INDEX_FILE)
+        self._local = threading.local()
+        conn = self._conn()
+        # Indexes written before the table was contentless hold a copy of
+        # every body; drop them, open_index rebuilds from the store
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'fts'").fetchone()
+        if row and "content=''" not in row[0]:
+            conn.executescript("DROP TABLE fts; DROP TABLE docs;")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (rowid INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(
+                subject, sender, recipient, date, body, content='', tokenize='porter unicode61'
+            );
+        """)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _delete(self, conn, msg_ids):
+        # Unlinks the emails; their terms stay in fts until the next rebuild
+        stale = 0
+        for msg_id in msg_ids:
+            stale += conn.execute("DELETE FROM docs WHERE id = ?", (msg_id,)).rowcount
+        if stale:
+            conn.execute("INSERT INTO meta VALUES ('stale', ?) "
+                         "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value", (stale,))
+
+    def add_many(self, emails):
+        conn = self._conn()
+        with conn:
+            self._delete(conn, [email['id'] for email in emails])
+            for email in emails:
+                rowid = conn.execute("INSERT INTO docs (id) VALUES (?)", (email['id'],)).lastrowid
+                conn.execute(
+                    "INSERT INTO fts (rowid, subject, sender, recipient, date, body) VALUES (?, ?, ?, ?, ?, ?)",
+                    (rowid, email.get('subject'), email.get('from'), email.get('to'), email.get('date'),
+                     email.get('body') or email.get('snippet'))
+                )
+
+    def remove(self, msg_ids):
+        conn = self._conn()
+        with conn:
+            self._delete(conn, msg_ids)
+
+    def search(self, query, k=DEFAULT_TOP_K):
+        expr = match_query(query)
+        if not expr:
+            return []
+        rows = self._conn().execute(
+            f"SELECT docs.id, bm25(fts, {', '.join(map(str, WEIGHTS))}) AS score "
+            "FROM fts JOIN docs ON docs.rowid = fts.rowid "
+            "WHERE fts MATCH ? ORDER BY score LIMIT ?",
+            (expr, k)
+        ).fetchall()
+        # bm25() is lower-is-better, flip it so callers see higher-is-better
+        return [(msg_id, -score) for msg_id, score in rows]
+
+    def ids(self):
+        return [row[0] for row in self._conn().execute("SELECT id FROM docs")]
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def stale(self):
+        # Entries of deleted or replaced emails still in fts
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'stale'").fetchone()
+        return row[0] if row else 0
+
+    def size(self):
+        # Bytes on disk, write-ahead log included
+        return sum(os.path.getsize(self.path + suffix) for suffix in ('', '-wal') if os.path.exists(self.path + suffix))
+
+    def rebuild(self, emails, batch_size=1000):
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO fts (fts) VALUES ('delete-all')")
+            conn.execute("DELETE FROM docs")
+            conn.execute("DELETE FROM meta WHERE key = 'stale'")
+        batch = []
+        for email in emails:
+            batch.append(email)
+            if len(batch) >= batch_size:
+                self.add_many(batch)
+                batch = []
+        if batch:
+            self.add_many(batch)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+def open_index(folder='temp', emails=None):
+    index = EmailIndex(folder)
+    # Stores migrated from JSON or written before indexing existed need a
+    # rebuild, and so does an index with too many stale entries
+    if emails is not None and (index.count() != len(emails)
+                               or index.stale() > max(STALE_MIN, STALE_RATIO * len(emails))):
+        print("[+] Rebuilding search index...")
+        index.rebuild(emails)
+    return index
+
+def fuse_rankings(rankings, k, rrf_k=60):
+    # Reciprocal rank fusion of several ranked id lists
+    scores = {}
+    for ranking in rankings:
+        for rank, msg_id in enumerate(ranking):
+            scores[msg_id] = scores.get(msg_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+def select_emails(query, emails, k=DEFAULT_TOP_K, index=None, semantic=None, by_id=None, newest_first=False):
+    # Top-k emails for the query, from the full-text index, the semantic index
+    # or both fused. Questions with no matching terms (e.g. "summarize my
+    # inbox") fall back to the most recent emails. Callers holding the
+    # mailbox in memory can pass a prebuilt id map and a date-sorted list.
+    if len(emails) <= k:
+        return emails
+    by_id = by_id if by_id is not None else {email['id']: email for email in emails}
+    rankings = []
+    if index is not None:
+        rankings.append([msg_id for msg_id, _ in index.search(query, k)])
+    if semantic is not None:
+        rankings.append([msg_id for msg_id, _ in semantic.search(query, k)])
+    hits = [by_id[msg_id] for msg_id in fuse_rankings(rankings, k) if msg_id in by_id]
+    if not hits:
+        hits = emails[:k] if newest_first else sorted(emails, key=email_sort_key, reverse=True)[:k]
+    return hits
@@ -1,20 +1,133 @@
 import os
+import sys
 import json
+import time
+import argparse
+import threading
+from email_store import open_store, HEADER_FIELDS, SCAN_WORKERS
+from email_index import email_sort_key
+from metrics import span, record_latency
 
-def load_emails_from_temp(folder="temp"):
-    emails = []
+def iter_emails(folder="temp", fields=None, since=None, until=None, sender=None, workers=SCAN_WORKERS,
+                processes=False):
+    # Streams emails without materializing the mailbox. fields limits the
+    # keys loaded (e.g. HEADER_FIELDS to skip bodies), since/until (dates
+    # or ISO strings) and sender (substring of From) filter them. Chunks are
+    # read by `workers` threads, or processes if processes is True.
     if not os.path.exists(folder):
         print("[!] Temp folder not found.")
-        return emails
-
-    for file in os.listdir(folder):
-        if file.endswith(".json"):
-            path = os.path.join(folder, file)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    emails.append(data)
-            except Exception as e:
-                print(f"[!] Error reading {file}: {e}")
+        return
+    store = open_store(folder)
+    try:
+        yield from store.scan(fields, since, until, sender, workers, processes=processes)
+    finally:
+        store.close()
+
+def load_emails_from_temp(folder="temp", **filters):
+    with span('load_emails'):
+        emails = list(iter_emails(folder, **filters))
     print(f"[+] Loaded {len(emails)} emails from '{folder}'")
     return emails
+
+class MailboxCache:
+    # Keeps the mailbox in memory for long-running processes and only reads
+    # what changed since the last refresh. Changes are detected from the
+    # store's file signature, checked at most every check_interval seconds.
+    # emails() is sorted newest first.
+    def __init__(self, folder="temp", check_interval=1.0):
+        self.folder = folder
+        self.check_interval = check_interval
+        self.generation = 0
+        self._emails = {}
+        self._snapshot = []
+        self._store = None
+        self._store_version = None
+        self._folder_id = None
+        self._token = 0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        if self._store is not None:
+            self._store.close()
+        self._emails = {}
+        self._snapshot = []
+        self._store = None
+        self._store_version = None
+        self._folder_id = None
+        self._token = 0
+        self.generation += 1
+
+    def refresh(self):
+        if not os.path.exists(self.folder):
+            if self._store is not None or self._emails:
+                self._reset()
+            return
+        # A deleted and recreated folder (e.g. after /cleanup) starts from scratch
+        st = os.stat(self.folder)
+        if self._folder_id not in (None, (st.st_dev, st.st_ino)):
+            self._reset()
+        if self._store is None:
+            self._store = open_store(self.folder)
+            self._folder_id = (st.st_dev, st.st_ino)
+        version = self._store.version()
+        if version == self._store_version:
+            return
+
+        start = time.perf_counter()
+        changed, self._token = self._store.changes_since(self._token)
+        # Mutate a copy, readers may still hold the previous map
+        self._emails = dict(self._emails)
+        for email in changed:
+            self._emails[email['id']] = email
+        ids = set(self._store.ids())
+        removed = [msg_id for msg_id in self._emails if msg_id not in ids]
+        for msg_id in removed:
+            del self._emails[msg_id]
+
+        self._store_version = version
+        if changed or removed or self.generation == 0:
+            self._snapshot = sorted(self._emails.values(), key=email_sort_key, reverse=True)
+            self.generation += 1
+            record_latency('mailbox_refresh', time.perf_counter() - start, changed=len(changed))
+            print(f"[+] Mailbox cache: {len(changed)} updated, {len(removed)} removed, {len(self._snapshot)} total")
+
+    def emails(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked >= self.check_interval:
+                self._checked = now
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[!] Error refreshing mailbox cache: {e}")
+                    self._reset()
+            return self._snapshot
+
+    def by_id(self):
+        return self._emails
+
+def main():
+    # Streams matching emails as JSON lines, e.g. for piping into jq
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', default='temp', help='Email storage folder')
+    parser.add_argument('--fields', default=None, help="Comma separated fields, or 'headers' to skip bodies")
+    parser.add_argument('--since', default=None, help='Only emails on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', default=None, help='Only emails before this date (YYYY-MM-DD)')
+    parser.add_argument('--sender', default=None, help='Only emails whose From contains this text')
+    parser.add_argument('--workers', default=SCAN_WORKERS, type=int, help='Parallel readers')
+    parser.add_argument('--processes', default='false', help='Parse in worker processes instead of threads')
+    parser.add_argument('--count', default='false', help='Only print the number of matching emails')
+    args = parser.parse_args()
+
+    fields = HEADER_FIELDS if args.fields == 'headers' else args.fields.split(',') if args.fields else None
+    emails = iter_emails(args.folder, fields, args.since, args.until, args.sender, args.workers,
+                         processes=args.processes.lower() == 'true')
+    if args.count.lower() == 'true':
+        print(f"[+] {sum(1 for _ in emails)} matching emails")
+        return
+    for email in emails:
+        sys.stdout.write(json.dumps(email) + "\n")
+
+if __name__ == '__main__':
+    main()
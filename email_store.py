@@ -0,0 +1,612 @@
+import os
+import time
+import json
+import zlib
+import sqlite3
+import argparse
+import threading
+from datetime import datetime, date
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from email_index import email_sort_key
+from metrics import record_latency, count
+
+# Storage backends for downloaded emails. Both expose the same methods so
+# the downloader and the loaders don't care which one is in use:
+#   put_many(emails), upsert(email), get(id), delete(ids), ids(),
+#   iter_emails(), count(), get_meta(key), set_meta(key, value), close()
+# plus version() and changes_since(token) for readers that keep emails in
+# memory and want to pick up only what changed, scan(...) for streaming
+# large mailboxes with field projection and date/sender filters, and
+# ids_without(field) / set_field(field, values) for stages that fill in one
+# extra field (like summaries) without rewriting whole emails.
+
+DB_FILE = 'emails.db'
+COLUMNS = ['id', 'subject', 'from', 'to', 'date', 'snippet', 'body', 'labels']
+# Email field -> sqlite column
+FIELD_COLUMNS = {'id': 'id', 'subject': 'subject', 'from': 'sender', 'to': 'recipient', 'date': 'date',
+                 'snippet': 'snippet', 'body': 'body', 'labels': 'labels'}
+COLUMN_FIELDS = {c: f for f, c in FIELD_COLUMNS.items()}
+# Projection for callers that don't need bodies
+HEADER_FIELDS = ['id', 'subject', 'from', 'to', 'date', 'snippet', 'labels']
+
+# scan() reads the mailbox in chunks of SCAN_CHUNK emails, SCAN_WORKERS
+# chunks at a time, so memory stays bounded by the chunks in flight.
+# Threads overlap disk reads; parsing is CPU bound, so on multi-core
+# machines processes=True parses in worker processes instead.
+SCAN_CHUNK = 1000
+SCAN_WORKERS = min(4, os.cpu_count() or 1)
+
+# Bodies are stored zlib-compressed (as BLOBs in the body column) and only
+# decompressed when the body column is read, so header-only scans never pay
+# for it. Rows written before compression keep their text bodies and stay
+# readable; 'compact' rewrites them. Set EMAIL_BODY_COMPRESSION=none to store
+# new bodies as text.
+BODY_COMPRESSION = os.getenv('EMAIL_BODY_COMPRESSION', 'zlib')
+# Shorter bodies don't shrink enough to be worth it
+BODY_COMPRESS_MIN = 256
+BODY_COMPRESS_LEVEL = 6
+
+def pack_body(body):
+    if BODY_COMPRESSION != 'zlib' or not isinstance(body, str) or len(body) < BODY_COMPRESS_MIN:
+        return body
+    raw = body.encode('utf-8')
+    packed = zlib.compress(raw, BODY_COMPRESS_LEVEL)
+    return packed if len(packed) < len(raw) else body
+
+def unpack_body(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+def timed_read(read, chunk):
+    # Returns read(chunk) and the seconds it took, measured where it ran
+    # (a worker process can't record metrics for the parent)
+    start = time.perf_counter()
+    return read(chunk), time.perf_counter() - start
+
+def parallel_chunks(chunks, read, workers=SCAN_WORKERS, processes=False):
+    # Yields read(chunk) for every chunk in order, keeping at most
+    # workers * 2 chunks in flight
+    def done(result):
+        emails, seconds = result
+        record_latency('store_scan_chunk', seconds)
+        count('store_emails_read', len(emails))
+        return emails
+
+    read = partial(timed_read, read)
+    if workers <= 1:
+        for chunk in chunks:
+            yield done(read(chunk))
+        return
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(read, chunk))
+            if len(pending) >= workers * 2:
+                yield done(pending.popleft().result())
+        while pending:
+            yield done(pending.popleft().result())
+
+def to_timestamp(value):
+    # Filter bounds: epoch seconds, date/datetime or an ISO 'YYYY-MM-DD[THH:MM]' string
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return value.timestamp()
+
+def matches(email, since=None, until=None, sender=None):
+    if sender and sender.lower() not in (email.get('from') or '').lower():
+        return False
+    if since is not None or until is not None:
+        ts = email_sort_key(email)
+        if (since is not None and ts < since) or (until is not None and ts >= until):
+            return False
+    return True
+
+def project(email, fields):
+    return email if fields is None else {k: email[k] for k in fields if k in email}
+
+def read_sqlite_rows(path, sql, params, columns, fields, bounds):
+    # One scan chunk: a rowid range, on its own connection so it can run
+    # in any thread or process
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        rows = conn.execute(sql, list(bounds) + params).fetchall()
+    finally:
+        conn.close()
+    if fields is None:
+        return [SqliteStore._from_row(row) for row in rows]
+    names = [COLUMN_FIELDS.get(column, column) for column in columns]
+    emails = []
+    for row in rows:
+        email = dict(zip(names, row))
+        if 'body' in email:
+            email['body'] = unpack_body(email['body'])
+        if 'labels' in email:
+            email['labels'] = json.loads(email['labels'] or '[]')
+        extra = email.pop('extra', None)
+        if extra:
+            email.update({k: v for k, v in json.loads(extra).items() if k in fields})
+        emails.append(email)
+    return emails
+
+def read_json_files(folder, since, until, sender, fields, names):
+    # One scan chunk of the JSON folder layout
+    emails = []
+    for name in names:
+        try:
+            with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                email = json.load(f)
+        except Exception as e:
+            print(f"[!] Error reading {name}: {e}")
+            continue
+        if matches(email, since, until, sender):
+            emails.append(project(email, fields))
+    return emails
+
+class SqliteStore:
+    def __init__(self, folder='temp'):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.path = os.path.join(folder, DB_FILE)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS emails (
+                id TEXT PRIMARY KEY,
+                subject TEXT,
+                sender TEXT,
+                recipient TEXT,
+                date TEXT,
+                snippet TEXT,
+                body TEXT,
+                labels TEXT,
+                extra TEXT,
+                seq INTEGER DEFAULT 0,
+                ts REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        # Databases created before change tracking lack the write sequence column,
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(emails)")]
+        if 'seq' not in columns:
+            conn.execute("ALTER TABLE emails ADD COLUMN seq INTEGER DEFAULT 0")
+        # and the parsed date used by scan() filters
+        if 'ts' not in columns:
+            conn.execute("ALTER TABLE emails ADD COLUMN ts REAL")
+            conn.executemany("UPDATE emails SET ts = ? WHERE id = ?",
+                             [(email_sort_key({'date': row[1]}), row[0])
+                              for row in conn.execute("SELECT id, date FROM emails").fetchall()])
+        conn.execute("CREATE INDEX IF NOT EXISTS emails_seq ON emails (seq)")
+        conn.execute("CREATE INDEX IF NOT EXISTS emails_ts ON emails (ts)")
+        conn.commit()
+
+    def _conn(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_row(email):
+        extra = {k: v for k, v in email.items() if k not in COLUMNS}
+        return (
+            email['id'], email.get('subject'), email.get('from'), email.get('to'), email.get('date'),
+            email.get('snippet'), pack_body(email.get('body')), json.dumps(email.get('labels', [])),
+            json.dumps(extra, separators=(',', ':')) if extra else None,
+        )
+
+    @staticmethod
+    def _from_row(row):
+        email = {
+            'id': row[0], 'subject': row[1], 'from': row[2], 'to': row[3], 'date': row[4],
+            'snippet': row[5], 'body': unpack_body(row[6]), 'labels': json.loads(row[7] or '[]'),
+        }
+        if row[8]:
+            email.update(json.loads(row[8]))
+        return email
+
+    @staticmethod
+    def _next_seq(conn):
+        # Each write gets a new sequence number so readers can fetch only
+        # newer rows. Kept in meta rather than derived from the rows, so it
+        # never goes back when the newest rows are deleted (readers holding
+        # that token would miss the next writes). Call within a write
+        # transaction.
+        row = conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+        # Databases from before the counter start after their newest row
+        seq = max(json.loads(row[0]) if row else 0,
+                  conn.execute("SELECT COALESCE(MAX(seq), 0) FROM emails").fetchone()[0]) + 1
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('seq', ?)", (json.dumps(seq),))
+        return seq
+
+    def put_many(self, emails):
+        start = time.perf_counter()
+        rows = [self._to_row(email) for email in emails]
+        conn = self._conn()
+        with conn:
+            # Taken before reading the counter, so concurrent writers can't share a seq
+            conn.execute("BEGIN IMMEDIATE")
+            seq = self._next_seq(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO emails (id, subject, sender, recipient, date, snippet, body, labels, extra, seq, ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [row + (seq, email_sort_key(email)) for row, email in zip(rows, emails)]
+            )
+        record_latency('store_write', time.perf_counter() - start, emails=len(rows))
+        count('store_emails_written', len(rows))
+        # Size of the stored values (characters for text, bytes for compressed bodies)
+        count('store_bytes_written', sum(len(value) for row in rows for value in row if value))
+
+    def upsert(self, email):
+        self.put_many([email])
+
+    def get(self, msg_id):
+        row = self._conn().execute(
+            "SELECT id, subject, sender, recipient, date, snippet, body, labels, extra FROM emails WHERE id = ?",
+            (msg_id,)
+        ).fetchone()
+        return self._from_row(row) if row else None
+
+    def delete(self, msg_ids):
+        conn = self._conn()
+        with conn:
+            conn.executemany("DELETE FROM emails WHERE id = ?", [(msg_id,) for msg_id in msg_ids])
+
+    def ids(self):
+        return [row[0] for row in self._conn().execute("SELECT id FROM emails")]
+
+    def ids_without(self, field):
+        # Ids of the emails that don't have an extra field set, without
+        # reading (or decompressing) anything else
+        return [row[0] for row in self._conn().execute(
+            "SELECT id FROM emails WHERE extra IS NULL OR json_extract(extra, ?) IS NULL", (f'$.{field}',))]
+
+    def set_field(self, field, values):
+        # Sets an extra field of existing emails ({id: value}) in place, so
+        # labels or bodies written meanwhile by a sync aren't overwritten.
+        # Deleted emails are skipped. Returns the number of emails updated.
+        start = time.perf_counter()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            seq = self._next_seq(conn)
+            updated = conn.executemany(
+                "UPDATE emails SET extra = json_set(COALESCE(extra, '{}'), ?, json(?)), seq = ? WHERE id = ?",
+                [(f'$.{field}', json.dumps(value), seq, msg_id) for msg_id, value in values.items()]
+            ).rowcount
+        record_latency('store_write', time.perf_counter() - start, emails=updated)
+        count('store_emails_written', updated)
+        return updated
+
+    def iter_emails(self):
+        cursor = self._conn().execute(
+            "SELECT id, subject, sender, recipient, date, snippet, body, labels, extra FROM emails"
+        )
+        for row in cursor:
+            yield self._from_row(row)
+
+    def scan(self, fields=None, since=None, until=None, sender=None, workers=SCAN_WORKERS, chunk_size=SCAN_CHUNK,
+             processes=False):
+        # Streams emails matching the filters, reading rowid ranges in
+        # parallel. Only the columns needed for fields are read, and filters
+        # run in SQL.
+        if fields is None:
+            columns = ['id', 'subject', 'sender', 'recipient', 'date', 'snippet', 'body', 'labels', 'extra']
+        else:
+            fields = set(fields) | {'id'}
+            columns = [c for f, c in FIELD_COLUMNS.items() if f in fields]
+            if fields - set(FIELD_COLUMNS):
+                columns.append('extra')
+        where, params = [], []
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(to_timestamp(since))
+        if until is not None:
+            where.append("ts < ?")
+            params.append(to_timestamp(until))
+        if sender:
+            where.append("sender LIKE ?")
+            params.append(f"%{sender}%")
+        sql = (f"SELECT {', '.join(columns)} FROM emails WHERE rowid BETWEEN ? AND ?"
+               + "".join(f" AND {clause}" for clause in where))
+
+        read = partial(read_sqlite_rows, self.path, sql, params, columns, fields)
+        low, high = self._conn().execute("SELECT MIN(rowid), MAX(rowid) FROM emails").fetchone()
+        if low is None:
+            return
+        chunks = ((start, start + chunk_size - 1) for start in range(low, high + 1, chunk_size))
+        for emails in parallel_chunks(chunks, read, workers, processes):
+            yield from emails
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def version(self):
+        # Changes whenever the database or its write-ahead log is written
+        signature = []
+        for suffix in ('', '-wal'):
+            try:
+                st = os.stat(self.path + suffix)
+                signature.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def changes_since(self, token=0):
+        # Emails written after token, and the token to pass next time
+        rows = self._conn().execute(
+            "SELECT id, subject, sender, recipient, date, snippet, body, labels, extra, seq FROM emails WHERE seq > ?",
+            (token or 0,)
+        ).fetchall()
+        new_token = max([row[9] for row in rows], default=token or 0)
+        return [self._from_row(row) for row in rows], new_token
+
+    def compact(self, batch_size=1000):
+        # Compresses bodies stored as text and reclaims the freed pages.
+        # Rows keep their write sequence: the emails themselves don't change.
+        # Returns (bodies compressed, bytes before, bytes after).
+        before = self.size()
+        conn = self._conn()
+        packed = 0
+        last = 0
+        while True:
+            rows = conn.execute(
+                "SELECT rowid, body FROM emails WHERE rowid > ? AND typeof(body) = 'text' AND length(body) >= ? "
+                "ORDER BY rowid LIMIT ?", (last, BODY_COMPRESS_MIN, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            updates = [(body, rowid) for rowid, body in ((rowid, pack_body(body)) for rowid, body in rows)
+                       if isinstance(body, bytes)]
+            with conn:
+                conn.executemany("UPDATE emails SET body = ? WHERE rowid = ?", updates)
+            packed += len(updates)
+        # VACUUM goes through the write-ahead log in WAL mode, truncate it after
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return packed, before, self.size()
+
+    def size(self):
+        # Bytes on disk, write-ahead log included
+        return sum(os.path.getsize(self.path + suffix) for suffix in ('', '-wal') if os.path.exists(self.path + suffix))
+
+    def get_meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+class JsonFolderStore:
+    # The original layout: one pretty-printed JSON file per email
+    META_FILE = '.store_meta'
+
+    def __init__(self, folder='temp'):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self._files = None
+        self._files_version = None
+        self._lock = threading.Lock()
+
+    def _index(self):
+        # Older downloads are named email_N.json, so map ids to files by
+        # reading them, again only if another writer changed the folder
+        if self._files is None or self._files_version != self.version():
+            files = {}
+            for name, email in self._iter_files():
+                # Files without an id aren't emails the store can serve
+                if email.get('id') is not None:
+                    files[email['id']] = name
+            self._files = files
+            self._files_version = self.version()
+        return self._files
+
+    def _iter_files(self):
+        for name in os.listdir(self.folder):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.folder, name), 'r', encoding='utf-8') as f:
+                        yield name, json.load(f)
+                except Exception as e:
+                    print(f"[!] Error reading {name}: {e}")
+
+    def put_many(self, emails):
+        start = time.perf_counter()
+        written = 0
+        with self._lock:
+            files = self._index()
+            for email in emails:
+                name = files.get(email['id'], f"email_{email['id']}.json")
+                # Write and rename so the folder mtime changes on every update
+                path = os.path.join(self.folder, name)
+                data = json.dumps(email, indent=2)
+                with open(path + '.tmp', 'w') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                files[email['id']] = name
+                written += len(data)
+            self._files_version = self.version()
+        record_latency('store_write', time.perf_counter() - start, emails=len(emails))
+        count('store_emails_written', len(emails))
+        count('store_bytes_written', written)
+
+    def upsert(self, email):
+        self.put_many([email])
+
+    def get(self, msg_id):
+        name = self._index().get(msg_id)
+        if not name:
+            return None
+        with open(os.path.join(self.folder, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def delete(self, msg_ids):
+        with self._lock:
+            files = self._index()
+            for msg_id in msg_ids:
+                name = files.pop(msg_id, None)
+                if name and os.path.exists(os.path.join(self.folder, name)):
+                    os.remove(os.path.join(self.folder, name))
+            self._files_version = self.version()
+
+    def ids(self):
+        return list(self._index())
+
+    def ids_without(self, field):
+        return [email['id'] for email in self.scan(fields=[field]) if email.get(field) is None]
+
+    def set_field(self, field, values):
+        # Files are rewritten whole, read just before
+        updated = []
+        for msg_id, value in values.items():
+            email = self.get(msg_id)
+            if email is not None:
+                email[field] = value
+                updated.append(email)
+        self.put_many(updated)
+        return len(updated)
+
+    def iter_emails(self):
+        for _, email in self._iter_files():
+            yield email
+
+    def scan(self, fields=None, since=None, until=None, sender=None, workers=SCAN_WORKERS, chunk_size=SCAN_CHUNK,
+             processes=False):
+        # Streams emails matching the filters, parsing files in parallel
+        if fields is not None:
+            fields = set(fields) | {'id'}
+        read = partial(read_json_files, self.folder, to_timestamp(since), to_timestamp(until), sender, fields)
+        names = sorted(name for name in os.listdir(self.folder) if name.endswith('.json'))
+        chunks = (names[i:i + chunk_size] for i in range(0, len(names), chunk_size))
+        for emails in parallel_chunks(chunks, read, workers, processes):
+            yield from emails
+
+    def count(self):
+        return len(self._index())
+
+    def version(self):
+        st = os.stat(self.folder)
+        return (st.st_mtime_ns, st.st_nlink)
+
+    def changes_since(self, token=0):
+        # Token is the newest file mtime seen so far
+        changed = []
+        new_token = token or 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.json'):
+                mtime = entry.stat().st_mtime_ns
+                if mtime > (token or 0):
+                    try:
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            changed.append(json.load(f))
+                    except Exception as e:
+                        print(f"[!] Error reading {entry.name}: {e}")
+                new_token = max(new_token, mtime)
+        return changed, new_token
+
+    def get_meta(self, key, default=None):
+        path = os.path.join(self.folder, self.META_FILE)
+        if not os.path.exists(path):
+            return default
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get(key, default)
+
+    def set_meta(self, key, value):
+        path = os.path.join(self.folder, self.META_FILE)
+        meta = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        meta[key] = value
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        pass
+
+BACKENDS = {
+    'sqlite': SqliteStore,
+    'json': JsonFolderStore,
+}
+
+def has_legacy_files(folder='temp'):
+    return os.path.isdir(folder) and any(name.endswith('.json') for name in os.listdir(folder))
+
+def open_store(folder='temp', backend=None):
+    backend = backend or os.getenv('EMAIL_STORE', 'sqlite')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown email store backend: {backend}")
+    needs_migration = (backend == 'sqlite' and not os.path.exists(os.path.join(folder, DB_FILE))
+                       and has_legacy_files(folder))
+    store = BACKENDS[backend](folder)
+    if needs_migration:
+        migrate_json_folder(folder, store)
+    return store
+
+def migrate_json_folder(folder, store, remove=False, batch_size=1000):
+    legacy = JsonFolderStore(folder)
+    batch = []
+    migrated = 0
+    for email in legacy.iter_emails():
+        if 'id' not in email:
+            continue
+        batch.append(email)
+        if len(batch) >= batch_size:
+            store.put_many(batch)
+            migrated += len(batch)
+            batch = []
+    if batch:
+        store.put_many(batch)
+        migrated += len(batch)
+
+    if remove:
+        for name in os.listdir(folder):
+            if name.endswith('.json'):
+                os.remove(os.path.join(folder, name))
+    print(f"[+] Migrated {migrated} emails from '{folder}' into {type(store).__name__}")
+    return migrated
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['migrate', 'count', 'compact'])
+    parser.add_argument('--folder', default='temp', help='Email storage folder')
+    parser.add_argument('--backend', default='sqlite', help='Target backend (sqlite or json)')
+    parser.add_argument('--remove', default='false', help='Delete the JSON files after migrating')
+    args = parser.parse_args()
+
+    store = BACKENDS[args.backend](args.folder)
+    if args.command == 'migrate':
+        migrate_json_folder(args.folder, store, remove=args.remove.lower() == 'true')
+    elif args.command == 'compact':
+        if not isinstance(store, SqliteStore):
+            print("[!] Only the sqlite backend compresses bodies")
+        else:
+            packed, before, after = store.compact()
+            print(f"[+] Compressed {packed} bodies, {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    else:
+        print(f"[+] {store.count()} emails in '{args.folder}'")
+    store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import os
+import time
+import json
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from prompt_builder import compact_email, dump_compact, estimate_tokens, SUMMARY_LIST_FIELDS
+from rate_limiter import RateLimitExceeded, is_rate_limit_error
+from gemini_models import scheduler as shared_scheduler
+from metrics import record_latency, count
+
+# Optional ingest stage run after a sync: a cheap model summarizes emails in
+# batches and extracts structured fields (category, amounts, due dates,
+# action items), stored with the email under 'summary'. Prompts can then
+# carry these instead of whole bodies (build_prompt(..., summaries=True)).
+# Every summary keeps a hash of the content it was made from; syncs drop it
+# when that content changes (keep_summary), so a run only sends emails
+# without a summary and an interrupted run picks up where it stopped.
+# Summaries are written on their own (store.set_field), leaving labels and
+# bodies synced meanwhile alone.
+
+SUMMARY_FIELD = 'summary'
+SUMMARY_MODEL = 'gemini-2.0-flash-lite-001'
+# Cheap models suited for summaries, paced by the shared scheduler with the
+# limits from gemini_models.py
+SUMMARY_MODEL_IDS = ['gemini-2.0-flash-lite-001', 'gemini-1.5-flash-8b']
+# Emails per model call and calls in flight
+SUMMARY_BATCH = 20
+SUMMARY_WORKERS = 2
+# Body share of each email sent for summarizing
+SUMMARY_BODY_TOKENS = 500
+CALL_ATTEMPTS = 3
+# Longest a batch may queue for its rate limit before the run pauses
+MAX_QUEUE_WAIT = 600
+
+CATEGORIES = ['personal', 'work', 'invoice', 'receipt', 'payment', 'shipping', 'travel', 'event',
+              'newsletter', 'promotion', 'notification', 'security', 'other']
+
+SUMMARY_PROMPT = (
+    "Summarize each of these emails. Reply with a JSON array holding one object per email with the keys "
+    "\"id\" (copied from the email), \"summary\" (one or two sentences), \"category\" (one of: "
+    + ", ".join(CATEGORIES) + "), \"amounts\" (list of money amounts with currency), \"due_dates\" "
+    "(list of deadlines or due dates as YYYY-MM-DD) and \"action_items\" (list of things the recipient "
+    "has to do). Use empty lists when there are none.\n\nEmails:\n{emails}"
+)
+JSON_CONFIG = {'response_mime_type': 'application/json'}
+
+def summary_hash(email):
+    text = "\n".join([email.get('subject') or '', email.get('from') or '', email.get('date') or '',
+                      email.get('body') or email.get('snippet') or ''])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def keep_summary(email, existing):
+    # Carries the summary of an earlier copy over to a re-synced email when
+    # the content it was made from is unchanged
+    summary = (existing or {}).get(SUMMARY_FIELD)
+    if summary and summary.get('hash') == summary_hash(email):
+        email[SUMMARY_FIELD] = summary
+    return email
+
+def summary_prompt(emails):
+    items = [{'id': email['id'], **compact_email(email, SUMMARY_BODY_TOKENS)} for email in emails]
+    return SUMMARY_PROMPT.format(emails=dump_compact(items))
+
+def _strings(value):
+    if isinstance(value, (str, int, float)):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    return [str(v).strip() for v in value if isinstance(v, (str, int, float)) and str(v).strip()]
+
+def parse_summaries(text):
+    # Model reply -> {id: summary}; entries that don't parse are left out
+    # and their emails retried on the next run
+    start, end = text.find('['), text.rfind(']')
+    try:
+        entries = json.loads(text[start:end + 1]) if start != -1 else []
+    except ValueError:
+        return {}
+    summaries = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not entry.get('id'):
+            continue
+        category = str(entry.get('category') or 'other').strip().lower()
+        summaries[str(entry['id'])] = {
+            'text': str(entry.get('summary') or '').strip(),
+            'category': category if category in CATEGORIES else 'other',
+            **{field: _strings(entry.get(field)) for field in SUMMARY_LIST_FIELDS},
+        }
+    return summaries
+
+def _generate(model, model_id, scheduler, prompt, max_wait):
+    for attempt in range(CALL_ATTEMPTS):
+        scheduler.acquire(model_id, estimate_tokens(prompt), max_wait=max_wait)
+        start = time.perf_counter()
+        try:
+            text = model.generate_content(prompt, generation_config=JSON_CONFIG).text
+            record_latency('summary_response', time.perf_counter() - start)
+            return text
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == CALL_ATTEMPTS - 1:
+                raise
+            scheduler.penalize(model_id)
+            count('gemini_retries')
+
+def summarize_emails(store, showlog=False, model_id=SUMMARY_MODEL, model=None, scheduler=None,
+                     batch_size=SUMMARY_BATCH, workers=SUMMARY_WORKERS, max_wait=MAX_QUEUE_WAIT):
+    # Generator of log lines like the sync functions. Summaries are saved
+    # batch by batch, so stopping at any point loses at most the batches
+    # in flight.
+    pending = store.ids_without(SUMMARY_FIELD)
+    log_message = f"Summaries: {len(pending)} emails to summarize with {model_id}\n"
+    print(log_message)
+    yield log_message.encode("utf-8")
+    if not pending:
+        return
+
+    if model is None:
+        import google.generativeai as genai
+        from gemini_client import get_model
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        model = get_model(model_id)
+    # Every run of the process counts against the same limits
+    scheduler = scheduler or shared_scheduler
+    stop = threading.Event()
+
+    def run(ids):
+        if stop.is_set():
+            return ids, None, None
+        emails = [email for email in (store.get(msg_id) for msg_id in ids) if email]
+        try:
+            parsed = parse_summaries(_generate(model, model_id, scheduler, summary_prompt(emails), max_wait))
+        except RateLimitExceeded as e:
+            stop.set()
+            return ids, None, e
+        except Exception as e:
+            return ids, None, e
+        summaries = {email['id']: {**parsed[email['id']], 'hash': summary_hash(email), 'model': model_id}
+                     for email in emails if email['id'] in parsed}
+        # Emails re-synced with new content while the model was working get
+        # summarized again next run
+        current = (store.get(msg_id) for msg_id in summaries)
+        summaries = {email['id']: summaries[email['id']] for email in current
+                     if email and summary_hash(email) == summaries[email['id']]['hash']}
+        store.set_field(SUMMARY_FIELD, summaries)
+        count('emails_summarized', len(summaries))
+        return ids, list(summaries), None
+
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    summarized = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for ids, done, error in pool.map(run, batches):
+            if done is None and error is None:
+                continue
+            if isinstance(error, RateLimitExceeded):
+                log_message = f"Summaries paused, {model_id} is out of quota: {error}\n"
+            elif error is not None:
+                failed += len(ids)
+                log_message = f"Summary batch of {len(ids)} emails failed: {error}\n"
+            else:
+                summarized += len(done)
+                failed += len(ids) - len(done)
+                log_message = f"Summarized {summarized}/{len(pending)} emails\n"
+            if showlog or error is not None:
+                print(log_message)
+            yield log_message.encode("utf-8")
+
+    log_message = f"Summaries done: {summarized} summarized, {failed} failed, {len(pending) - summarized - failed} left\n"
+    print(log_message)
+    yield log_message.encode("utf-8")
+
+def main():
+    from email_store import open_store
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', default='temp', help='Mailbox folder')
+    parser.add_argument('--model', default=SUMMARY_MODEL, choices=SUMMARY_MODEL_IDS,
+                        help='Model used for summaries')
+    parser.add_argument('--showlog', default='false', help='Show progress for every batch')
+    args = parser.parse_args()
+
+    store = open_store(args.folder)
+    try:
+        for _ in summarize_emails(store, args.showlog.lower() == 'true', args.model):
+            pass
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+
+# Local stand-in for google.generativeai.GenerativeModel, enough for the ask
+# servers and the load-test benchmark to run without an API key. Answers are
+# canned text delivered after a simulated latency, streamed in a few chunks.
+# Requests for JSON (the summary stage) get one canned summary per email id
+# found in the prompt. A share of calls can be answered with a 429 to
+# exercise the retry and pacing paths.
+
+ID_RE = re.compile(r'"id":"([^"]+)"')
+
+class ResourceExhausted(Exception):
+    # What google.api_core raises when a model is over quota
+    code = 429
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenerativeModel:
+    def __init__(self, model_id, latency=0.5, chunks=5, error_rate=0.0, seed=0):
+        self.model_id = model_id
+        self.latency = latency
+        self.chunks = chunks
+        # Share of calls answered with ResourceExhausted
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors_injected = 0
+        self.prompt_chars = 0
+
+    def _maybe_fail(self):
+        if not self.error_rate:
+            return
+        with self._lock:
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors_injected += 1
+        if fail:
+            raise ResourceExhausted(f"429 Resource has been exhausted (e.g. check quota) for {self.model_id}")
+
+    def _answer(self, prompt):
+        self.calls += 1
+        if not isinstance(prompt, str):
+            # Multi-turn contents: [{'role': ..., 'parts': [text]}, ...]
+            prompt = "".join(part for turn in prompt for part in turn['parts'])
+        self.prompt_chars += len(prompt)
+        return f"[{self.model_id}] Answer based on a {len(prompt)} character prompt."
+
+    def _pieces(self, text):
+        size = max(1, len(text) // self.chunks + 1)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def _json_answer(self, prompt):
+        self.calls += 1
+        self.prompt_chars += len(prompt)
+        return json.dumps([{'id': msg_id, 'summary': f"Short summary of email {msg_id}.", 'category': 'other',
+                            'amounts': [], 'due_dates': [], 'action_items': []} for msg_id in ID_RE.findall(prompt)])
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        self._maybe_fail()
+        if generation_config and generation_config.get('response_mime_type') == 'application/json':
+            time.sleep(self.latency)
+            return FakeResponse(self._json_answer(prompt))
+        text = self._answer(prompt)
+        if stream:
+            return self._stream(text)
+        time.sleep(self.latency)
+        return FakeResponse(text)
+
+    def _stream(self, text):
+        for piece in self._pieces(text):
+            time.sleep(self.latency / self.chunks)
+            yield FakeResponse(piece)
+
+    async def generate_content_async(self, prompt, stream=False):
+        self._maybe_fail()
+        text = self._answer(prompt)
+        if stream:
+            return self._stream_async(text)
+        await asyncio.sleep(self.latency)
+        return FakeResponse(text)
+
+    async def _stream_async(self, text):
+        for piece in self._pieces(text):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield FakeResponse(piece)
+
+def fake_model_factory(latency=0.5, error_rate=0.0):
+    # One shared fake client per model id, like gemini_client.get_model
+    models = {}
+
+    def factory(model_id):
+        if model_id not in models:
+            models[model_id] = FakeGenerativeModel(model_id, latency, error_rate=error_rate)
+        return models[model_id]
+    factory.models = models
+    return factory
+
+class FakeCachedContent:
+    def __init__(self, contents):
+        self.contents = contents
+        self.deleted = False
+
+    def update(self, ttl=None):
+        pass
+
+    def delete(self):
+        self.deleted = True
+
+def fake_context_cache(model_factory):
+    # Stand-in for gemini_client.cache_context: the cached contents are kept
+    # locally and the plain fake model answers on top of them
+    def cache(model_id, contents, ttl):
+        return model_factory(model_id), FakeCachedContent(contents)
+    return cache
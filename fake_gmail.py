@@ -0,0 +1,382 @@
+import base64
+import random
+import threading
+import time
+import json
+import httplib2
+from email.utils import formatdate
+from googleapiclient.errors import HttpError
+
+# Local stand-in for the subset of the Gmail API this project uses, so the
+# sync pipeline can be exercised and benchmarked without Google services.
+# Latency, bandwidth and injected 429 rate-limit errors are configurable,
+# and synthetic mailboxes can be generated lazily so 100k-message runs fit
+# in memory. After users().watch(), every mailbox change is announced to the
+# callbacks registered with subscribe(), like Gmail push notifications
+# delivered through Pub/Sub.
+
+LABELS = [
+    {'id': 'INBOX', 'name': 'INBOX'},
+    {'id': 'IMPORTANT', 'name': 'IMPORTANT'},
+    {'id': 'CATEGORY_UPDATES', 'name': 'CATEGORY_UPDATES'},
+    {'id': 'SENT', 'name': 'SENT'},
+]
+
+SENDERS = ['billing@vendor.com', 'alice@example.com', 'bob@example.com', 'news@updates.io', 'support@shop.net']
+TOPICS = ['invoice', 'meeting', 'report', 'newsletter', 'order', 'travel', 'password', 'contract']
+WORDS = ('the please review attached due payment schedule project update team thanks regards '
+         'week month amount total account order shipping delivery call notes agenda').split()
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _text(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+def message_rng(i, seed=0):
+    return random.Random(seed * 1000003 + i)
+
+def message_labels(i, seed=0):
+    # Drawn separately from the content, so a mailbox can be listed
+    # without generating its messages
+    rng = random.Random(f"labels:{seed}:{i}")
+    labels = ['INBOX']
+    if rng.random() < 0.4:
+        labels.append('IMPORTANT')
+    if rng.random() < 0.5:
+        labels.append('CATEGORY_UPDATES')
+    if rng.random() < 0.1:
+        labels = ['SENT']
+    return labels
+
+def generate_message(i, rng=None, seed=0):
+    rng = rng or message_rng(i, seed)
+    topic = rng.choice(TOPICS)
+    subject = f"{topic.title()} #{i}"
+    sender = rng.choice(SENDERS)
+    body = _text(rng, rng.randint(20, 400))
+    html = f"<html><body><p>{body}</p></body></html>"
+    headers = [
+        {'name': 'Subject', 'value': subject},
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': 'me@example.com'},
+        {'name': 'Date', 'value': formatdate(1700000000 + i * 3600)},
+    ]
+    # Mix flat, multipart/alternative, nested multipart/mixed, HTML-only and
+    # multipart/related layouts
+    kind = i % 5
+    alternative = {
+        'mimeType': 'multipart/alternative',
+        'headers': headers if kind == 1 else [],
+        'body': {'size': 0},
+        'parts': [
+            {'partId': '0', 'mimeType': 'text/plain', 'body': {'size': len(body), 'data': _encode(body)}},
+            {'partId': '1', 'mimeType': 'text/html', 'body': {'size': len(html), 'data': _encode(html)}},
+        ],
+    }
+    attachment = {'partId': '2', 'mimeType': 'application/pdf', 'filename': f"{topic}-{i}.pdf",
+                  'body': {'size': 20000 + i, 'attachmentId': f"att-{i}"}}
+    if kind == 0:
+        payload = {'mimeType': 'text/plain', 'headers': headers, 'body': {'size': len(body), 'data': _encode(body)}}
+    elif kind == 1:
+        payload = alternative
+    elif kind == 2:
+        payload = {'mimeType': 'multipart/mixed', 'headers': headers, 'body': {'size': 0},
+                   'parts': [alternative, attachment]}
+    elif kind == 3:
+        styled = (f"<html><head><style>p {{color: red}}</style></head><body><table><tr><td>"
+                  f"<p>{body}</p></td></tr></table><p>&copy; Unsubscribe &amp; settings</p></body></html>")
+        payload = {'mimeType': 'text/html',
+                   'headers': headers + [{'name': 'Content-Type', 'value': 'text/html; charset="UTF-8"'}],
+                   'body': {'size': len(styled), 'data': _encode(styled)}}
+    else:
+        related = {
+            'mimeType': 'multipart/related',
+            'body': {'size': 0},
+            'parts': [
+                {'partId': '0.0', 'mimeType': 'text/html', 'body': {'size': len(html), 'data': _encode(html)}},
+                {'partId': '0.1', 'mimeType': 'image/png', 'filename': 'logo.png',
+                 'body': {'size': 4000, 'attachmentId': f"img-{i}"}},
+            ],
+        }
+        notes = f"Notes for {subject}"
+        payload = {'mimeType': 'multipart/mixed', 'headers': headers, 'body': {'size': 0}, 'parts': [
+            related,
+            {'partId': '1', 'mimeType': 'text/plain', 'filename': 'notes.txt',
+             'headers': [{'name': 'Content-Disposition', 'value': 'attachment; filename="notes.txt"'}],
+             'body': {'size': len(notes), 'data': _encode(notes)}},
+        ]}
+    return {
+        'id': f"{i:016x}",
+        'threadId': f"{i // 3:016x}",
+        'labelIds': message_labels(i, seed),
+        'snippet': body[:100],
+        'internalDate': str((1700000000 + i * 3600) * 1000),
+        'sizeEstimate': len(body) + len(html) + 500,
+        'payload': payload,
+    }
+
+def iter_mailbox(count, seed=0):
+    # Messages one at a time, for callers that only need them in passing
+    for i in range(count):
+        yield generate_message(i, seed=seed)
+
+def generate_mailbox(count, seed=0):
+    return list(iter_mailbox(count, seed))
+
+def http_error(status, message):
+    content = json.dumps({'error': {'code': status, 'message': message}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+def _strip_payload(payload, fmt, metadata_headers):
+    if fmt == 'minimal':
+        return None
+    headers = payload.get('headers', [])
+    if metadata_headers:
+        headers = [h for h in headers if h['name'] in metadata_headers]
+    if fmt == 'metadata':
+        return {'mimeType': payload.get('mimeType'), 'headers': headers}
+    return payload
+
+class _Request:
+    def __init__(self, service, func):
+        self._service = service
+        self._func = func
+
+    def execute(self, http=None, num_retries=0):
+        self._service._round_trip()
+        self._service._maybe_fail()
+        response = self._func()
+        self._service._transfer(response)
+        return response
+
+class _Batch:
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self._requests) >= 100:
+            raise ValueError("Exceeded the maximum calls(100) in a single batch request.")
+        self._requests.append((request_id or str(len(self._requests)), request, callback or self._callback))
+
+    def execute(self, http=None):
+        self._service._round_trip()
+        for request_id, request, callback in self._requests:
+            try:
+                # Gmail rate-limits calls inside a batch one by one
+                self._service._maybe_fail()
+                response, exception = request._func(), None
+                self._service._transfer(response)
+            except Exception as e:
+                response, exception = None, e
+            if callback:
+                callback(request_id, response, exception)
+
+class _Resource:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+class FakeGmailService:
+    def __init__(self, messages=None, labels=None, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        self.labels = list(labels or LABELS)
+        self.messages = {}
+        self.order = []
+        self.latency = latency
+        # Response bytes per second, None for unlimited
+        self.bandwidth = bandwidth
+        # Share of calls answered with a 429 rateLimitExceeded
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self.errors_injected = 0
+        # Seed of a lazily generated mailbox, see synthetic()
+        self.seed = seed
+        self.calls = 0
+        self.bytes_sent = 0
+        self.history_id = 1000
+        # History older than this id has expired, like Gmail's ~1 week window
+        self.min_history_id = self.history_id
+        self.history = []
+        # Push notifications: the watched topic and its subscribers
+        self.watch_topic = None
+        self.subscribers = []
+        self._lock = threading.Lock()
+        for msg in messages or []:
+            msg = dict(msg, historyId=str(self.history_id))
+            self.messages[msg['id']] = msg
+            self.order.append(msg['id'])
+
+    @classmethod
+    def synthetic(cls, count, seed=0, **kwargs):
+        # A generated mailbox that only keeps what listing needs in memory;
+        # messages are generated again whenever they are fetched
+        service = cls(seed=seed, **kwargs)
+        for i in range(count):
+            msg_id = f"{i:016x}"
+            service.messages[msg_id] = {'id': msg_id, 'threadId': f"{i // 3:016x}", 'labelIds': message_labels(i, seed),
+                                        'historyId': str(service.history_id), 'index': i}
+            service.order.append(msg_id)
+        return service
+
+    def _full_message(self, msg_id):
+        msg = self.messages[msg_id]
+        if 'index' not in msg:
+            return dict(msg)
+        full = generate_message(msg['index'], seed=self.seed)
+        full.update(labelIds=list(msg['labelIds']), historyId=msg['historyId'])
+        return full
+
+    def _maybe_fail(self):
+        if not self.error_rate:
+            return
+        with self._lock:
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors_injected += 1
+        if fail:
+            raise http_error(429, "Rate Limit Exceeded")
+
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _transfer(self, response):
+        size = len(json.dumps(response))
+        with self._lock:
+            self.bytes_sent += size
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    # Mailbox mutations, recorded in history like Gmail does
+
+    def _record(self, key, msg_id, label_ids=None):
+        self.history_id += 1
+        msg = self.messages[msg_id]
+        msg['historyId'] = str(self.history_id)
+        entry = {'message': {'id': msg_id, 'threadId': msg['threadId'], 'labelIds': list(msg['labelIds'])}}
+        if label_ids is not None:
+            entry['labelIds'] = list(label_ids)
+        self.history.append({'id': str(self.history_id), 'messages': [entry['message']], key: [entry]})
+
+    def _publish(self):
+        # Called after a change, outside the lock so subscribers may call back
+        if self.watch_topic is None:
+            return
+        notification = {'emailAddress': 'me@example.com', 'historyId': self.history_id}
+        for callback in list(self.subscribers):
+            callback(notification)
+
+    def subscribe(self, callback):
+        # callback({'emailAddress', 'historyId'}) on every change while watched
+        self.subscribers.append(callback)
+
+    def add_message(self, msg):
+        with self._lock:
+            self.messages[msg['id']] = dict(msg)
+            self.order.insert(0, msg['id'])
+            self._record('messagesAdded', msg['id'])
+        self._publish()
+
+    def delete_message(self, msg_id):
+        with self._lock:
+            self._record('messagesDeleted', msg_id)
+            self.order.remove(msg_id)
+            del self.messages[msg_id]
+        self._publish()
+
+    def relabel_message(self, msg_id, add=(), remove=()):
+        with self._lock:
+            msg = self.messages[msg_id]
+            msg['labelIds'] = [l for l in msg['labelIds'] if l not in remove] + [l for l in add if l not in msg['labelIds']]
+            if add:
+                self._record('labelsAdded', msg_id, add)
+            if remove:
+                self._record('labelsRemoved', msg_id, remove)
+        self._publish()
+
+    def expire_history(self):
+        with self._lock:
+            self.min_history_id = self.history_id
+            self.history = []
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+
+    def users(self):
+        return _Resource(
+            getProfile=self._get_profile,
+            labels=lambda: _Resource(list=self._labels_list),
+            messages=lambda: _Resource(list=self._messages_list, get=self._messages_get),
+            history=lambda: _Resource(list=self._history_list),
+            watch=self._watch,
+            stop=self._stop_watch,
+        )
+
+    def _watch(self, userId='me', body=None):
+        def run():
+            self.watch_topic = (body or {}).get('topicName')
+            # Gmail watches last 7 days
+            return {'historyId': str(self.history_id), 'expiration': str(int((time.time() + 7 * 24 * 3600) * 1000))}
+        return _Request(self, run)
+
+    def _stop_watch(self, userId='me'):
+        def run():
+            self.watch_topic = None
+            return {}
+        return _Request(self, run)
+
+    def _get_profile(self, userId='me'):
+        return _Request(self, lambda: {
+            'emailAddress': 'me@example.com',
+            'messagesTotal': len(self.messages),
+            'historyId': str(self.history_id),
+        })
+
+    def _history_list(self, userId='me', startHistoryId=None, pageToken=None, maxResults=100, historyTypes=None):
+        def run():
+            if int(startHistoryId) < self.min_history_id:
+                raise http_error(404, "Requested entity was not found.")
+            records = [h for h in self.history if int(h['id']) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            end = start + min(maxResults or 100, 500)
+            response = {'history': records[start:end], 'historyId': str(self.history_id)}
+            if end < len(records):
+                response['nextPageToken'] = str(end)
+            return response
+        return _Request(self, run)
+
+    def _labels_list(self, userId='me'):
+        return _Request(self, lambda: {'labels': list(self.labels)})
+
+    def _messages_list(self, userId='me', maxResults=100, labelIds=None, pageToken=None, q=None):
+        def run():
+            ids = [m for m in self.order
+                   if not labelIds or set(labelIds) & set(self.messages[m]['labelIds'])]
+            start = int(pageToken or 0)
+            # Gmail caps list pages at 500 ids
+            end = start + min(maxResults or 100, 500)
+            page = ids[start:end]
+            response = {
+                'messages': [{'id': m, 'threadId': self.messages[m]['threadId']} for m in page],
+                'resultSizeEstimate': len(page),
+            }
+            if end < len(ids):
+                response['nextPageToken'] = str(end)
+            return response
+        return _Request(self, run)
+
+    def _messages_get(self, userId='me', id=None, format='full', metadataHeaders=None):
+        def run():
+            if id not in self.messages:
+                raise http_error(404, "Requested entity was not found.")
+            msg = self._full_message(id)
+            payload = _strip_payload(msg['payload'], format, metadataHeaders)
+            if payload is None:
+                msg.pop('payload')
+            else:
+                msg['payload'] = payload
+            return msg
+        return _Request(self, run)
@@ -4,93 +4,19 @@ import json
 import readline
 import shutil
 from email_loader import load_emails_from_temp
+from email_index import open_index, select_emails, DEFAULT_TOP_K
+from email_embeddings import semantic_enabled, open_semantic_index
+from rate_limiter import is_rate_limit_error
+from gemini_models import GEMINI_MODELS, model_limits, scheduler
+from answer_cache import AnswerCache
+from metrics import record_latency
+from gemini_client import stream_text, cache_context
+from chat_session import ChatSession
+from map_reduce import MapReduce
+from ed import fill_bodies
 from google.generativeai import GenerativeModel, configure
 import google.generativeai as genai
 
-GEMINI_MODELS = [
-    {
-      "name": "Gemini 2.5 Flash Preview 04-17 (Experimental)",
-      "id": "gemini-1.5-flash-latest",
-      "description": "Optimized for adaptive thinking and cost efficiency, it accepts audio, images, videos, and text as input and generates text.",
-      "limits": {
-        "requests_per_minute": 10,
-        "tokens_per_minute": 250000,
-        "requests_per_day": 500
-      }
-    },
-    {
-      "name": "Gemini 2.5 Pro Experimental 03-25 (Experimental)",
-      "id": "gemini-1.5-pro-latest",
-      "description": "The most advanced reasoning Gemini model, excelling in multimodal understanding, coding, and world knowledge. It supports audio, images, videos, and text inputs and provides text outputs.",
-      "limits": {
-        "requests_per_minute": 5,
-        "tokens_per_minute": 250000,
-        "tokens_per_day": 1000000,
-        "requests_per_day": 25
-      }
-    },
-    {
-      "name": "Gemini 2.0 Flash",
-      "id": "gemini-2.0-flash-001",
-      "description": "A fast, next-generation multimodal model supporting audio, images, videos, and text inputs, with text, and experimental image outputs, and audio output coming soon. It's designed for diverse tasks and real-time streaming.",
-      "limits": {
-        "requests_per_minute": 15,
-        "tokens_per_minute": 1000000,
-        "requests_per_day": 1500
-      }
-    },
-    {
-      "name": "Gemini 2.0 Flash-Lite",
-      "id": "gemini-2.0-flash-lite-001",
-      "description": "A cost-effective version of Gemini 2.0 Flash, optimized for high throughput and low latency, supporting the same input types and providing text output.",
-      "limits": {
-        "requests_per_minute": 30,
-        "tokens_per_minute": 1000000,
-        "requests_per_day": 1500
-      }
-    },
-    {
-      "name": "Gemini 1.5 Flash",
-      "id": "gemini-1.5-flash",
-      "description": "Offers fast and versatile performance across various tasks, with audio, images, videos, and text input and text output, also featuring a 2M token context window.",
-      "limits": {
-        "requests_per_minute": 15,
-        "tokens_per_minute": 250000,
-        "requests_per_day": 500
-      }
-    },
-    {
-      "name": "Gemini 1.5 Flash-8B",
-      "id": "gemini-1.5-flash-8b",
-      "description": "Designed for high-volume and lower-intelligence tasks, it supports multimodal inputs and text output.",
-      "limits": {
-        "requests_per_minute": 15,
-        "tokens_per_minute": 250000,
-        "requests_per_day": 500
-      }
-    },
-    {
-      "name": "Gemma 3",
-      "id": "gemma-3",
-      "description": "A small-sized, lightweight open model for text generation and image understanding.",
-      "limits": {
-        "requests_per_minute": 30,
-        "tokens_per_minute": 15000,
-        "requests_per_day": 14400
-      }
-    },
-    {
-      "name": "Gemini Embedding Experimental 03-07",
-      "id": "embedding-001",
-      "description": "Creates text embeddings to measure the relatedness of text strings.",
-      "limits": {
-        "requests_per_minute": 5,
-        "requests_per_day": 100
-      }
-    }
-  ]
-
-
 def select_model():
     print("[?] Select a Gemini model:")
     for i, model in enumerate(GEMINI_MODELS, 1):
@@ -108,23 +34,69 @@ def select_model():
         except ValueError:
             print("Invalid input. Please enter a valid number.")
 
-def ask_loop(model_id, all_emails):
+def ask_loop(model_id, all_emails, top_k=DEFAULT_TOP_K):
     genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
     model = GenerativeModel(model_id)
-    history = []
+    # Follow-ups reuse the emails already sent in this conversation
+    session = ChatSession(model_id, model_limits(model_id), cache_factory=cache_context)
+    index = open_index(emails=all_emails)
+    answer_cache = AnswerCache()
+    semantic = None
+    if semantic_enabled():
+        semantic = open_semantic_index(all_emails)
 
-    print("\n[+] Ask about your emails. Type 'exit()' to quit.\n")
+    print("\n[+] Ask about your emails. Type 'exit()' to quit.")
+    print("[+] Start a question with '/all ' to answer it over every email instead of the most relevant ones.")
+    print("[+] Type '/new' to start a new conversation.\n")
     while True:
         query = input("You: ")
         if query.strip() == "exit()":
             break
-        prompt = f"Based on these emails:\n\n{json.dumps(all_emails)}\n\nAnswer this:\n{query}"
+        if query.strip() == "/new":
+            session.close()
+            session = ChatSession(model_id, model_limits(model_id), cache_factory=cache_context)
+            print("[+] Started a new conversation.")
+            continue
+        if query.startswith("/all "):
+            # Map-reduce over the whole mailbox, shard by shard, reading
+            # ingest-time summaries where there are any
+            query = query[len("/all "):]
+            try:
+                runner = MapReduce(model_id, model, scheduler, model_limits(model_id), answer_cache, summaries=True)
+                answer, stats = runner.answer(query, all_emails)
+                print(f"[+] {stats['shards']} shards, {stats['relevant_shards']} relevant, "
+                      f"{stats['model_calls']} calls ({stats['cached_calls']} cached), {stats['seconds']}s")
+                print("AI:", answer)
+            except Exception as e:
+                print("[!] Error with Gemini:", e)
+            continue
+        # Only send the relevant emails the conversation hasn't seen yet
+        emails = fill_bodies(select_emails(query, all_emails, top_k, index, semantic))
+        contents, message, ids, stats = session.prepare(query, emails)
+        print(f"[+] Sending {stats['emails_included']} new emails, {stats['context_emails']} in context"
+              f"{' (cached)' if stats['context_cached'] else ''}, {stats['history_turns']} earlier turns"
+              f" (~{stats['estimated_tokens']} tokens)")
         try:
-            res = model.generate_content(prompt)
-            print("AI:", res.text.strip())
+            waited = scheduler.limiter(model_id).acquire(stats['estimated_tokens'])
+            if waited > 1:
+                print(f"[+] Waited {waited:.1f}s for the {model_id} rate limit")
+            # Print the answer as it streams in
+            start = time.perf_counter()
+            parts = []
+            print("AI: ", end="", flush=True)
+            for text in stream_text((session.model or model).generate_content(contents, stream=True)):
+                if not parts:
+                    record_latency('gemini_ttft', time.perf_counter() - start)
+                print(text, end="", flush=True)
+                parts.append(text)
+            print()
+            record_latency('gemini_response', time.perf_counter() - start)
+            session.record(message, ids, "".join(parts).strip())
         except Exception as e:
+            if is_rate_limit_error(e):
+                scheduler.penalize(model_id)
             print("[!] Error with Gemini:", e)
-        time.sleep(0.5)
+    session.close()
 
 def cleanup_prompt(temp_dir="temp"):
     choice = input("\nDo you want to delete the temp folder? (y/n): ").strip().lower()
@@ -0,0 +1,41 @@
+import datetime
+from functools import lru_cache
+from google.generativeai import GenerativeModel
+
+# Shared helpers around Gemini model clients
+
+@lru_cache(maxsize=None)
+def get_model(model_id):
+    # Model clients are reusable, build one per model id per process
+    return GenerativeModel(model_id)
+
+def stream_text(response):
+    # Text pieces of a streamed generate_content response. Chunks without
+    # text parts (e.g. only a finish reason) raise on .text and are skipped.
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+async def stream_text_async(response):
+    # stream_text() for generate_content_async(..., stream=True)
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+def cache_context(model_id, contents, ttl):
+    # Uploads contents once as Gemini cached content. Returns a model that
+    # answers on top of it and the cache handle (delete() it when done).
+    # Raises when the model or context size doesn't support caching.
+    from google.generativeai import caching
+    name = model_id if model_id.startswith('models/') else 'models/' + model_id
+    cached = caching.CachedContent.create(model=name, contents=contents,
+                                          ttl=datetime.timedelta(seconds=ttl))
+    return GenerativeModel.from_cached_content(cached_content=cached), cached
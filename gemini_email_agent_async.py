@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from ask_service import AskService, AskError
+from gemini_models import ASK_MODELS
+from rate_limiter import is_rate_limit_error
+from metrics import (record_latency, snapshot as metrics_snapshot, start_trace, use_trace, finish_trace,
+                     recent_traces, get_trace)
+from gemini_client import stream_text_async
+from ed import fill_bodies
+
+# asyncio serving mode for the ask API, as a plain ASGI app (run it with
+# uvicorn or any other ASGI server). A waiting question only holds a
+# coroutine, not a thread: model calls use generate_content_async, rate
+# limit waits sleep on the event loop, and a semaphore caps how many
+# questions are in flight at once.
+
+# Questions being answered at the same time, the rest wait their turn
+MAX_CONCURRENT_ASKS = int(os.getenv('MAX_CONCURRENT_ASKS', 256))
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body) if body else {}
+    except ValueError:
+        return None
+
+async def send_json(send, payload, status=200, headers=None):
+    body = json.dumps(payload).encode('utf-8')
+    raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    raw_headers += [(k.lower().encode(), str(v).encode()) for k, v in (headers or {}).items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n".encode('utf-8')
+
+def with_header(send, name, value):
+    # send adding a header to the response start
+    async def wrapped(message):
+        if message['type'] == 'http.response.start':
+            message = {**message, 'headers': list(message.get('headers', [])) + [(name, value.encode())]}
+        await send(message)
+    return wrapped
+
+def create_app(service, max_concurrent=MAX_CONCURRENT_ASKS):
+    state = {'slots': None}
+
+    def slots():
+        # Created lazily so it belongs to the server's event loop
+        if state['slots'] is None:
+            state['slots'] = asyncio.Semaphore(max_concurrent)
+        return state['slots']
+
+    async def prepare(data):
+        # Retrieval and prompt building touch sqlite and numpy, keep them off the loop
+        return await asyncio.to_thread(service.prepare, data)
+
+    async def ask(data, send):
+        if data.get('mode') == 'map_reduce':
+            return await ask_map_reduce(data, send)
+        try:
+            ctx = await prepare(data)
+            if ctx['cached'] is not None:
+                return await send_json(send, {"response": ctx['cached'], "model_id": ctx['model_id'],
+                                              "prompt": ctx['stats'], "cached": True})
+            used_model_id = await service.acquire_async(ctx, data)
+        except AskError as e:
+            return await send_json(send, {"error": e.message}, e.status, e.headers)
+        model = service.model(used_model_id, ctx)
+
+        try:
+            start = time.perf_counter()
+            res = await model.generate_content_async(ctx['prompt'])
+            answer = res.text.strip()
+            record_latency('gemini_response', time.perf_counter() - start)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                service.scheduler.penalize(used_model_id)
+                return await send_json(send, {"error": str(e)}, 429)
+            return await send_json(send, {"error": str(e)}, 500)
+        await asyncio.to_thread(service.finish, ctx, answer)
+        await send_json(send, {"response": answer, "model_id": used_model_id, "prompt": ctx['stats'], "cached": False,
+                               "session_id": ctx.get('session_id')})
+
+    async def ask_map_reduce(data, send):
+        # Rare and long: runs on a worker thread with its own shard pool
+        try:
+            result = await asyncio.to_thread(service.map_reduce, data)
+        except AskError as e:
+            return await send_json(send, {"error": e.message}, e.status, e.headers)
+        except Exception as e:
+            return await send_json(send, {"error": str(e)}, 429 if is_rate_limit_error(e) else 500)
+        await send_json(send, result)
+
+    async def ask_stream(data, send):
+        try:
+            ctx = await prepare(data)
+            used_model_id = ctx['model_id'] if ctx['cached'] is not None else await service.acquire_async(ctx, data)
+        except AskError as e:
+            return await send_json(send, {"error": e.message}, e.status, e.headers)
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no'),
+        ]})
+
+        async def emit(payload, more=True):
+            await send({'type': 'http.response.body', 'body': sse_event(payload), 'more_body': more})
+
+        await emit({"type": "meta", "model_id": used_model_id, "prompt": ctx['stats'], "cached": ctx['cached'] is not None,
+                    "session_id": ctx.get('session_id')})
+        if ctx['cached'] is not None:
+            await emit({"type": "token", "text": ctx['cached']})
+            return await emit({"type": "done", "ttft_ms": 0, "total_ms": 0}, more=False)
+
+        model = service.model(used_model_id, ctx)
+        start = time.perf_counter()
+        ttft = None
+        parts = []
+        try:
+            response = await model.generate_content_async(ctx['prompt'], stream=True)
+            async for text in stream_text_async(response):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    record_latency('gemini_ttft', ttft)
+                parts.append(text)
+                await emit({"type": "token", "text": text})
+        except Exception as e:
+            if is_rate_limit_error(e):
+                service.scheduler.penalize(used_model_id)
+            return await emit({"type": "error", "error": str(e)}, more=False)
+
+        total = time.perf_counter() - start
+        record_latency('gemini_response', total)
+        await asyncio.to_thread(service.finish, ctx, "".join(parts).strip())
+        await emit({"type": "done", "ttft_ms": round((ttft or total) * 1000, 1),
+                    "total_ms": round(total * 1000, 1)}, more=False)
+
+    def clear_cache():
+        service.answer_cache.clear()
+        return {"message": "Answer cache cleared"}
+
+    # (method, path) -> blocking handler returning a JSON payload
+    simple_routes = {
+        ('GET', '/models'): lambda: ASK_MODELS,
+        ('GET', '/metrics'): metrics_snapshot,
+        ('GET', '/rate-limits'): lambda: service.scheduler.metrics(),
+        ('GET', '/cache'): lambda: service.answer_cache.stats(),
+        ('GET', '/sessions'): lambda: service.sessions.list(),
+        ('GET', '/accounts'): service.account_list,
+        ('GET', '/traces'): recent_traces,
+        ('DELETE', '/cache'): clear_cache,
+    }
+    ask_routes = {
+        ('POST', '/ask'): (ask, 'ask'),
+        ('POST', '/ask/stream'): (ask_stream, 'ask_stream'),
+    }
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        route = (scope['method'], scope['path'].rstrip('/') or '/')
+        if route[0] == 'DELETE' and route[1].startswith('/sessions/'):
+            await read_json(receive)
+            if not service.sessions.delete(route[1][len('/sessions/'):]):
+                return await send_json(send, {"error": "Unknown or expired session"}, 404)
+            return await send_json(send, {"message": "Session ended"})
+        if route[0] == 'GET' and route[1].startswith('/traces/'):
+            trace = get_trace(route[1][len('/traces/'):])
+            if trace is None:
+                return await send_json(send, {"error": "Unknown trace"}, 404)
+            return await send_json(send, trace)
+        if route == ('POST', '/cleanup'):
+            data = await read_json(receive)
+            try:
+                accounts = await asyncio.to_thread(service.cleanup, data if isinstance(data, dict) else {})
+            except AskError as e:
+                return await send_json(send, {"error": e.message}, e.status, e.headers)
+            return await send_json(send, {"message": "Temp folder deleted", "accounts": accounts})
+        if route in simple_routes:
+            await read_json(receive)
+            try:
+                payload = await asyncio.to_thread(simple_routes[route])
+            except Exception as e:
+                return await send_json(send, {"error": str(e)}, 500)
+            return await send_json(send, payload)
+        if route in ask_routes:
+            data = await read_json(receive)
+            if not isinstance(data, dict):
+                return await send_json(send, {"error": "Request body must be a JSON object"}, 400)
+            handler, name = ask_routes[route]
+            # Traced on request ("trace": true) or with TRACE_FOLDER set;
+            # the trace follows the handler into asyncio.to_thread
+            trace = start_trace(name, data)
+            if trace is not None:
+                send = with_header(send, b'x-trace-id', trace.id)
+            try:
+                with use_trace(trace):
+                    async with slots():
+                        return await handler(data, send)
+            finally:
+                finish_trace(trace)
+        await send_json(send, {"error": "Not found"}, 404)
+
+    app.service = service
+    return app
+
+app = create_app(AskService(ASK_MODELS, body_loader=fill_bodies))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', default=5000, type=int)
+    parser.add_argument('--fake-latency', default=None, type=float,
+                        help='Answer with a local fake model of this latency (seconds) instead of Gemini')
+    parser.add_argument('--fake-error-rate', default=0.0, type=float,
+                        help='Share of fake model calls answered with a 429')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("[!] uvicorn is not installed, run: pip install uvicorn")
+        return
+
+    served = app
+    if args.fake_latency is not None:
+        from fake_gemini import fake_model_factory
+        served = create_app(AskService(ASK_MODELS, model_factory=fake_model_factory(args.fake_latency, args.fake_error_rate),
+                                       body_loader=fill_bodies, context_cache=None))
+    uvicorn.run(served, host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -1,129 +1,213 @@
 import os
 import time
 import json
-import shutil
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context, make_response
 from google.generativeai import GenerativeModel, configure
 import google.generativeai as genai
+from ask_service import AskService, AskError
+from gemini_models import ASK_MODELS
+from rate_limiter import is_rate_limit_error
+from metrics import (record_latency, snapshot as metrics_snapshot, start_trace, use_trace, finish_trace,
+                     current_trace, recent_traces, get_trace)
+from gemini_client import stream_text
+from ed import fill_bodies
 
 app = Flask(__name__)
 
-# Models configuration
-GEMINI_MODELS = [
-    {
-        "name": "Gemini 2.5 Flash Preview 04-17 (Experimental)",
-        "id": "gemini-1.5-flash-latest",
-        "description": "Optimized for adaptive thinking and cost efficiency, it accepts audio, images, videos, and text as input and generates text.",
-        "limits": {
-            "requests_per_minute": 10,
-            "tokens_per_minute": 250000,
-            "requests_per_day": 500
-        }
-    },
-    {
-        "name": "Gemini 2.5 Pro Experimental 03-25 (Experimental)",
-        "id": "gemini-1.5-pro-latest",
-        "description": "The most advanced reasoning Gemini model, excelling in multimodal understanding, coding, and world knowledge. It supports audio, images, videos, and text inputs and provides text outputs.",
-        "limits": {
-            "requests_per_minute": 5,
-            "tokens_per_minute": 250000,
-            "tokens_per_day": 1000000,
-            "requests_per_day": 25
-        }
-    },
-    {
-        "name": "Gemini 2.0 Flash",
-        "id": "gemini-2.0-flash-001",
-        "description": "A fast, next-generation multimodal model supporting audio, images, videos, and text inputs, with text, and experimental image outputs, and audio output coming soon. It's designed for diverse tasks and real-time streaming.",
-        "limits": {
-            "requests_per_minute": 15,
-            "tokens_per_minute": 1000000,
-            "requests_per_day": 1500
-        }
-    },
-    {
-        "name": "Gemini 2.0 Flash-Lite",
-        "id": "gemini-2.0-flash-lite-001",
-        "description": "A cost-effective version of Gemini 2.0 Flash, optimized for high throughput and low latency, supporting the same input types and providing text output.",
-        "limits": {
-            "requests_per_minute": 30,
-            "tokens_per_minute": 1000000,
-            "requests_per_day": 1500
-        }
-    },
-    {
-        "name": "Gemini 1.5 Flash",
-        "id": "gemini-1.5-flash",
-        "description": "Offers fast and versatile performance across various tasks, with audio, images, videos, and text input and text output, also featuring a 2M token context window.",
-        "limits": {
-            "requests_per_minute": 15,
-            "tokens_per_minute": 250000,
-            "requests_per_day": 500
-        }
-    },
-]
-
-# Email loader
-def load_emails_from_temp(folder="temp"):
-    emails = []
-    if not os.path.exists(folder):
-        print("[!] Temp folder not found.")
-        return emails
-
-    for file in os.listdir(folder):
-        if file.endswith(".json"):
-            path = os.path.join(folder, file)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    emails.append(data)
-            except Exception as e:
-                print(f"[!] Error reading {file}: {e}")
-    print(f"[+] Loaded {len(emails)} emails from '{folder}'")
-    return emails
+# Configure the generative AI once per process
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+# Mailbox cache, retrieval, answer cache and rate limiting shared by all request threads
+service = AskService(ASK_MODELS, body_loader=fill_bodies)
+
+def error_response(error):
+    response = jsonify({"error": error.message})
+    for name, value in error.headers.items():
+        response.headers[name] = value
+    return response, error.status
+
+def traced(name, handler):
+    # Runs handler(data) under a trace when the request asks for one (or
+    # TRACE_FOLDER is set) and returns the trace id in X-Trace-Id. A
+    # streamed answer's trace ends when the stream closes.
+    data = request.json
+    trace = start_trace(name, data)
+    with use_trace(trace):
+        response = make_response(handler(data))
+    if trace is not None:
+        response.headers['X-Trace-Id'] = trace.id
+        if response.is_streamed:
+            response.call_on_close(lambda: finish_trace(trace))
+        else:
+            finish_trace(trace)
+    return response
 
 # Flask route for listing models
 @app.route('/models', methods=['GET'])
 def list_models():
-    return jsonify(GEMINI_MODELS)
+    return jsonify(ASK_MODELS)
 
 # Flask route for selecting a model and asking questions
 @app.route('/ask', methods=['POST'])
 def ask_gemini():
-    data = request.json
-
-    # Get model ID and query from the request
-    model_id = data.get('model_id')
-    query = data.get('query')
-    if not model_id or not query:
-        return jsonify({"error": "model_id and query are required"}), 400
-
-    # Load emails
-    emails = load_emails_from_temp()
-    if not emails:
-        return jsonify({"error": "No emails loaded"}), 400
+    return traced('ask', answer_question)
 
-    # Configure the generative AI
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    model = GenerativeModel(model_id)
-
-    # Generate the prompt
-    prompt = f"Based on these emails:\n\n{json.dumps(emails)}\n\nAnswer this:\n{query}"
+def answer_question(data):
+    if data.get('mode') == 'map_reduce':
+        return ask_map_reduce(data)
+    try:
+        ctx = service.prepare(data)
+        if ctx['cached'] is not None:
+            return jsonify({"response": ctx['cached'], "model_id": ctx['model_id'], "prompt": ctx['stats'], "cached": True})
+        used_model_id = service.acquire(ctx, data)
+    except AskError as e:
+        return error_response(e)
+    model = service.model(used_model_id, ctx)
 
     try:
         # Get response from the model
-        res = model.generate_content(prompt)
-        return jsonify({"response": res.text.strip()})
+        start = time.perf_counter()
+        res = model.generate_content(ctx['prompt'])
+        answer = res.text.strip()
+        record_latency('gemini_response', time.perf_counter() - start)
+        service.finish(ctx, answer)
+        return jsonify({"response": answer, "model_id": used_model_id, "prompt": ctx['stats'], "cached": False,
+                        "session_id": ctx.get('session_id')})
     except Exception as e:
+        if is_rate_limit_error(e):
+            service.scheduler.penalize(used_model_id)
+            return jsonify({"error": str(e)}), 429
         return jsonify({"error": str(e)}), 500
 
+def ask_map_reduce(data):
+    try:
+        return jsonify(service.map_reduce(data))
+    except AskError as e:
+        return error_response(e)
+    except Exception as e:
+        if is_rate_limit_error(e):
+            return jsonify({"error": str(e)}), 429
+        return jsonify({"error": str(e)}), 500
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+# Flask route for streaming answers as server-sent events
+@app.route('/ask/stream', methods=['POST'])
+def ask_gemini_stream():
+    return traced('ask_stream', stream_answer)
+
+def stream_answer(data):
+    try:
+        ctx = service.prepare(data)
+    except AskError as e:
+        return error_response(e)
+
+    if ctx['cached'] is not None:
+        def replay():
+            yield sse_event({"type": "meta", "model_id": ctx['model_id'], "prompt": ctx['stats'], "cached": True})
+            yield sse_event({"type": "token", "text": ctx['cached']})
+            yield sse_event({"type": "done", "ttft_ms": 0, "total_ms": 0})
+        return Response(replay(), mimetype='text/event-stream')
+
+    try:
+        used_model_id = service.acquire(ctx, data)
+    except AskError as e:
+        return error_response(e)
+    model = service.model(used_model_id, ctx)
+    # The stream runs after this view returns, outside its trace
+    trace = current_trace()
+
+    def generate():
+        yield sse_event({"type": "meta", "model_id": used_model_id, "prompt": ctx['stats'], "cached": False,
+                         "session_id": ctx.get('session_id')})
+        with use_trace(trace):
+            start = time.perf_counter()
+            ttft = None
+            parts = []
+            try:
+                for text in stream_text(model.generate_content(ctx['prompt'], stream=True)):
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                        record_latency('gemini_ttft', ttft)
+                    parts.append(text)
+                    yield sse_event({"type": "token", "text": text})
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    service.scheduler.penalize(used_model_id)
+                yield sse_event({"type": "error", "error": str(e)})
+                return
+
+            total = time.perf_counter() - start
+            record_latency('gemini_response', total)
+            service.finish(ctx, "".join(parts).strip())
+        yield sse_event({"type": "done", "ttft_ms": round((ttft or total) * 1000, 1), "total_ms": round(total * 1000, 1)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Flask route for metrics: stage latencies (retrieval, prompt building,
+# Gemini time-to-first-token and response), counters and prompt sizes
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify(metrics_snapshot())
+
+# Flask routes for the traces of recent traced questions
+@app.route('/traces', methods=['GET'])
+def list_traces():
+    return jsonify(recent_traces())
+
+@app.route('/traces/<trace_id>', methods=['GET'])
+def show_trace(trace_id):
+    trace = get_trace(trace_id)
+    if trace is None:
+        return jsonify({"error": "Unknown trace"}), 404
+    return jsonify(trace)
+
+# Flask route for rate limiter queue depth and wait times
+@app.route('/rate-limits', methods=['GET'])
+def rate_limits():
+    return jsonify(service.scheduler.metrics())
+
+# Flask route for answer cache statistics
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(service.answer_cache.stats())
+
+# Flask route for clearing the answer cache
+@app.route('/cache', methods=['DELETE'])
+def clear_cache():
+    service.answer_cache.clear()
+    return jsonify({"message": "Answer cache cleared"})
+
+# Flask route for listing the accounts questions can target
+@app.route('/accounts', methods=['GET'])
+def list_accounts():
+    return jsonify(service.account_list())
+
+# Flask route for listing open question sessions
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    return jsonify(service.sessions.list())
+
+# Flask route for ending a question session
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    if not service.sessions.delete(session_id):
+        return jsonify({"error": "Unknown or expired session"}), 404
+    return jsonify({"message": "Session ended"})
+
 # Flask route for cleanup
 @app.route('/cleanup', methods=['POST'])
 def cleanup_temp():
-    temp_dir = "temp"
+    # "account" or "accounts" pick what to delete, the default account otherwise
     try:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        return jsonify({"message": "Temp folder deleted"})
+        accounts = service.cleanup(request.get_json(silent=True) or {})
+        return jsonify({"message": "Temp folder deleted", "accounts": accounts})
+    except AskError as e:
+        return error_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,100 @@
+from rate_limiter import Scheduler
+
+# Gemini models with their free tier limits, shared by the command line
+# agent, both ask servers, the summarizer and the embedder. Only depends on
+# rate_limiter so importing it has no side effects.
+
+GEMINI_MODELS = [
+    {
+        "name": "Gemini 2.5 Flash Preview 04-17 (Experimental)",
+        "id": "gemini-1.5-flash-latest",
+        "description": "Optimized for adaptive thinking and cost efficiency, it accepts audio, images, videos, and text as input and generates text.",
+        "limits": {
+            "requests_per_minute": 10,
+            "tokens_per_minute": 250000,
+            "requests_per_day": 500
+        }
+    },
+    {
+        "name": "Gemini 2.5 Pro Experimental 03-25 (Experimental)",
+        "id": "gemini-1.5-pro-latest",
+        "description": "The most advanced reasoning Gemini model, excelling in multimodal understanding, coding, and world knowledge. It supports audio, images, videos, and text inputs and provides text outputs.",
+        "limits": {
+            "requests_per_minute": 5,
+            "tokens_per_minute": 250000,
+            "tokens_per_day": 1000000,
+            "requests_per_day": 25
+        }
+    },
+    {
+        "name": "Gemini 2.0 Flash",
+        "id": "gemini-2.0-flash-001",
+        "description": "A fast, next-generation multimodal model supporting audio, images, videos, and text inputs, with text, and experimental image outputs, and audio output coming soon. It's designed for diverse tasks and real-time streaming.",
+        "limits": {
+            "requests_per_minute": 15,
+            "tokens_per_minute": 1000000,
+            "requests_per_day": 1500
+        }
+    },
+    {
+        "name": "Gemini 2.0 Flash-Lite",
+        "id": "gemini-2.0-flash-lite-001",
+        "description": "A cost-effective version of Gemini 2.0 Flash, optimized for high throughput and low latency, supporting the same input types and providing text output.",
+        "limits": {
+            "requests_per_minute": 30,
+            "tokens_per_minute": 1000000,
+            "requests_per_day": 1500
+        }
+    },
+    {
+        "name": "Gemini 1.5 Flash",
+        "id": "gemini-1.5-flash",
+        "description": "Offers fast and versatile performance across various tasks, with audio, images, videos, and text input and text output, also featuring a 2M token context window.",
+        "limits": {
+            "requests_per_minute": 15,
+            "tokens_per_minute": 250000,
+            "requests_per_day": 500
+        }
+    },
+    {
+        "name": "Gemini 1.5 Flash-8B",
+        "id": "gemini-1.5-flash-8b",
+        "description": "Designed for high-volume and lower-intelligence tasks, it supports multimodal inputs and text output.",
+        "limits": {
+            "requests_per_minute": 15,
+            "tokens_per_minute": 250000,
+            "requests_per_day": 500
+        }
+    },
+    {
+        "name": "Gemma 3",
+        "id": "gemma-3",
+        "description": "A small-sized, lightweight open model for text generation and image understanding.",
+        "limits": {
+            "requests_per_minute": 30,
+            "tokens_per_minute": 15000,
+            "requests_per_day": 14400
+        }
+    },
+    {
+        "name": "Gemini Embedding Experimental 03-07",
+        "id": "embedding-001",
+        "description": "Creates text embeddings to measure the relatedness of text strings.",
+        "limits": {
+            "requests_per_minute": 5,
+            "requests_per_day": 100
+        }
+    }
+]
+
+# Models the ask servers answer with (and list under /models)
+ASK_MODEL_IDS = ['gemini-1.5-flash-latest', 'gemini-1.5-pro-latest', 'gemini-2.0-flash-001',
+                 'gemini-2.0-flash-lite-001', 'gemini-1.5-flash']
+ASK_MODELS = [m for m in GEMINI_MODELS if m['id'] in ASK_MODEL_IDS]
+
+def model_limits(model_id):
+    return next((m['limits'] for m in GEMINI_MODELS if m['id'] == model_id), {})
+
+# Paces every Gemini call of the process (questions, summaries, embeddings)
+# to the limits above
+scheduler = Scheduler(GEMINI_MODELS)
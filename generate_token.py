@@ -1,10 +1,18 @@
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+import os
 import json
+import argparse
+from accounts import DEFAULT_ACCOUNT, token_path
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--account', default=DEFAULT_ACCOUNT, help='Account name to store the token under')
+    args = parser.parse_args()
+    path = token_path(args.account)
+
     with open("credentials.json", "r") as f:
         creds_info = json.load(f)['web']
 
@@ -22,9 +30,11 @@ def main():
     flow.fetch_token(code=code)
     creds = flow.credentials
 
-    with open('token.json', 'w') as token_file:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as token_file:
         token_file.write(creds.to_json())
-    print("token.json generated successfully.")
+    print(f"{path} generated successfully.")
 
     service = build('gmail', 'v1', credentials=creds)
     profile = service.users().getProfile(userId='me').execute()
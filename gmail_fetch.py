@@ -0,0 +1,240 @@
+import os
+import time
+import random
+import socket
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import ModelLimiter
+from metrics import record_latency, count
+
+# Gmail accepts up to 100 calls in a single batch HTTP request
+BATCH_SIZE = 100
+MAX_WORKERS = 4
+
+# Transient failures (rate limits, server errors, dropped connections) are
+# retried with exponential backoff and jitter: BACKOFF_BASE, 2x, 4x, ... up
+# to BACKOFF_MAX seconds, MAX_RETRIES times
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_REASONS = ('ratelimitexceeded', 'userratelimitexceeded', 'backenderror')
+
+# Headers requested by metadata-only fetches
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date']
+
+# Gmail's per-user quota is 250 units per second (15000 per minute) and a
+# messages.get costs 5 units. Fetches are paced to it per mailbox, so
+# accounts syncing side by side each stay under their own quota instead of
+# running into 429s. GMAIL_USER_QUOTA=0 turns the pacing off.
+USER_QUOTA_PER_MINUTE = int(os.getenv('GMAIL_USER_QUOTA', 15000))
+MESSAGE_GET_UNITS = 5
+_quotas = {}
+_quotas_lock = threading.Lock()
+
+def user_quota(key):
+    # Shared quota limiter for one mailbox (keyed by its storage folder),
+    # None when pacing is off
+    if not USER_QUOTA_PER_MINUTE:
+        return None
+    with _quotas_lock:
+        if key not in _quotas:
+            _quotas[key] = ModelLimiter(f"gmail:{key}", {'tokens_per_minute': USER_QUOTA_PER_MINUTE})
+        return _quotas[key]
+
+def is_retryable(error):
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is not None:
+        status = int(status)
+        # Gmail also reports per-user rate limits as 403
+        return status in RETRY_STATUSES or (status == 403 and any(r in str(error).lower() for r in RETRY_REASONS))
+    return (isinstance(error, (ConnectionError, TimeoutError, socket.timeout))
+            or type(error).__name__ in ('TransportError', 'ServerNotFoundError'))
+
+def is_not_found(error):
+    # The message was deleted after it was listed, there is nothing to retry
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status is not None and int(status) == 404
+
+def backoff(attempt):
+    time.sleep(min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+def execute_with_retry(request, retries=MAX_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            return request.execute()
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            print(f"[!] Retrying after error ({attempt + 1}/{retries}): {e}")
+            count('gmail_retries')
+            backoff(attempt)
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def fetch_batch(service, message_ids, fmt='full', metadata_headers=None):
+    results = {}
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            results[request_id] = response
+
+    extra = {'metadataHeaders': metadata_headers or METADATA_HEADERS} if fmt == 'metadata' else {}
+    batch = service.new_batch_http_request(callback=callback)
+    for i, msg_id in enumerate(message_ids):
+        # Request ids must be unique within a batch, so key on position
+        batch.add(service.users().messages().get(userId='me', id=msg_id, format=fmt, **extra), request_id=str(i))
+    start = time.perf_counter()
+    batch.execute()
+    record_latency('gmail_batch', time.perf_counter() - start, messages=len(message_ids), format=fmt)
+    count('gmail_messages_fetched', len(results))
+    if errors:
+        count('gmail_message_errors', len(errors))
+
+    return [(msg_id, results.get(str(i)), errors.get(str(i))) for i, msg_id in enumerate(message_ids)]
+
+def fetch_batch_with_retry(service, message_ids, fmt='full', metadata_headers=None, retries=MAX_RETRIES):
+    # fetch_batch, resending only the messages that failed with a transient
+    # error (a batch can partly succeed and partly hit the rate limit)
+    results = {}
+    remaining = list(message_ids)
+    for attempt in range(retries + 1):
+        try:
+            fetched = fetch_batch(service, remaining, fmt, metadata_headers)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            count('gmail_retries')
+            backoff(attempt)
+            continue
+        retry = []
+        for msg_id, detail, error in fetched:
+            if error is not None and attempt < retries and is_retryable(error):
+                retry.append(msg_id)
+            else:
+                results[msg_id] = (msg_id, detail, error)
+        if not retry:
+            break
+        count('gmail_retries')
+        remaining = retry
+        backoff(attempt)
+    return [results[msg_id] for msg_id in message_ids]
+
+def fetch_messages(service_factory, message_ids, fmt='full', batch_size=BATCH_SIZE, max_workers=MAX_WORKERS,
+                   metadata_headers=None, quota=None):
+    # Yields (message_id, detail, error) in the order of message_ids.
+    # googleapiclient services are not thread-safe, so every worker thread
+    # builds its own through service_factory. quota (see user_quota) paces
+    # the batches to the mailbox's Gmail quota.
+    local = threading.local()
+
+    def run(chunk):
+        if not hasattr(local, 'service'):
+            local.service = service_factory()
+        if quota is not None:
+            start = time.perf_counter()
+            quota.acquire(len(chunk) * MESSAGE_GET_UNITS)
+            record_latency('gmail_quota_wait', time.perf_counter() - start)
+        try:
+            return fetch_batch_with_retry(local.service, chunk, fmt, metadata_headers)
+        except Exception as e:
+            return [(msg_id, None, e) for msg_id in chunk]
+
+    chunks = chunked(message_ids, min(batch_size, BATCH_SIZE))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Keep a bounded number of batches in flight so huge mailboxes don't
+        # queue every request up front
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(run, chunk))
+            if len(pending) >= max_workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def list_unique_messages(service, labels, max_results=None, checkpoint=None):
+    # Lists every label but keeps a single record per message id, merging the
+    # labels it was listed under. Returns the records in first-seen order and
+    # the raw number of listed entries. With a checkpoint, every page is
+    # saved as it arrives and an interrupted listing continues from the
+    # label and page token it stopped at.
+    messages = {}
+    total_listed = 0
+    start_label, start_token = None, None
+    if checkpoint is not None:
+        records, start_label, start_token, total_listed = checkpoint.listing()
+        messages = {record['id']: record for record in records}
+        if start_label is not None and start_label not in [label['id'] for label in labels]:
+            # The labels changed since the checkpoint, list everything again
+            print(f"Label {start_label} no longer exists, restarting the listing")
+            messages, total_listed, start_label, start_token = {}, 0, None, None
+            checkpoint.reset_listing()
+        elif messages:
+            print(f"Resuming listing at label {start_label} with {len(messages)} emails already listed")
+
+    for label in labels:
+        label_id = label['id']
+        label_name = label['name']
+        if start_label is not None:
+            # Labels before the checkpointed one are already listed
+            if label_id != start_label:
+                continue
+            next_page_token, start_label, start_token = start_token, None, None
+        else:
+            next_page_token = None
+        label_message_count = 0
+
+        print(f"Fetching emails for label: {label_name}")
+
+        while True:
+            start = time.perf_counter()
+            response = execute_with_retry(service.users().messages().list(
+                userId='me',
+                maxResults=500,
+                labelIds=[label_id],
+                pageToken=next_page_token
+            ))
+            record_latency('gmail_list_page', time.perf_counter() - start)
+
+            changed = []
+            for msg in response.get('messages', []):
+                record = messages.get(msg['id'])
+                if record is None:
+                    record = messages[msg['id']] = {'id': msg['id'], 'threadId': msg.get('threadId'), 'labels': []}
+                record['labels'].append(label_id)
+                changed.append(record)
+                label_message_count += 1
+            total_listed += len(changed)
+
+            next_page_token = response.get('nextPageToken', None)
+            if checkpoint is not None:
+                # Where to continue from: the next page, or the next label
+                if next_page_token:
+                    checkpoint.save_page(changed, label_id, next_page_token, total_listed)
+                else:
+                    following = next((l['id'] for l in labels[labels.index(label) + 1:]), None)
+                    checkpoint.save_page(changed, following, None, total_listed)
+            if not next_page_token or (max_results and len(messages) >= max_results):
+                break
+
+        print(f"Total emails for label {label_name}: {label_message_count}")
+
+        if max_results and len(messages) >= max_results:
+            break
+
+    unique = list(messages.values())
+    if max_results:
+        unique = unique[:max_results]
+    return unique, total_listed
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+from gmail_fetch import execute_with_retry
+from metrics import span
+
+# Incremental sync via Gmail history. The last synced historyId is kept in
+# the email store's metadata.
+
+# Interrupted full syncs older than this start over, like the history window
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+
+class HistoryExpired(Exception):
+    pass
+
+def get_history_id(service):
+    return execute_with_retry(service.users().getProfile(userId='me'))['historyId']
+
+def list_history_changes(service, start_history_id):
+    # Collapses every history record since start_history_id into the net set
+    # of added, deleted and relabeled message ids.
+    added = set()
+    deleted = set()
+    relabeled = {}
+    history_id = start_history_id
+    page_token = None
+
+    while True:
+        try:
+            with span('gmail_history_page'):
+                response = execute_with_retry(service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    pageToken=page_token,
+                    maxResults=500
+                ))
+        except Exception as e:
+            # Gmail answers 404 once startHistoryId is outside the history window
+            if getattr(getattr(e, 'resp', None), 'status', None) == 404:
+                raise HistoryExpired(str(e))
+            raise
+
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                msg_id = item['message']['id']
+                added.add(msg_id)
+                deleted.discard(msg_id)
+                relabeled.pop(msg_id, None)
+            for item in record.get('messagesDeleted', []):
+                msg_id = item['message']['id']
+                deleted.add(msg_id)
+                added.discard(msg_id)
+                relabeled.pop(msg_id, None)
+            for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                msg_id = item['message']['id']
+                if msg_id not in added and msg_id not in deleted:
+                    relabeled[msg_id] = item['message'].get('labelIds', [])
+
+        history_id = response.get('historyId', history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    return added, deleted, relabeled, history_id
+
+class SyncCheckpoint:
+    # Progress of a full download, so an interrupted sync resumes where it
+    # stopped: the listing position (label and page token), every message
+    # listed so far and the ids already written to the store. Kept in its
+    # own small sqlite file next to the store and cleared once the sync
+    # completes.
+    FILE = 'sync_checkpoint.db'
+
+    def __init__(self, folder='temp'):
+        os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(folder, self.FILE), timeout=30, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS listed (
+                pos INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE,
+                thread_id TEXT,
+                labels TEXT
+            );
+            CREATE TABLE IF NOT EXISTS fetched (id TEXT PRIMARY KEY);
+        """)
+        self.conn.commit()
+
+    def _get(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value)))
+
+    def pending(self):
+        started = self._get('started')
+        return started is not None and time.time() - started < CHECKPOINT_MAX_AGE
+
+    def begin(self, params):
+        # Returns True when resuming an interrupted sync with the same parameters
+        if self.pending() and self._get('params') == params:
+            return True
+        with self.conn:
+            self._reset()
+            self._set('params', params)
+            self._set('started', time.time())
+        return False
+
+    def _reset(self):
+        self.conn.execute("DELETE FROM state")
+        self.conn.execute("DELETE FROM listed")
+        self.conn.execute("DELETE FROM fetched")
+
+    def clear(self):
+        with self.conn:
+            self._reset()
+
+    @property
+    def history_id(self):
+        return self._get('historyId')
+
+    @history_id.setter
+    def history_id(self, value):
+        with self.conn:
+            self._set('historyId', value)
+
+    def listing(self):
+        # (records in listing order, label to continue from, its page token, entries listed)
+        records = [{'id': row[0], 'threadId': row[1], 'labels': json.loads(row[2])}
+                   for row in self.conn.execute("SELECT id, thread_id, labels FROM listed ORDER BY pos")]
+        return records, self._get('label'), self._get('pageToken'), self._get('totalListed', 0)
+
+    def save_page(self, records, label_id, page_token, total_listed):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO listed (id, thread_id, labels) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET labels = excluded.labels",
+                [(record['id'], record.get('threadId'), json.dumps(record['labels'])) for record in records]
+            )
+            self._set('label', label_id)
+            self._set('pageToken', page_token)
+            self._set('totalListed', total_listed)
+            if label_id is None:
+                self._set('listingDone', True)
+
+    def reset_listing(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM listed")
+            for key in ('label', 'pageToken', 'totalListed', 'listingDone'):
+                self.conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def listing_done(self):
+        return self._get('listingDone', False)
+
+    def finish_listing(self):
+        with self.conn:
+            self._set('listingDone', True)
+
+    def mark_fetched(self, msg_ids):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO fetched VALUES (?)", [(msg_id,) for msg_id in msg_ids])
+
+    def fetched_ids(self):
+        return {row[0] for row in self.conn.execute("SELECT id FROM fetched")}
+
+    def close(self):
+        self.conn.close()
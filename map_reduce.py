@@ -0,0 +1,147 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from prompt_builder import build_prompt, shard_emails, estimate_tokens, prompt_budget, truncate_tokens
+from answer_cache import cache_key
+from rate_limiter import is_rate_limit_error
+from metrics import record_latency, count, record_value, in_context
+
+# Map-reduce answering for questions that need more of the mailbox than one
+# prompt can hold ("summarize all my vendor correspondence this year").
+# Emails are split into token-budgeted shards, every shard is asked for the
+# facts relevant to the question (map, run concurrently and paced by the
+# shared scheduler), then the partial answers are combined (reduce, in
+# several rounds if they don't fit one prompt). Map and reduce results are
+# cached, so rerunning a question only calls the model for shards whose
+# emails changed.
+
+MAP_WORKERS = 4
+# Attempts per call when the model still answers 429 despite the pacing
+CALL_ATTEMPTS = 3
+# Longest a shard may queue for its rate limit
+MAX_QUEUE_WAIT = 600
+NOTHING = "NONE"
+
+MAP_TEMPLATE = (
+    "These emails are part {part} of {parts} of a mailbox:\n\n{{emails}}\n\n"
+    "Using only these emails, list everything relevant to the question below "
+    "(facts, names, dates, amounts, with the email subject and date). "
+    "Reply with only " + NOTHING + " if none of them are relevant.\n\nQuestion:\n{{query}}"
+)
+REDUCE_TEMPLATE = (
+    "Partial answers, each from a different part of a mailbox:\n\n{partials}\n\n"
+    "Combine them into one complete, deduplicated answer to this question:\n{query}"
+)
+NO_MATCH_ANSWER = "None of the emails are relevant to this question."
+
+def is_empty_partial(text):
+    return text.strip().strip('.').upper() == NOTHING
+
+class MapReduce:
+    def __init__(self, model_id, model, scheduler, limits=None, cache=None, max_tokens=None,
+                 workers=MAP_WORKERS, max_wait=MAX_QUEUE_WAIT, summaries=False):
+        self.model_id = model_id
+        self.model = model
+        self.scheduler = scheduler
+        self.limits = limits or {}
+        self.cache = cache
+        self.max_tokens = max_tokens
+        self.workers = workers
+        self.max_wait = max_wait
+        # Send emails that have an ingest-time summary as that summary
+        self.summaries = summaries
+        self.calls = 0
+        self.cached = 0
+
+    def _generate(self, prompt, tokens):
+        for attempt in range(CALL_ATTEMPTS):
+            self.scheduler.acquire(self.model_id, tokens, max_wait=self.max_wait)
+            start = time.perf_counter()
+            try:
+                self.calls += 1
+                answer = self.model.generate_content(prompt).text.strip()
+                record_latency('gemini_response', time.perf_counter() - start)
+                return answer
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == CALL_ATTEMPTS - 1:
+                    raise
+                self.scheduler.penalize(self.model_id)
+                count('gemini_retries')
+
+    def _cached_call(self, key, query, prompt, tokens):
+        if self.cache is not None:
+            answer = self.cache.get(key)
+            if answer is not None:
+                self.cached += 1
+                return answer
+        answer = self._generate(prompt, tokens)
+        if self.cache is not None:
+            self.cache.put(key, self.model_id, query, answer)
+        return answer
+
+    def map(self, query, shards):
+        def run(numbered):
+            i, shard = numbered
+            template = MAP_TEMPLATE.format(part=i + 1, parts=len(shards))
+            prompt, stats = build_prompt(query, shard, self.limits, self.max_tokens, template=template,
+                                         summaries=self.summaries)
+            record_value('prompt_tokens', stats['estimated_tokens'])
+            # Keyed on the shard's emails only, not its position, so shards
+            # survive mailbox changes elsewhere
+            key = cache_key(self.model_id, ('map-summaries:' if self.summaries else 'map:') + query, shard)
+            return self._cached_call(key, query, prompt, stats['estimated_tokens'])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(in_context(run), enumerate(shards)))
+
+    def reduce(self, query, partials):
+        # Combines partial answers, grouping them into prompts that fit the
+        # budget and repeating until one answer is left. Returns (answer, rounds).
+        budget = prompt_budget(self.limits, self.max_tokens) - estimate_tokens(REDUCE_TEMPLATE + query)
+        rounds = 0
+        while len(partials) > 1 or rounds == 0:
+            rounds += 1
+            # Cap every partial so at least two fit a prompt and each round
+            # shrinks the list
+            partials = [truncate_tokens(p, budget // 2 - 8) for p in partials]
+            groups = []
+            group = []
+            used = 0
+            for partial in partials:
+                cost = estimate_tokens(partial) + 4
+                if group and used + cost > budget:
+                    groups.append(group)
+                    group = []
+                    used = 0
+                group.append(partial)
+                used += cost
+            groups.append(group)
+
+            def run(group):
+                text = "\n\n".join(f"[{n + 1}] {p}" for n, p in enumerate(group))
+                prompt = REDUCE_TEMPLATE.format(partials=text, query=query)
+                key = cache_key(self.model_id, 'reduce:' + query,
+                                [{'id': str(n), 'body': p} for n, p in enumerate(group)])
+                return self._cached_call(key, query, prompt, estimate_tokens(prompt))
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                partials = list(pool.map(in_context(run), groups))
+        return partials[0], rounds
+
+    def answer(self, query, emails):
+        # Returns (answer, stats)
+        start = time.perf_counter()
+        reserve = estimate_tokens(MAP_TEMPLATE + query)
+        shards = shard_emails(emails, self.limits, self.max_tokens, reserve, self.summaries)
+        partials = self.map(query, shards)
+        relevant = [p for p in partials if not is_empty_partial(p)]
+        answer, rounds = self.reduce(query, relevant) if relevant else (NO_MATCH_ANSWER, 0)
+        stats = {
+            'emails': len(emails),
+            'shards': len(shards),
+            'relevant_shards': len(relevant),
+            'reduce_rounds': rounds,
+            'model_calls': self.calls,
+            'cached_calls': self.cached,
+            'seconds': round(time.perf_counter() - start, 2),
+        }
+        return answer, stats
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# Process-wide metrics, served on /metrics:
+# - latency: timing spans per stage (Gmail batches, store writes, retrieval,
+#   Gemini time-to-first-token and response), a bounded window of recent
+#   samples per name for the percentiles
+# - counters: running totals with a per-second rate over the last minute
+#   (messages fetched, bytes written, retries)
+# - values: distributions of sizes, e.g. prompt tokens
+# A request can also be traced: every span, counter and value recorded while
+# its trace is active is kept on the trace, which is served on /traces and,
+# with TRACE_FOLDER set, dumped as a Chrome trace file (chrome://tracing,
+# Perfetto).
+
+WINDOW = 1000
+RATE_WINDOW = 60
+RECENT_TRACES = 100
+# Set to trace every question and dump the traces to this folder
+TRACE_FOLDER = os.getenv('TRACE_FOLDER')
+
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=WINDOW)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def summary(self, scale=1000, unit='_ms'):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean' + unit: round(self.total / self.count * scale, 1),
+            'p50' + unit: round(samples[len(samples) // 2] * scale, 1),
+            'p95' + unit: round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * scale, 1),
+            'max' + unit: round(samples[-1] * scale, 1),
+        }
+
+class Counter:
+    def __init__(self):
+        self.total = 0
+        self.started = time.monotonic()
+        # [second, amount] buckets of the last RATE_WINDOW seconds
+        self.buckets = deque()
+
+    def add(self, amount):
+        self.total += amount
+        now = int(time.monotonic())
+        if self.buckets and self.buckets[-1][0] == now:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([now, amount])
+        while self.buckets[0][0] <= now - RATE_WINDOW:
+            self.buckets.popleft()
+
+    def summary(self):
+        now = time.monotonic()
+        recent = sum(amount for second, amount in self.buckets if second > now - RATE_WINDOW)
+        window = min(RATE_WINDOW, max(1.0, now - self.started))
+        return {'total': self.total, 'per_sec': round(recent / window, 2)}
+
+_latencies = {}
+_counters = {}
+_values = {}
+_lock = threading.Lock()
+
+class Trace:
+    def __init__(self, name, attrs=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs or {}
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.spans = []
+        self.counters = {}
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, seconds, attrs=None):
+        span = {'name': name, 'start_ms': round((start - self.start) * 1000, 2), 'ms': round(seconds * 1000, 2),
+                'thread': threading.get_ident()}
+        if attrs:
+            span['attrs'] = attrs
+        with self._lock:
+            self.spans.append(span)
+
+    def add_count(self, name, amount):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_value(self, name, value):
+        with self._lock:
+            self.values.setdefault(name, []).append(value)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'name': self.name,
+                'attrs': self.attrs,
+                'started': self.started,
+                'total_ms': round(self.seconds * 1000, 2) if self.seconds is not None else None,
+                'spans': sorted(self.spans, key=lambda span: span['start_ms']),
+                'counters': dict(self.counters),
+                'values': {name: list(values) for name, values in self.values.items()},
+            }
+
+    def chrome_events(self):
+        # Chrome trace event format, one complete ("X") event per span
+        trace = self.to_dict()
+        events = [{'name': trace['name'], 'ph': 'X', 'ts': 0, 'dur': round((trace['total_ms'] or 0) * 1000),
+                   'pid': 1, 'tid': 0, 'args': {**trace['attrs'], **trace['counters']}}]
+        for span in trace['spans']:
+            events.append({'name': span['name'], 'ph': 'X', 'ts': round(span['start_ms'] * 1000),
+                           'dur': round(span['ms'] * 1000), 'pid': 1, 'tid': span['thread'],
+                           'args': span.get('attrs', {})})
+        return {'traceEvents': events, 'otherData': {'id': trace['id'], 'started': trace['started'],
+                                                    'values': trace['values']}}
+
+_current = contextvars.ContextVar('trace', default=None)
+_traces = deque(maxlen=RECENT_TRACES)
+
+def current_trace():
+    return _current.get()
+
+def record_latency(name, seconds, **attrs):
+    with _lock:
+        if name not in _latencies:
+            _latencies[name] = LatencyStats()
+        _latencies[name].record(seconds)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, time.perf_counter() - seconds, seconds, attrs)
+
+def count(name, amount=1):
+    with _lock:
+        if name not in _counters:
+            _counters[name] = Counter()
+        _counters[name].add(amount)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_count(name, amount)
+
+def record_value(name, value):
+    with _lock:
+        if name not in _values:
+            _values[name] = LatencyStats()
+        _values[name].record(value)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_value(name, value)
+
+@contextmanager
+def span(name, **attrs):
+    # Times the block under name, also when it raises
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_latency(name, time.perf_counter() - start, **attrs)
+
+def start_trace(name, data=None):
+    # A trace for one request when it asks for one ("trace": true) or
+    # TRACE_FOLDER is set, else None. Activate it with use_trace.
+    if not TRACE_FOLDER and not (isinstance(data, dict) and data.get('trace')):
+        return None
+    attrs = {key: data[key] for key in ('model_id', 'mode', 'top_k', 'account', 'accounts', 'session_id')
+             if isinstance(data, dict) and key in data}
+    return Trace(name, attrs)
+
+@contextmanager
+def use_trace(trace):
+    # Records into trace within the block. Context variables follow
+    # asyncio.to_thread but not plain thread pools, see in_context.
+    if trace is None:
+        yield
+        return
+    token = _current.set(trace)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+def in_context(fn):
+    # Wraps fn to run in a copy of the caller's context, so work handed to
+    # a thread pool stays on the caller's trace
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+def finish_trace(trace):
+    if trace is None or trace.seconds is not None:
+        return
+    trace.seconds = time.perf_counter() - trace.start
+    _traces.append(trace)
+    if TRACE_FOLDER:
+        try:
+            os.makedirs(TRACE_FOLDER, exist_ok=True)
+            path = os.path.join(TRACE_FOLDER, f"{int(trace.started)}_{trace.name}_{trace.id}.json")
+            with open(path, 'w') as f:
+                json.dump(trace.chrome_events(), f)
+        except OSError as e:
+            print(f"[!] Could not write trace {trace.id}: {e}")
+
+def recent_traces():
+    return [{'id': trace.id, 'name': trace.name, 'started': trace.started,
+             'total_ms': round(trace.seconds * 1000, 2), 'spans': len(trace.spans)}
+            for trace in reversed(list(_traces))]
+
+def get_trace(trace_id):
+    for trace in list(_traces):
+        if trace.id == trace_id:
+            return trace.to_dict()
+    return None
+
+def reset():
+    with _lock:
+        _latencies.clear()
+        _counters.clear()
+        _values.clear()
+    _traces.clear()
+
+def snapshot():
+    with _lock:
+        return {
+            'latency': {name: stats.summary() for name, stats in _latencies.items()},
+            'counters': {name: counter.summary() for name, counter in _counters.items()},
+            'values': {name: stats.summary(1, '') for name, stats in _values.items()},
+        }
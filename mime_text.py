@@ -0,0 +1,140 @@
+import re
+import base64
+import binascii
+from html import unescape
+
+# Text extraction from Gmail message payloads. The payload is walked
+# recursively: multipart/alternative contributes its text/plain version
+# (HTML only when there is no plain text), other multiparts contribute every
+# text part that isn't an attachment. HTML is converted to compact text and
+# bodies are capped, decoding only as much base64 as the cap needs.
+# Attachments are only described (name, type, size) from the payload; their
+# bytes are never downloaded.
+
+MAX_BODY_CHARS = 20000
+# HTML shrinks a lot once tags are dropped, so allow more raw input for it
+HTML_RAW_FACTOR = 4
+# base64 is decoded in slices of this many characters (a multiple of 4)
+DECODE_CHUNK = 64 * 1024
+
+BLOCK_TAGS = ('p', 'div', 'br', 'li', 'tr', 'table', 'ul', 'ol', 'blockquote', 'pre',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'section', 'article', 'header', 'footer')
+SKIP_TAGS = ('script', 'style', 'head', 'title', 'noscript', 'template')
+SKIP_RE = re.compile(r'<(%s)\b.*?</\1\s*>' % '|'.join(SKIP_TAGS), re.IGNORECASE | re.DOTALL)
+COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+BLOCK_RE = re.compile(r'</?(?:%s)\b[^>]*>' % '|'.join(BLOCK_TAGS), re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]*>')
+CHARSET_RE = re.compile(r'charset="?([\w.:-]+)"?', re.IGNORECASE)
+SPACES_RE = re.compile(r'[ \t\r\f\v\xa0]+')
+BLANK_LINES_RE = re.compile(r' ?\n[ \n]*\n ?')
+LINE_EDGES_RE = re.compile(r' ?\n ?')
+
+def compact_whitespace(text):
+    text = SPACES_RE.sub(' ', text)
+    text = BLANK_LINES_RE.sub('\n\n', text)
+    return LINE_EDGES_RE.sub('\n', text).strip()
+
+def html_to_text(html):
+    # Regex passes rather than a full parser: mail HTML is often malformed
+    # and this runs on every synced message
+    text = COMMENT_RE.sub('', html)
+    text = SKIP_RE.sub('', text)
+    text = BLOCK_RE.sub('\n', text)
+    text = TAG_RE.sub('', text)
+    return compact_whitespace(unescape(text))
+
+def _header(part, name):
+    name = name.lower()
+    return next((h['value'] for h in part.get('headers', []) if h.get('name', '').lower() == name), '')
+
+def _charset(part):
+    match = CHARSET_RE.search(_header(part, 'Content-Type'))
+    return match.group(1) if match else 'utf-8'
+
+def _is_attachment(part):
+    return bool(part.get('filename')) or _header(part, 'Content-Disposition').lower().startswith('attachment')
+
+def decode_data(data, limit=None):
+    # Decodes base64url data, stopping after roughly limit bytes
+    if limit is not None:
+        data = data[:(limit // 3 + 1) * 4]
+    chunks = []
+    for start in range(0, len(data), DECODE_CHUNK):
+        piece = data[start:start + DECODE_CHUNK]
+        try:
+            chunks.append(base64.urlsafe_b64decode(piece + '=' * (-len(piece) % 4)))
+        except (binascii.Error, ValueError):
+            break
+    return b''.join(chunks)
+
+def _part_text(part, max_chars):
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ''
+    is_html = part.get('mimeType', '').lower() == 'text/html'
+    raw = decode_data(data, max_chars * (HTML_RAW_FACTOR if is_html else 1))
+    try:
+        text = raw.decode(_charset(part), errors='ignore')
+    except LookupError:
+        text = raw.decode('utf-8', errors='ignore')
+    return html_to_text(text) if is_html else text
+
+def _has_plain(part):
+    if part.get('mimeType', '').lower() == 'text/plain':
+        return not _is_attachment(part)
+    return any(_has_plain(child) for child in part.get('parts', []))
+
+def _walk(part, out, budget):
+    # Appends the text of part to out, returns the characters still allowed
+    if budget <= 0:
+        return budget
+    mime = part.get('mimeType', '').lower()
+    children = part.get('parts', [])
+
+    if mime == 'multipart/alternative' and children:
+        # One version is enough: the plain one if there is any
+        chosen = next((c for c in children if _has_plain(c)), None)
+        if chosen is None:
+            chosen = next((c for c in reversed(children) if c.get('mimeType', '').lower() == 'text/html'
+                           or c.get('parts')), children[-1])
+        return _walk(chosen, out, budget)
+
+    if children:
+        for child in children:
+            budget = _walk(child, out, budget)
+        return budget
+
+    if _is_attachment(part) or mime not in ('text/plain', 'text/html', ''):
+        return budget
+    text = _part_text(part, budget)
+    if text:
+        if out:
+            out.append('\n\n')
+            budget -= 2
+        text = text[:budget]
+        out.append(text)
+        budget -= len(text)
+    return budget
+
+def decode_message(payload, max_chars=MAX_BODY_CHARS):
+    out = []
+    _walk(payload, out, max_chars)
+    return ''.join(out)
+
+def _collect_attachments(part, found):
+    children = part.get('parts', [])
+    for child in children:
+        _collect_attachments(child, found)
+    if children:
+        return
+    mime = part.get('mimeType', '').lower()
+    body = part.get('body', {})
+    if _is_attachment(part) or (body.get('attachmentId') and mime not in ('text/plain', 'text/html')):
+        found.append({'filename': part.get('filename') or '', 'mime_type': mime, 'size': body.get('size', 0)})
+
+def list_attachments(payload):
+    # [{'filename', 'mime_type', 'size'}] for every attachment and inline
+    # file of the message, in payload order
+    found = []
+    _collect_attachments(payload, found)
+    return found
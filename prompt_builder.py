@@ -0,0 +1,133 @@
+import re
+import json
+
+# Builds prompts that fit a per-model token budget: emails are compacted,
+# packed in relevance order and long bodies are truncated, so a request is
+# never rejected for its size and input tokens stay predictable.
+
+# Rough estimate for Gemini tokenizers on English mail text
+CHARS_PER_TOKEN = 4
+# Context window used when a model entry doesn't declare one
+DEFAULT_INPUT_TOKEN_LIMIT = 1000000
+# Share of the budget actually used, the estimate is only approximate
+SAFETY_MARGIN = 0.8
+# Upper bound for one prompt regardless of model, keeps latency and cost in check
+MAX_PROMPT_TOKENS = 100000
+MAX_BODY_TOKENS = 1000
+MIN_BODY_TOKENS = 50
+
+PROMPT_TEMPLATE = "Based on these emails:\n\n{emails}\n\nAnswer this:\n{query}"
+PROMPT_FIELDS = ['subject', 'from', 'to', 'date', 'body']
+# Structured fields of an ingest-time summary (see email_summaries.py)
+SUMMARY_LIST_FIELDS = ['amounts', 'due_dates', 'action_items']
+# Attachments listed per email, by name, type and size
+MAX_ATTACHMENTS = 10
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def prompt_budget(limits=None, max_tokens=None):
+    limits = limits or {}
+    budget = min(limits.get('input_token_limit', DEFAULT_INPUT_TOKEN_LIMIT),
+                 limits.get('tokens_per_minute', DEFAULT_INPUT_TOKEN_LIMIT),
+                 max_tokens or MAX_PROMPT_TOKENS)
+    return int(budget * SAFETY_MARGIN)
+
+def compact_text(text):
+    # Drop quoted reply lines and collapse whitespace runs
+    lines = [line for line in text.splitlines() if not line.lstrip().startswith('>')]
+    return re.sub(r'\s+', ' ', ' '.join(lines)).strip()
+
+def truncate_tokens(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + ' [...]'
+
+def describe_attachment(attachment):
+    size = attachment.get('size') or 0
+    size = f"{size / 1e6:.1f} MB" if size >= 1e6 else f"{max(1, round(size / 1e3))} KB"
+    return f"{attachment.get('filename') or 'unnamed'} ({attachment.get('mime_type') or 'unknown'}, {size})"
+
+def compact_email(email, body_tokens=MAX_BODY_TOKENS, summaries=False):
+    compact = {field: email[field] for field in PROMPT_FIELDS[:-1] if email.get(field)}
+    if email.get('account'):
+        # Set when a question spans several accounts
+        compact['account'] = email['account']
+    if email.get('attachments'):
+        compact['attachments'] = [describe_attachment(a) for a in email['attachments'][:MAX_ATTACHMENTS]]
+    summary = email.get('summary') if summaries else None
+    if summary:
+        # The summary and extracted fields stand in for the body
+        compact['summary'] = summary.get('text', '')
+        compact['category'] = summary.get('category', 'other')
+        compact.update({field: summary[field] for field in SUMMARY_LIST_FIELDS if summary.get(field)})
+        return compact
+    body = compact_text(email.get('body') or email.get('snippet') or '')
+    if body:
+        compact['body'] = truncate_tokens(body, body_tokens)
+    return compact
+
+def dump_compact(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+def pack_emails(emails, budget, summaries=False):
+    # Compacts emails in order until budget tokens are used, shrinking the
+    # last bodies to fit. Returns (packed, bodies truncated, tokens used).
+    used = 0
+    packed = []
+    truncated = 0
+    for email in emails:
+        remaining = budget - used
+        item = compact_email(email, summaries=summaries)
+        cost = estimate_tokens(dump_compact(item)) + 1
+        if cost > remaining:
+            # Shrink the body to whatever room is left, or stop packing
+            header_cost = cost - estimate_tokens(item.get('body', ''))
+            room = remaining - header_cost
+            if room < MIN_BODY_TOKENS or 'body' not in item:
+                break
+            item = compact_email(email, room)
+            cost = estimate_tokens(dump_compact(item)) + 1
+            truncated += 1
+        packed.append(item)
+        used += cost
+    return packed, truncated, used
+
+def build_prompt(query, emails, limits=None, max_tokens=None, template=PROMPT_TEMPLATE, summaries=False):
+    # Returns the prompt and packing stats. emails must be in relevance order.
+    # With summaries, emails that have one are sent as their summary.
+    budget = prompt_budget(limits, max_tokens)
+    query = truncate_tokens(query, budget // 4)
+    used = estimate_tokens(template.format(emails='[]', query=query))
+    packed, truncated, _ = pack_emails(emails, budget - used, summaries)
+
+    prompt = template.format(emails=dump_compact(packed), query=query)
+    stats = {
+        'emails_included': len(packed),
+        'emails_total': len(emails),
+        'bodies_truncated': truncated,
+        'estimated_tokens': estimate_tokens(prompt),
+        'budget_tokens': budget,
+    }
+    return prompt, stats
+
+def shard_emails(emails, limits=None, max_tokens=None, reserve=0, summaries=False):
+    # Splits emails into consecutive shards that each fit one prompt, for
+    # questions that need more emails than a single prompt can hold.
+    # reserve is the token cost of the template and question.
+    budget = prompt_budget(limits, max_tokens) - reserve
+    shards = []
+    shard = []
+    used = 0
+    for email in emails:
+        cost = estimate_tokens(dump_compact(compact_email(email, summaries=summaries))) + 1
+        if shard and used + cost > budget:
+            shards.append(shard)
+            shard = []
+            used = 0
+        shard.append(email)
+        used += cost
+    if shard:
+        shards.append(shard)
+    return shards
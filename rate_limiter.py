@@ -0,0 +1,212 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from metrics import count
+
+# Client-side pacing driven by the "limits" blocks in GEMINI_MODELS (see
+# gemini_models.py). Every model gets token buckets for its per-minute and
+# per-day request and token limits; callers block in acquire() until the call
+# fits instead of firing requests and collecting 429s. One Scheduler is shared
+# by all threads of a process.
+
+PERIODS = {
+    'requests_per_minute': 60,
+    'tokens_per_minute': 60,
+    'requests_per_day': 86400,
+    'tokens_per_day': 86400,
+}
+# Waits longer than this make the scheduler look for another model when fallback is allowed
+FALLBACK_WAIT = 2.0
+
+class RateLimitExceeded(Exception):
+    def __init__(self, model_id, wait):
+        super().__init__(f"Rate limit for {model_id} needs a {wait:.1f}s wait")
+        self.model_id = model_id
+        self.wait = wait
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = float(capacity)
+        self.rate = capacity / float(period)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def drain(self, now):
+        # Used after a 429: the server says we are out of budget
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+class ModelLimiter:
+    def __init__(self, model_id, limits=None):
+        self.model_id = model_id
+        self.buckets = {name: TokenBucket(limit, PERIODS[name])
+                        for name, limit in (limits or {}).items() if name in PERIODS and limit}
+        self._cond = threading.Condition()
+        self.waiting = 0
+        self.granted = 0
+        self.total_wait = 0.0
+        self.waits = deque(maxlen=1000)
+
+    def _cost(self, name, tokens):
+        return tokens if name.startswith('tokens') else 1
+
+    def _wait_time(self, tokens, now):
+        return max((bucket.wait_time(self._cost(name, tokens), now) for name, bucket in self.buckets.items()),
+                   default=0.0)
+
+    def wait_time(self, tokens=0):
+        with self._cond:
+            return self._wait_time(tokens, time.monotonic())
+
+    def acquire(self, tokens=0, max_wait=None):
+        # Blocks until a call with this many input tokens fits every bucket.
+        # Raises RateLimitExceeded instead if that would take longer than max_wait.
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._wait_time(tokens, now)
+                    if wait <= 0:
+                        break
+                    if max_wait is not None and now - start + wait > max_wait:
+                        raise RateLimitExceeded(self.model_id, wait)
+                    self._cond.wait(wait)
+                for name, bucket in self.buckets.items():
+                    bucket.take(self._cost(name, tokens))
+            finally:
+                self.waiting -= 1
+            waited = time.monotonic() - start
+            self.granted += 1
+            self.total_wait += waited
+            self.waits.append(waited)
+            self._cond.notify_all()
+        return waited
+
+    def try_acquire(self, tokens=0):
+        # Non-blocking: takes the budget and returns 0, or returns how long
+        # the caller should wait before trying again
+        with self._cond:
+            wait = self._wait_time(tokens, time.monotonic())
+            if wait > 0:
+                return wait
+            for name, bucket in self.buckets.items():
+                bucket.take(self._cost(name, tokens))
+            self.granted += 1
+            return 0.0
+
+    async def acquire_async(self, tokens=0, max_wait=None):
+        # acquire() for event loops: sleeps on the loop instead of blocking a thread
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self.try_acquire(tokens)
+                if wait <= 0:
+                    break
+                if max_wait is not None and time.monotonic() - start + wait > max_wait:
+                    raise RateLimitExceeded(self.model_id, wait)
+                await asyncio.sleep(wait)
+        finally:
+            with self._cond:
+                self.waiting -= 1
+        waited = time.monotonic() - start
+        with self._cond:
+            self.total_wait += waited
+            self.waits.append(waited)
+        return waited
+
+    def penalize(self):
+        with self._cond:
+            now = time.monotonic()
+            for name, bucket in self.buckets.items():
+                if name.endswith('per_minute'):
+                    bucket.drain(now)
+
+    def metrics(self):
+        with self._cond:
+            waits = sorted(self.waits)
+            return {
+                'queue_depth': self.waiting,
+                'granted': self.granted,
+                'total_wait_seconds': round(self.total_wait, 3),
+                'wait_p50_seconds': round(waits[len(waits) // 2], 3) if waits else 0.0,
+                'wait_p95_seconds': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                'headroom': {name: int(bucket.level) for name, bucket in self.buckets.items()},
+            }
+
+class Scheduler:
+    def __init__(self, models):
+        self.models = models
+        self.limiters = {m['id']: ModelLimiter(m['id'], m.get('limits')) for m in models}
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def limiter(self, model_id):
+        with self._lock:
+            if model_id not in self.limiters:
+                self.limiters[model_id] = ModelLimiter(model_id)
+            return self.limiters[model_id]
+
+    def pick(self, model_id, tokens=0, candidates=None):
+        # The requested model, or the text model with the shortest wait if
+        # the requested one would have to wait more than FALLBACK_WAIT.
+        # candidates limits the choice to some model ids.
+        if self.limiter(model_id).wait_time(tokens) <= FALLBACK_WAIT:
+            return model_id
+        # Only text models that can take a prompt of this size
+        candidates = [m['id'] for m in self.models if 'embedding' not in m['id']
+                      and (candidates is None or m['id'] in candidates)
+                      and m.get('limits', {}).get('tokens_per_minute', tokens) >= tokens]
+        best = min(candidates, key=lambda m: self.limiter(m).wait_time(tokens), default=model_id)
+        if best != model_id and self.limiter(best).wait_time(tokens) < self.limiter(model_id).wait_time(tokens):
+            with self._lock:
+                self.fallbacks += 1
+            return best
+        return model_id
+
+    def acquire(self, model_id, tokens=0, fallback=False, max_wait=None, candidates=None):
+        # Returns the id of the model the caller should use
+        if fallback:
+            model_id = self.pick(model_id, tokens, candidates)
+        self.limiter(model_id).acquire(tokens, max_wait)
+        return model_id
+
+    async def acquire_async(self, model_id, tokens=0, fallback=False, max_wait=None, candidates=None):
+        if fallback:
+            model_id = self.pick(model_id, tokens, candidates)
+        await self.limiter(model_id).acquire_async(tokens, max_wait)
+        return model_id
+
+    def penalize(self, model_id):
+        # The model answered 429 despite the pacing
+        count('gemini_rate_limited')
+        self.limiter(model_id).penalize()
+
+    def metrics(self):
+        with self._lock:
+            limiters = dict(self.limiters)
+            fallbacks = self.fallbacks
+        return {
+            'fallbacks': fallbacks,
+            'models': {model_id: limiter.metrics() for model_id, limiter in limiters.items()},
+        }
+
+def is_rate_limit_error(error):
+    # google.api_core raises ResourceExhausted (HTTP 429) when over quota
+    return getattr(error, 'code', None) == 429 or type(error).__name__ == 'ResourceExhausted'
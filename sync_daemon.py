@@ -0,0 +1,317 @@
+import os
+import hmac
+import json
+import time
+import base64
+import threading
+from gmail_fetch import execute_with_retry, is_retryable, user_quota
+from email_store import open_store
+from metrics import record_latency, count
+
+# Keeps a mailbox in sync in the background, so questions are answered from
+# fresh mail without anyone running a sync first. Each poll is a cheap
+# getProfile probe: only when the mailbox's historyId moved past the stored
+# one does a sync job run (history deltas, see gmail_sync.py), through the
+# same JobManager as /download-emails so there is still only one sync per
+# account at a time. Emails and the search index are updated in place; the
+# ask servers pick the changes up on their next mailbox refresh.
+#
+# Polling is adaptive: it starts every MIN_INTERVAL seconds, slows down
+# (doubling up to MAX_INTERVAL) while nothing changes and speeds up again as
+# soon as something does. With push notifications (Gmail watch plus a
+# Pub/Sub push subscription posting to /gmail/push, or the local stand-in's
+# subscribe()) changes are synced as they are announced and polling only
+# runs every MAX_INTERVAL as a safety net.
+#
+# Backpressure: notifications arriving during a sync collapse into one
+# follow-up sync, syncs start at most every MIN_GAP seconds, polls wait
+# while the account's Gmail quota is used up by other work, and failures
+# back off (rate limits straight to MAX_INTERVAL).
+
+MIN_INTERVAL = float(os.getenv('SYNC_MIN_INTERVAL', 15))
+MAX_INTERVAL = float(os.getenv('SYNC_MAX_INTERVAL', 600))
+MIN_GAP = 2.0
+# Pub/Sub topic for Gmail push notifications, polling only when unset
+PUSH_TOPIC = os.getenv('GMAIL_PUSH_TOPIC')
+# /gmail/push only takes notifications that prove where they come from:
+# the shared secret put in the push subscription's endpoint URL
+# (?token=...), and/or the OIDC token Pub/Sub signs for subscriptions with
+# push authentication (audience as configured there, optionally from one
+# service account). Every configured check has to pass; with none
+# configured notifications are refused.
+PUSH_TOKEN = os.getenv('GMAIL_PUSH_TOKEN')
+PUSH_AUDIENCE = os.getenv('GMAIL_PUSH_AUDIENCE')
+PUSH_SERVICE_ACCOUNT = os.getenv('GMAIL_PUSH_SERVICE_ACCOUNT')
+# Gmail watches expire after 7 days, they are renewed well before
+WATCH_RENEW = 24 * 3600
+# Quota units of a poll (getProfile) and of a small history sync
+POLL_UNITS = 10
+
+class SyncFailed(Exception):
+    def __init__(self, message, cause=None):
+        super().__init__(message)
+        self.cause = cause
+
+def decode_push(envelope):
+    # Gmail notification ({'emailAddress', 'historyId'}) from a Pub/Sub push
+    # request body, None when it isn't one
+    try:
+        data = json.loads(base64.b64decode(envelope['message']['data']))
+        return {'emailAddress': data['emailAddress'], 'historyId': int(data['historyId'])}
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def verify_push(token=None, authorization=None, secret=PUSH_TOKEN, audience=PUSH_AUDIENCE,
+                service_account=PUSH_SERVICE_ACCOUNT):
+    # True when a push request carries the shared secret (token, from the
+    # query string) and/or a valid Pub/Sub OIDC token (Authorization header)
+    if not secret and not audience:
+        return False
+    if secret and not (token and hmac.compare_digest(token.encode('utf-8'), secret.encode('utf-8'))):
+        return False
+    if audience:
+        scheme, _, jwt = (authorization or '').partition(' ')
+        if scheme.lower() != 'bearer' or not jwt:
+            return False
+        try:
+            from google.oauth2 import id_token
+            from google.auth.transport.requests import Request
+            claims = id_token.verify_oauth2_token(jwt, Request(), audience)
+        except Exception:
+            return False
+        if service_account and not (claims.get('email') == service_account and claims.get('email_verified')):
+            return False
+    return True
+
+class SyncDaemon:
+    def __init__(self, account, jobs, service_factory, folder, params=None, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, topic=PUSH_TOPIC, min_gap=MIN_GAP):
+        self.account = account
+        # jobs.start(account, params) runs the sync, see sync_jobs.JobManager
+        self.jobs = jobs
+        self.service_factory = service_factory
+        self.folder = folder
+        self.params = dict(params or {}, daemon=True)
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.topic = topic
+        self.min_gap = min_gap
+        self.interval = min_interval
+        self.email_address = None
+        self.watch_expires = None
+        self._watch_due = 0.0
+        self.status = 'stopped'
+        # historyId of the store after the last pass
+        self.history_id = None
+        # Latest historyId announced by a notification and when the first
+        # notification not yet synced arrived
+        self._announced = None
+        self._announced_at = None
+        self.stats = {'polls': 0, 'syncs': 0, 'changes': 0, 'notifications': 0, 'notifications_skipped': 0,
+                      'deferred': 0, 'errors': 0}
+        self.last_poll = None
+        self.last_sync = None
+        self.last_change = None
+        self.last_error = None
+        # Recent syncs, newest last
+        self.passes = []
+        self._last_pass = 0.0
+        self._failures = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def push(self):
+        return self.watch_expires is not None and self.watch_expires > time.time()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            # First poll right away
+            self._wake.set()
+            self._thread = threading.Thread(target=self._run, name=f"sync-daemon-{self.account}", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self, notification=None):
+        # A push notification for this mailbox; historyIds already synced
+        # are dropped, the rest wake the daemon up
+        history_id = (notification or {}).get('historyId')
+        with self._lock:
+            self.stats['notifications'] += 1
+            stored = self.history_id
+            if history_id is not None and stored is not None and int(history_id) <= stored:
+                self.stats['notifications_skipped'] += 1
+                return False
+            if history_id is not None:
+                self._announced = max(int(history_id), self._announced or 0)
+            if self._announced_at is None:
+                self._announced_at = time.monotonic()
+        count('sync_daemon_notifications')
+        self._wake.set()
+        return True
+
+    def _next_wait(self):
+        if self.push:
+            return self.max_interval
+        return self.interval
+
+    def _run(self):
+        self.status = 'starting'
+        store = open_store(self.folder)
+        service = None
+        try:
+            while not self._stop.is_set():
+                if service is None:
+                    try:
+                        service = self.service_factory()
+                        profile = execute_with_retry(service.users().getProfile(userId='me'))
+                        self.email_address = profile.get('emailAddress')
+                    except Exception as e:
+                        service = None
+                        self._failed(e)
+                        self._stop.wait(self.interval)
+                        continue
+                self._renew_watch(service)
+                self.status = 'idle'
+                self._wake.wait(self._next_wait())
+                # Syncs start at most every min_gap seconds; notifications
+                # arriving meanwhile are folded into this one
+                gap = self._last_pass + self.min_gap - time.monotonic()
+                if self._stop.is_set() or (gap > 0 and self._stop.wait(gap)):
+                    break
+                self._wake.clear()
+                if not self._take_quota():
+                    break
+                try:
+                    self._poll(service, store)
+                    self._failures = 0
+                except Exception as e:
+                    self._failed(e)
+        finally:
+            self.status = 'stopped'
+            store.close()
+
+    def _take_quota(self):
+        # Waits until the account's Gmail quota has room for a poll, leaving
+        # it to syncs and body downloads already using it. False when stopped.
+        quota = user_quota(self.folder)
+        if quota is None:
+            return True
+        wait = quota.try_acquire(POLL_UNITS)
+        while wait > 0:
+            self.stats['deferred'] += 1
+            if self._stop.wait(wait):
+                return False
+            wait = quota.try_acquire(POLL_UNITS)
+        return True
+
+    def _renew_watch(self, service):
+        # Failed watches are retried at the next renewal, polling meanwhile
+        if not self.topic or time.time() < self._watch_due:
+            return
+        self._watch_due = time.time() + WATCH_RENEW
+        try:
+            response = execute_with_retry(service.users().watch(userId='me', body={'topicName': self.topic}))
+            self.watch_expires = int(response['expiration']) / 1000
+            print(f"[+] [{self.account}] Watching for changes on {self.topic}")
+        except Exception as e:
+            print(f"[!] [{self.account}] Push notifications unavailable, polling instead: {e}")
+            self.watch_expires = None
+
+    def _poll(self, service, store):
+        start = time.monotonic()
+        self._last_pass = start
+        self.status = 'polling'
+        with self._lock:
+            announced, announced_at = self._announced, self._announced_at
+            self._announced = self._announced_at = None
+        stored = store.get_meta('historyId')
+        stored = int(stored) if stored is not None else None
+        self.history_id = stored
+        if announced is not None and stored is not None and announced <= stored:
+            # Already synced by an earlier pass
+            self.last_poll = time.time()
+            return 0
+        latest = int(execute_with_retry(service.users().getProfile(userId='me'))['historyId'])
+        self.stats['polls'] += 1
+        self.last_poll = time.time()
+        count('sync_daemon_polls')
+        if stored is not None and latest <= stored:
+            self._adapt(0)
+            return 0
+
+        self.status = 'syncing'
+        job, _ = self.jobs.start(self.account, self.params)
+        job.wait()
+        if job.status == 'failed':
+            raise SyncFailed(job.error or 'sync failed', job.exception)
+        changes = job.counts['downloaded'] + job.counts['deleted'] + job.counts['relabeled']
+        stored = store.get_meta('historyId')
+        self.history_id = int(stored) if stored is not None else None
+        seconds = time.monotonic() - start
+        self.stats['syncs'] += 1
+        self.stats['changes'] += changes
+        self.last_sync = time.time()
+        if changes:
+            self.last_change = self.last_sync
+        self.passes.append({'finished': self.last_sync, 'seconds': round(seconds, 3), 'changes': changes,
+                            'job': job.id})
+        del self.passes[:-100]
+        record_latency('sync_daemon_sync', seconds, changes=changes)
+        count('sync_daemon_changes', changes)
+        if announced_at is not None:
+            # Notification to mail in the store
+            record_latency('sync_push_lag', time.monotonic() - announced_at)
+        self._adapt(changes)
+        return changes
+
+    def _adapt(self, changes):
+        if changes:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+
+    def _failed(self, error):
+        self._failures += 1
+        self.stats['errors'] += 1
+        self.last_error = str(error)
+        count('sync_daemon_errors')
+        cause = getattr(error, 'cause', None) or error
+        if is_retryable(cause):
+            # Rate limited or Gmail unavailable: give it room
+            self.interval = self.max_interval
+        else:
+            self.interval = min(self.max_interval, self.min_interval * 2 ** self._failures)
+        print(f"[!] [{self.account}] Background sync failed, next try in {self.interval:.0f}s: {error}")
+
+    def to_dict(self):
+        return {
+            'account': self.account,
+            'email_address': self.email_address,
+            'status': self.status,
+            'mode': 'push' if self.push else 'poll',
+            'interval_seconds': round(self._next_wait(), 1),
+            'history_id': self.history_id,
+            'last_poll': self.last_poll,
+            'last_sync': self.last_sync,
+            'last_change': self.last_change,
+            'last_error': self.last_error,
+            'watch_expires': self.watch_expires,
+            **self.stats,
+        }
+
+def route_notification(daemons, notification):
+    # Hands a notification to the daemon of its mailbox, False when none matches
+    for daemon in daemons:
+        if daemon.email_address and daemon.email_address.lower() == notification['emailAddress'].lower():
+            return daemon.notify(notification)
+    return False
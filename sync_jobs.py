@@ -0,0 +1,179 @@
+import re
+import time
+import uuid
+import threading
+from collections import deque
+
+# Background sync jobs for the download server. A job runs a sync generator
+# in its own thread and keeps its log lines and progress counters, so any
+# number of clients can poll the status or follow the log while it runs.
+# Only one job runs per mailbox at a time; starting another one attaches to
+# the running job instead. Jobs past the manager's max_running wait queued.
+
+# Log lines kept per job, older ones are dropped (followers skip ahead)
+LOG_WINDOW = 10000
+# Finished jobs kept for status queries
+KEEP_FINISHED = 50
+
+LISTED_RE = re.compile(r'^Listed (\d+) unique emails')
+HISTORY_RE = re.compile(r'^History since \S+: (\d+) added')
+
+class SyncJob:
+    def __init__(self, mailbox, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.mailbox = mailbox
+        self.params = params
+        self.status = 'queued'
+        self.error = None
+        self.exception = None
+        self.queued = time.time()
+        self.started = self.queued
+        self.finished = None
+        self.total = None
+        self.counts = {'downloaded': 0, 'failed': 0, 'deleted': 0, 'relabeled': 0}
+        self.attached = 0
+        self._log = deque(maxlen=LOG_WINDOW)
+        # Absolute number of the first line still in _log
+        self._first = 0
+        self._cond = threading.Condition()
+
+    def append(self, line):
+        for prefix, counter in (('Downloaded', 'downloaded'), ('Failed', 'failed'),
+                                ('Deleted', 'deleted'), ('Relabeled', 'relabeled')):
+            if line.startswith(prefix):
+                self.counts[counter] += 1
+                break
+        else:
+            match = LISTED_RE.match(line) or HISTORY_RE.match(line)
+            if match:
+                self.total = int(match.group(1))
+        with self._cond:
+            if len(self._log) == self._log.maxlen:
+                self._first += 1
+            self._log.append(line)
+            self._cond.notify_all()
+
+    def finish(self, error=None, exception=None):
+        with self._cond:
+            self.status = 'failed' if error else 'done'
+            self.error = error
+            self.exception = exception
+            self.finished = time.time()
+            self._cond.notify_all()
+
+    def begin(self):
+        with self._cond:
+            self.status = 'running'
+            self.started = time.time()
+
+    @property
+    def running(self):
+        # Queued jobs count as running: they will, and clients may follow them
+        return self.status in ('queued', 'running')
+
+    def wait(self, timeout=None):
+        # Blocks until the job ends, False on timeout
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.running, timeout)
+
+    def lines(self, since=0):
+        # Log lines from absolute position since, and the position to ask for next
+        with self._cond:
+            since = max(since, self._first)
+            lines = list(self._log)[since - self._first:]
+            return lines, since + len(lines)
+
+    def follow(self, since=0, timeout=15.0):
+        # Yields log lines as they arrive until the job ends. Yields None
+        # after timeout seconds without output so callers can send keepalives.
+        # Never yields while holding _cond: the consumer writes to a socket,
+        # and a slow client must not block append() for the sync thread and
+        # the other followers
+        position = since
+        while True:
+            lines, position = self.lines(position)
+            for line in lines:
+                yield line
+            with self._cond:
+                caught_up = position >= self._first + len(self._log)
+                if caught_up and not self.running:
+                    return
+                timed_out = caught_up and not self._cond.wait(timeout)
+            if timed_out:
+                yield None
+
+    def to_dict(self):
+        elapsed = (self.finished or time.time()) - self.started if self.status != 'queued' else 0.0
+        done = self.counts['downloaded'] + self.counts['failed']
+        return {
+            'id': self.id,
+            'mailbox': self.mailbox,
+            'status': self.status,
+            'error': self.error,
+            'params': self.params,
+            'queued_seconds': round((time.time() if self.status == 'queued' else self.started) - self.queued, 1),
+            'started': self.started,
+            'finished': self.finished,
+            'elapsed_seconds': round(elapsed, 1),
+            'total': self.total,
+            'progress': round(done / self.total, 4) if self.total else None,
+            'emails_per_sec': round(done / elapsed, 1) if elapsed > 0 else 0.0,
+            'attached_clients': self.attached,
+            **self.counts,
+        }
+
+class JobManager:
+    def __init__(self, run, max_running=None):
+        # run(job) returns the sync generator of log lines (bytes) for a job
+        self.run = run
+        self._slots = threading.Semaphore(max_running) if max_running else None
+        self.jobs = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def start(self, mailbox, params):
+        # Returns (job, created); a running job for the mailbox is shared
+        with self._lock:
+            job = self._running.get(mailbox)
+            if job is not None and job.running:
+                job.attached += 1
+                return job, False
+            job = SyncJob(mailbox, params)
+            self.jobs[job.id] = job
+            self._running[mailbox] = job
+            self._prune()
+        threading.Thread(target=self._work, args=(job,), daemon=True).start()
+        return job, True
+
+    def _work(self, job):
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            job.begin()
+            for chunk in self.run(job):
+                job.append(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk)
+            job.finish()
+        except Exception as e:
+            print(f"[!] Sync job {job.id} failed: {e}")
+            job.append(f"Error: {e}\n")
+            job.finish(str(e), e)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+            with self._lock:
+                if self._running.get(job.mailbox) is job:
+                    del self._running[job.mailbox]
+
+    def _prune(self):
+        # Background sync daemon jobs go first, they are frequent and small
+        finished = [job for job in self.jobs.values() if not job.running]
+        for job in sorted(finished, key=lambda j: (not j.params.get('daemon'), j.started))[:-KEEP_FINISHED or None]:
+            del self.jobs[job.id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return [job.to_dict() for job in sorted(self.jobs.values(), key=lambda j: j.started, reverse=True)]
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # Modules default to ./temp and ./token.json, keep every test in its own folder
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,45 @@
+import os
+from accounts import account_folder, list_accounts
+from ask_service import AskService
+from email_store import open_store
+
+def store_email(folder, msg_id):
+    store = open_store(folder)
+    store.put_many([{'id': msg_id, 'subject': 'Hi', 'body': 'Hello', 'labels': []}])
+    store.close()
+
+def test_account_folders_sit_next_to_the_default_one():
+    folder = account_folder('work', 'temp')
+    assert os.path.commonpath([os.path.abspath(folder), os.path.abspath('temp')]) != os.path.abspath('temp')
+    assert account_folder('default', 'temp') == 'temp'
+
+def test_legacy_account_folder_is_moved():
+    store_email(os.path.join('temp', 'accounts', 'work'), 'a')
+    assert list_accounts('temp') == ['default', 'work']
+    assert not os.path.exists(os.path.join('temp', 'accounts'))
+    store = open_store(account_folder('work', 'temp'))
+    assert store.get('a')['subject'] == 'Hi'
+    store.close()
+
+def test_cleanup_keeps_other_accounts():
+    store_email('temp', 'a')
+    store_email(account_folder('work', 'temp'), 'b')
+    store_email(account_folder('home', 'temp'), 'c')
+    service = AskService([], folder='temp')
+    assert service.cleanup({}) == ['default']
+    assert not os.path.exists('temp')
+    assert os.path.exists(account_folder('work', 'temp'))
+    assert service.cleanup({'account': 'work'}) == ['work']
+    assert not os.path.exists(account_folder('work', 'temp'))
+    assert os.path.exists(account_folder('home', 'temp'))
+
+def test_cleanup_route_takes_an_account(monkeypatch):
+    import gemini_email_agent_flask as flask_app
+    store_email('temp', 'a')
+    store_email(account_folder('work', 'temp'), 'b')
+    monkeypatch.setattr(flask_app, 'service', AskService([], folder='temp'))
+    client = flask_app.app.test_client()
+    assert client.post('/cleanup', json={'account': 'nobody'}).status_code == 404
+    response = client.post('/cleanup')
+    assert response.status_code == 200 and response.get_json()['accounts'] == ['default']
+    assert os.path.exists(account_folder('work', 'temp'))
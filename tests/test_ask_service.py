@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import subprocess
+import pytest
+import ask_service
+from ask_service import AskService, AskError
+from email_store import open_store
+from email_embeddings import HashingEmbedder
+
+MODELS = [{"id": "test-model", "limits": {"requests_per_minute": 10, "tokens_per_minute": 100000}}]
+
+def ask(**fields):
+    return {"model_id": "test-model", "query": "invoice", **fields}
+
+@pytest.mark.parametrize('fields', [{'top_k': 'abc'}, {'top_k': 0}, {'top_k': [5]}, {'max_prompt_tokens': 'lots'}])
+def test_prepare_rejects_bad_numbers(fields):
+    service = AskService(MODELS, folder='temp')
+    with pytest.raises(AskError) as e:
+        service.prepare(ask(**fields))
+    assert e.value.status == 400
+
+@pytest.mark.parametrize('max_wait', ['soon', -1, float('nan'), True])
+def test_acquire_rejects_bad_max_wait(max_wait):
+    service = AskService(MODELS, folder='temp')
+    ctx = {'model_id': 'test-model', 'stats': {'estimated_tokens': 10}}
+    with pytest.raises(AskError) as e:
+        service.acquire(ctx, {'max_wait': max_wait})
+    assert e.value.status == 400
+    with pytest.raises(AskError) as e:
+        asyncio.run(service.acquire_async(ctx, {'max_wait': max_wait}))
+    assert e.value.status == 400
+
+def test_acquire_accepts_numeric_strings():
+    service = AskService(MODELS, folder='temp')
+    ctx = {'model_id': 'test-model', 'stats': {'estimated_tokens': 10}}
+    assert service.acquire(ctx, {'max_wait': '2.5'}) == 'test-model'
+
+def test_flask_bad_top_k_is_400(monkeypatch):
+    flask_app = pytest.importorskip('gemini_email_agent_flask')
+    monkeypatch.setattr(flask_app, 'service', AskService(MODELS, folder='temp'))
+    response = flask_app.app.test_client().post('/ask', json=ask(top_k='abc'))
+    assert response.status_code == 400
+    assert 'top_k' in response.get_json()['error']
+
+def call_asgi(app, method, path, payload):
+    messages = []
+    body = json.dumps(payload).encode('utf-8')
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app({'type': 'http', 'method': method, 'path': path, 'headers': []}, receive, send))
+    start = next(m for m in messages if m['type'] == 'http.response.start')
+    data = b''.join(m.get('body', b'') for m in messages if m['type'] == 'http.response.body')
+    return start['status'], json.loads(data)
+
+def test_asgi_bad_input_is_400():
+    from gemini_email_agent_async import create_app
+    app = create_app(AskService(MODELS, folder='temp'))
+    status, payload = call_asgi(app, 'POST', '/ask', ask(top_k='abc'))
+    assert status == 400 and 'top_k' in payload['error']
+    status, payload = call_asgi(app, 'POST', '/ask/stream', ask(top_k='-'))
+    assert status == 400 and 'top_k' in payload['error']
+
+def test_async_server_does_not_import_flask_server():
+    # Importing the Flask server builds its app and a second AskService
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, gemini_email_agent_async; print('gemini_email_agent_flask' in sys.modules, 'flask' in sys.modules)"
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ['False', 'False']
+
+def test_servers_share_the_model_table():
+    from gemini_models import GEMINI_MODELS, ASK_MODELS
+    import gemini_email_agent_async
+    assert all(any(m is model for model in GEMINI_MODELS) for m in ASK_MODELS)
+    assert gemini_email_agent_async.app.service.models is ASK_MODELS
+
+def test_semantic_index_builds_in_the_background(monkeypatch):
+    store = open_store('temp')
+    store.put_many([{'id': str(i), 'subject': f"Invoice {i}", 'body': 'Please pay', 'labels': []} for i in range(30)])
+    release = threading.Event()
+    built = []
+
+    def slow_index(emails, folder):
+        # Stands in for an embedding run waiting on the rate limit
+        release.wait(5)
+        built.append(len(emails))
+        return 'semantic-index'
+
+    monkeypatch.setattr(ask_service, 'semantic_enabled', lambda: True)
+    monkeypatch.setattr(ask_service, 'shared_embedder', lambda: HashingEmbedder())
+    monkeypatch.setattr(ask_service, 'open_semantic_index', slow_index)
+    shard = ask_service.MailboxShard('default', 'temp')
+    start = time.perf_counter()
+    assert len(shard.select('invoice', 5)) == 5
+    # Answered from the full-text index without waiting for the embeddings
+    assert time.perf_counter() - start < 2
+    _, semantic = shard.retrieval_indexes(shard.mailbox.emails())
+    assert semantic != 'semantic-index'
+    release.set()
+    for _ in range(100):
+        if shard.retrieval_indexes(shard.mailbox.emails())[1] == 'semantic-index':
+            break
+        time.sleep(0.05)
+    assert built == [30]
+    assert shard.retrieval_indexes(shard.mailbox.emails())[1] == 'semantic-index'
+    store.close()
+
+def test_shared_models_use_the_process_scheduler():
+    import gemini_models
+    from rate_limiter import Scheduler
+    assert AskService(gemini_models.ASK_MODELS, folder='temp').scheduler is gemini_models.scheduler
+    assert AskService(MODELS, folder='temp').scheduler is not gemini_models.scheduler
+    own = Scheduler(gemini_models.ASK_MODELS)
+    assert AskService(gemini_models.ASK_MODELS, folder='temp', scheduler=own).scheduler is own
+
+def test_fallback_stays_within_the_served_models():
+    import gemini_models
+    from rate_limiter import Scheduler
+    scheduler = Scheduler(gemini_models.GEMINI_MODELS)
+    service = AskService(gemini_models.ASK_MODELS, folder='temp', scheduler=scheduler)
+    # Every served model but one is out of requests for the minute
+    spare = gemini_models.ASK_MODEL_IDS[-1]
+    for model_id in gemini_models.ASK_MODEL_IDS[:-1]:
+        scheduler.penalize(model_id)
+    ctx = {'model_id': gemini_models.ASK_MODEL_IDS[0], 'stats': {'estimated_tokens': 10}}
+    assert service.acquire(ctx, {'fallback': True}) == spare
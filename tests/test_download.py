@@ -0,0 +1,43 @@
+from functools import partial
+import pytest
+import gmail_fetch
+from ed import sync_emails
+from email_store import open_store
+from fake_gmail import FakeGmailService
+from gmail_sync import SyncCheckpoint
+
+@pytest.fixture
+def no_retries(monkeypatch):
+    # Failed fetches stay failed, and retried calls don't sleep
+    monkeypatch.setattr(gmail_fetch, 'fetch_batch_with_retry', partial(gmail_fetch.fetch_batch_with_retry, retries=0))
+    monkeypatch.setattr(gmail_fetch, 'backoff', lambda attempt: None)
+
+def sync(service, store):
+    return [line.decode('utf-8') for line in sync_emails(service, store=store)]
+
+def test_failed_fetches_are_retried_by_the_next_run(no_retries):
+    service = FakeGmailService.synthetic(200, error_rate=0.3, seed=1)
+    store = open_store('temp')
+    lines = sync(service, store)
+    assert store.count() < 200
+    assert 'failed to download' in lines[-1]
+    # Not a complete mirror, so no incremental base yet
+    assert store.get_meta('historyId') is None
+    checkpoint = SyncCheckpoint('temp')
+    assert checkpoint.pending() and len(checkpoint.fetched_ids()) == store.count()
+    checkpoint.close()
+
+    # The next runs fetch only what is missing until the mailbox is complete
+    for _ in range(20):
+        missing = 200 - store.count()
+        calls = service.calls
+        sync(service, store)
+        if store.get_meta('historyId') is not None:
+            break
+        assert service.calls - calls <= missing + 10
+    assert store.count() == 200
+    assert sorted(store.ids()) == sorted(service.order)
+    checkpoint = SyncCheckpoint('temp')
+    assert not checkpoint.pending()
+    checkpoint.close()
+    store.close()
@@ -0,0 +1,58 @@
+import pytest
+import email_embeddings
+from email_embeddings import GeminiEmbedder, SemanticIndex, open_semantic_index, EMBEDDING_MODEL
+from gemini_models import GEMINI_MODELS, model_limits
+from rate_limiter import Scheduler
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    # Fresh process scheduler and a stand-in for the embedding API
+    calls = []
+    monkeypatch.setattr(email_embeddings, 'scheduler', Scheduler(GEMINI_MODELS))
+
+    def embed_content(model, content, task_type):
+        calls.append(len(content))
+        return {'embedding': [[float(len(text)), 1.0] for text in content]}
+
+    monkeypatch.setattr(email_embeddings.genai, 'embed_content', embed_content)
+    return calls
+
+def emails(count):
+    return [{'id': str(i), 'subject': f"Subject {i}", 'body': 'x' * i} for i in range(count)]
+
+def test_embedders_share_the_model_limits(embed_calls):
+    first, second = GeminiEmbedder(), GeminiEmbedder()
+    first.embed(['a'])
+    second.embed(['b'])
+    limiter = email_embeddings.scheduler.limiter(EMBEDDING_MODEL)
+    assert limiter.granted == 2
+    assert limiter.buckets['requests_per_day'].capacity == model_limits(EMBEDDING_MODEL)['requests_per_day']
+
+def test_reopened_index_keeps_counting_the_daily_quota(embed_calls):
+    embedder = GeminiEmbedder(max_wait=0.1)
+    open_semantic_index(emails(3), 'temp', embedder)
+    # Quota used up elsewhere in the process
+    email_embeddings.scheduler.limiter(EMBEDDING_MODEL).buckets['requests_per_day'].level = 0
+    index = open_semantic_index(emails(5), 'temp', GeminiEmbedder(max_wait=0.1))
+    # The index keeps the vectors it had and searching falls back to nothing
+    assert index.ids == ['0', '1', '2']
+    assert index.search('Subject 1') == []
+    assert embed_calls == [3]
+
+def test_shared_embedder_is_reused():
+    assert email_embeddings.shared_embedder() is email_embeddings.shared_embedder()
+    assert SemanticIndex('temp').embedder is email_embeddings.shared_embedder()
+
+def test_embedded_batches_are_kept_when_the_quota_runs_out(embed_calls):
+    limiter = email_embeddings.scheduler.limiter(EMBEDDING_MODEL)
+    # Two requests left today
+    limiter.buckets['requests_per_day'].level = 2
+    index = open_semantic_index(emails(250), 'temp', GeminiEmbedder(max_wait=0.1))
+    assert embed_calls == [100, 100]
+    assert len(index.ids) == 200
+    # The next day's run only embeds the rest, starting from the saved vectors
+    limiter.buckets['requests_per_day'].level = 100
+    index = open_semantic_index(emails(250), 'temp', GeminiEmbedder(max_wait=0.1))
+    assert embed_calls == [100, 100, 50]
+    assert sorted(index.ids, key=int) == [str(i) for i in range(250)]
+    assert index.matrix.shape == (250, 2)
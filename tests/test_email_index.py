@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import email_index
+from email_index import EmailIndex, open_index
+from email_store import SqliteStore
+
+def email(msg_id, body, **fields):
+    return {'id': msg_id, 'subject': f"Subject {msg_id}", 'from': 'a@example.com', 'to': 'me@example.com',
+            'date': 'Mon, 1 Jan 2024 10:00:00 +0000', 'body': body, **fields}
+
+def found(index, query):
+    return sorted(msg_id for msg_id, _ in index.search(query))
+
+def test_index_keeps_no_copy_of_the_bodies(tmp_path):
+    folder = str(tmp_path / 'mail')
+    emails = [email(str(i), f"Invoice {i} " + "lorem ipsum dolor sit amet " * 200) for i in range(300)]
+    store = SqliteStore(folder)
+    store.put_many(emails)
+    index = open_index(folder, emails)
+    assert len(found(index, 'invoice')) == email_index.DEFAULT_TOP_K
+    conn = sqlite3.connect(index.path)
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    assert 'fts_content' not in tables
+    assert conn.execute("SELECT COUNT(*) FROM fts WHERE body IS NOT NULL").fetchone()[0] == 0
+    conn.close()
+
+def test_deleted_and_replaced_emails_are_not_found(tmp_path):
+    index = EmailIndex(str(tmp_path))
+    index.add_many([email('a', 'quarterly invoice'), email('b', 'team lunch'), email('c', 'invoice reminder')])
+    index.remove(['c'])
+    index.add_many([email('a', 'holiday plans')])
+    assert found(index, 'invoice') == []
+    assert found(index, 'holiday') == ['a']
+    assert found(index, 'lunch') == ['b']
+    assert index.stale() == 2
+
+def test_open_index_rebuilds_once_stale_entries_pile_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(email_index, 'STALE_MIN', 2)
+    folder = str(tmp_path)
+    emails = [email(str(i), f"body {i}") for i in range(8)]
+    open_index(folder, emails).add_many(emails[:2])
+    assert open_index(folder, emails).stale() == 2
+    emails[2]['body'] = 'edited'
+    open_index(folder, emails).add_many(emails[2:3])
+    index = open_index(folder, emails)
+    assert index.stale() == 0 and index.count() == 8
+    assert found(index, 'edited') == ['2']
+
+def test_index_with_stored_content_is_replaced(tmp_path):
+    folder = str(tmp_path)
+    conn = sqlite3.connect(os.path.join(folder, email_index.INDEX_FILE))
+    conn.executescript("""
+        CREATE TABLE docs (rowid INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE);
+        CREATE VIRTUAL TABLE fts USING fts5(subject, sender, recipient, date, body, tokenize='porter unicode61');
+        INSERT INTO docs (id) VALUES ('old');
+        INSERT INTO fts (rowid, body) VALUES (1, 'invoice');
+    """)
+    conn.close()
+    emails = [email('a', 'invoice due')]
+    index = open_index(folder, emails)
+    assert found(index, 'invoice') == ['a']
@@ -0,0 +1,51 @@
+from email_store import SqliteStore
+from email_loader import MailboxCache
+
+def email(msg_id, **fields):
+    return {'id': msg_id, 'subject': f"Subject {msg_id}", 'from': 'a@example.com', 'to': 'me@example.com',
+            'date': 'Mon, 1 Jan 2024 10:00:00 +0000', 'snippet': '', 'body': f"Body {msg_id}", 'labels': [],
+            **fields}
+
+def test_seq_does_not_repeat_after_deleting_newest(tmp_path):
+    store = SqliteStore(str(tmp_path / 'mail'))
+    store.put_many([email('a')])
+    store.put_many([email('b')])
+    _, token = store.changes_since(0)
+    store.delete(['b'])
+    store.put_many([email('c')])
+    changed, _ = store.changes_since(token)
+    assert [e['id'] for e in changed] == ['c']
+
+def test_mailbox_cache_sees_writes_after_delete(tmp_path):
+    folder = str(tmp_path / 'mail')
+    store = SqliteStore(folder)
+    cache = MailboxCache(folder, check_interval=0)
+    store.put_many([email('a')])
+    store.put_many([email('b')])
+    assert sorted(e['id'] for e in cache.emails()) == ['a', 'b']
+    store.delete(['b'])
+    store.put_many([email('c')])
+    assert sorted(e['id'] for e in cache.emails()) == ['a', 'c']
+
+def test_seq_continues_after_existing_rows(tmp_path):
+    # Databases written before the counter existed carry on from their newest row
+    store = SqliteStore(str(tmp_path / 'mail'))
+    store.put_many([email('a')])
+    conn = store._conn()
+    with conn:
+        conn.execute("DELETE FROM meta WHERE key = 'seq'")
+        conn.execute("UPDATE emails SET seq = 7")
+    store.put_many([email('b')])
+    changed, token = store.changes_since(7)
+    assert [e['id'] for e in changed] == ['b'] and token == 8
+
+def test_set_field_updates_only_that_field():
+    store = SqliteStore('temp')
+    store.put_many([email('a'), email('b')])
+    _, token = store.changes_since(0)
+    assert store.set_field('summary', {'a': {'text': 'Hi'}, 'gone': {'text': 'x'}}) == 1
+    changed, _ = store.changes_since(token)
+    assert [e['id'] for e in changed] == ['a']
+    assert store.get('a')['summary'] == {'text': 'Hi'} and store.get('a')['subject'] == email('a')['subject']
+    assert store.ids_without('summary') == ['b']
+    store.close()
@@ -0,0 +1,74 @@
+import pytest
+from email_store import open_store
+from email_summaries import summarize_emails, SUMMARY_MODEL, SUMMARY_FIELD
+from fake_gemini import FakeGenerativeModel
+from gemini_models import scheduler, model_limits
+
+def email(msg_id, **fields):
+    return {'id': msg_id, 'subject': f"Subject {msg_id}", 'from': 'alice@example.com', 'snippet': 'Hello',
+            'body': f"Body of {msg_id}", 'labels': ['INBOX'], **fields}
+
+def run(store, model):
+    for _ in summarize_emails(store, model=model, batch_size=2):
+        pass
+
+def test_runs_share_the_process_scheduler():
+    limiter = scheduler.limiter(SUMMARY_MODEL)
+    assert 'requests_per_day' in limiter.buckets
+    assert limiter.buckets['requests_per_minute'].capacity == model_limits(SUMMARY_MODEL)['requests_per_minute']
+    granted = limiter.granted
+    store = open_store('temp')
+    model = FakeGenerativeModel(SUMMARY_MODEL, latency=0)
+    store.put_many([email('a'), email('b')])
+    run(store, model)
+    store.put_many([email('c')])
+    run(store, model)
+    # Both runs counted on the one limiter instead of starting from a full bucket
+    assert limiter.granted - granted == model.calls == 2
+    assert all(store.get(msg_id)[SUMMARY_FIELD] for msg_id in 'abc')
+    store.close()
+
+def test_run_reads_only_emails_without_summary(monkeypatch):
+    store = open_store('temp')
+    store.put_many([email('a'), email('b')])
+    run(store, FakeGenerativeModel(SUMMARY_MODEL, latency=0))
+    monkeypatch.setattr(store, 'scan', lambda *args, **kwargs: pytest.fail('full scan'))
+    store.put_many([email('c')])
+    model = FakeGenerativeModel(SUMMARY_MODEL, latency=0)
+    run(store, model)
+    assert model.calls == 1 and store.ids_without(SUMMARY_FIELD) == []
+    store.close()
+
+@pytest.mark.parametrize('backend', ['sqlite', 'json'])
+def test_summary_write_keeps_concurrent_relabel(backend):
+    store = open_store('temp', backend=backend)
+    store.put_many([email('a'), email('b')])
+    model = FakeGenerativeModel(SUMMARY_MODEL, latency=0)
+    generate = model.generate_content
+
+    def relabel_while_summarizing(*args, **kwargs):
+        # A sync relabels an email after the summarizer read it
+        store.upsert({**store.get('a'), 'labels': ['INBOX', 'STARRED']})
+        return generate(*args, **kwargs)
+
+    model.generate_content = relabel_while_summarizing
+    run(store, model)
+    assert store.get('a')['labels'] == ['INBOX', 'STARRED']
+    assert store.get('a')[SUMMARY_FIELD] and store.get('b')[SUMMARY_FIELD]
+    store.close()
+
+def test_summary_of_changed_email_is_not_saved():
+    store = open_store('temp')
+    store.put_many([email('a')])
+    model = FakeGenerativeModel(SUMMARY_MODEL, latency=0)
+    generate = model.generate_content
+
+    def resync_while_summarizing(*args, **kwargs):
+        store.upsert(email('a', body='A newer body'))
+        return generate(*args, **kwargs)
+
+    model.generate_content = resync_while_summarizing
+    run(store, model)
+    assert SUMMARY_FIELD not in store.get('a')
+    assert store.ids_without(SUMMARY_FIELD) == ['a']
+    store.close()
@@ -0,0 +1,7 @@
+import gemini_agent
+import gemini_email_agent
+
+def test_entry_points_share_one_ask_loop():
+    assert gemini_email_agent.ask_loop is gemini_agent.ask_loop
+    assert gemini_email_agent.select_model is gemini_agent.select_model
+    assert gemini_email_agent.cleanup_prompt is gemini_agent.cleanup_prompt
@@ -0,0 +1,136 @@
+from functools import partial
+import gmail_fetch
+from ed import sync_emails
+from email_store import open_store
+from fake_gmail import FakeGmailService, generate_message
+from gmail_sync import list_history_changes
+
+def sync(service, store):
+    return [line.decode('utf-8') for line in sync_emails(service, store=store)]
+
+def synced(count=10):
+    service = FakeGmailService.synthetic(count)
+    store = open_store('temp')
+    sync(service, store)
+    assert store.count() == count
+    return service, store
+
+def test_history_applies_adds_and_deletes():
+    service, store = synced()
+    new = generate_message(500)
+    gone = service.order[3]
+    service.add_message(new)
+    service.delete_message(gone)
+    lines = sync(service, store)
+    # Only the delta, not a full sync
+    assert len(lines) == 2 and lines[0] == f"Deleted email {gone}\n"
+    assert lines[1].startswith(f"Downloaded email {new['id']}:")
+    assert store.get(new['id']) is not None and store.get(gone) is None
+    assert int(store.get_meta('historyId')) == service.history_id
+    store.close()
+
+def test_message_added_and_deleted_between_syncs_is_never_fetched():
+    service, store = synced()
+    new = generate_message(501)
+    service.add_message(new)
+    service.delete_message(new['id'])
+    calls = service.calls
+    sync(service, store)
+    assert store.get(new['id']) is None and store.count() == 10
+    # Profile and one history page, no message fetch
+    assert service.calls - calls <= 3
+    store.close()
+
+def test_relabel_updates_labels_only():
+    service, store = synced()
+    msg_id = service.order[0]
+    body = store.get(msg_id)['body']
+    service.relabel_message(msg_id, add=['STARRED'])
+    sync(service, store)
+    email = store.get(msg_id)
+    assert 'STARRED' in email['labels'] and email['body'] == body
+    store.close()
+
+def test_relabel_of_unknown_message_downloads_it():
+    service, store = synced()
+    msg_id = service.order[0]
+    store.delete([msg_id])
+    service.relabel_message(msg_id, add=['STARRED'])
+    sync(service, store)
+    email = store.get(msg_id)
+    assert email is not None and 'STARRED' in email['labels']
+    store.close()
+
+def test_expired_history_falls_back_to_full_sync():
+    service, store = synced()
+    new = generate_message(502)
+    service.add_message(new)
+    service.expire_history()
+    lines = sync(service, store)
+    assert any('falling back to a full sync' in line for line in lines)
+    assert store.get(new['id']) is not None and store.count() == 11
+    store.close()
+
+def test_history_changes_collapse():
+    class Service:
+        # history().list() answering from fixed pages
+        def __init__(self, pages):
+            self.pages = pages
+
+        def users(self):
+            return self
+
+        def history(self):
+            return self
+
+        def list(self, userId, startHistoryId, pageToken=None, maxResults=None):
+            page = self.pages[int(pageToken or 0)]
+
+            class Request:
+                def execute(self, num_retries=0):
+                    return page
+            return Request()
+
+    def record(key, msg_id, labels=()):
+        return {key: [{'message': {'id': msg_id, 'labelIds': list(labels)}}]}
+
+    pages = [
+        {'history': [record('messagesAdded', 'a'), record('labelsAdded', 'b', ['INBOX', 'STARRED']),
+                     record('messagesAdded', 'c')], 'nextPageToken': '1'},
+        {'history': [record('messagesDeleted', 'a'), record('messagesDeleted', 'b'),
+                     record('labelsRemoved', 'c', ['INBOX']), record('labelsAdded', 'd', ['TRASH'])],
+         'historyId': '77'},
+    ]
+    added, deleted, relabeled, history_id = list_history_changes(Service(pages), 10)
+    assert added == {'c'} and deleted == {'a', 'b'}
+    assert relabeled == {'d': ['TRASH']} and history_id == '77'
+
+def test_failed_delta_fetches_are_retried(monkeypatch):
+    service, store = synced()
+    monkeypatch.setattr(gmail_fetch, 'fetch_batch_with_retry', partial(gmail_fetch.fetch_batch_with_retry, retries=0))
+    monkeypatch.setattr(gmail_fetch, 'backoff', lambda attempt: None)
+    new = [generate_message(600 + i) for i in range(30)]
+    for msg in new:
+        service.add_message(msg)
+    relabeled = service.order[-1]
+    store.delete([relabeled])
+    service.relabel_message(relabeled, add=['STARRED'])
+    # Every message fetch fails on the first run
+    fetch_batch = gmail_fetch.fetch_batch
+    monkeypatch.setattr(gmail_fetch, 'fetch_batch', lambda service, ids, *args: [
+        (msg_id, None, ConnectionError('connection reset')) for msg_id in ids])
+    sync(service, store)
+    assert all(store.get(msg['id']) is None for msg in new) and store.get(relabeled) is None
+    monkeypatch.setattr(gmail_fetch, 'fetch_batch', fetch_batch)
+    # One of them is deleted before the next run
+    service.delete_message(new[0]['id'])
+    sync(service, store)
+    assert store.get(new[0]['id']) is None
+    assert all(store.get(msg['id']) is not None for msg in new[1:])
+    assert 'STARRED' in store.get(relabeled)['labels']
+    assert store.count() == 10 + 29
+    # Nothing left to retry
+    calls = service.calls
+    sync(service, store)
+    assert service.calls - calls <= 2
+    store.close()
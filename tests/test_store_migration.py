@@ -0,0 +1,60 @@
+import os
+import json
+from email_store import open_store, migrate_json_folder, SqliteStore, DB_FILE
+
+def write_legacy(folder, name, email):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name), 'w') as f:
+        json.dump(email, f, indent=2)
+
+def legacy_folder():
+    # Old downloads: email_N.json files, named by position rather than id
+    write_legacy('temp', 'email_1.json', {'id': 'a', 'subject': 'First', 'from': 'x@example.com', 'body': 'Hello',
+                                          'labels': ['INBOX'], 'attachments': [{'filename': 'a.pdf'}]})
+    write_legacy('temp', 'email_2.json', {'id': 'b', 'subject': 'Second', 'snippet': 'Hi'})
+    write_legacy('temp', 'email_3.json', {'subject': 'No id'})
+    with open(os.path.join('temp', 'email_4.json'), 'w') as f:
+        f.write('{broken')
+
+def test_open_store_migrates_legacy_files():
+    legacy_folder()
+    store = open_store('temp')
+    assert isinstance(store, SqliteStore)
+    assert sorted(store.ids()) == ['a', 'b']
+    a = store.get('a')
+    assert a['body'] == 'Hello' and a['labels'] == ['INBOX'] and a['attachments'] == [{'filename': 'a.pdf'}]
+    assert store.get('b')['labels'] == []
+    store.close()
+    # The JSON files stay unless asked to remove them
+    assert os.path.exists(os.path.join('temp', 'email_1.json'))
+
+def test_migration_runs_once():
+    legacy_folder()
+    open_store('temp').close()
+    store = open_store('temp')
+    store.delete(['b'])
+    store.close()
+    # The database exists now, so the JSON files aren't read again
+    store = open_store('temp')
+    assert store.ids() == ['a']
+    store.close()
+
+def test_migrate_is_idempotent_and_can_remove_files():
+    legacy_folder()
+    store = SqliteStore('temp')
+    assert migrate_json_folder('temp', store) == 2
+    _, token = store.changes_since(0)
+    assert migrate_json_folder('temp', store, remove=True) == 2
+    assert store.count() == 2
+    assert not any(name.endswith('.json') for name in os.listdir('temp'))
+    assert os.path.exists(os.path.join('temp', DB_FILE))
+    # Readers see the rewritten rows as changes
+    changed, _ = store.changes_since(token)
+    assert sorted(email['id'] for email in changed) == ['a', 'b']
+    store.close()
+
+def test_json_backend_is_left_alone():
+    legacy_folder()
+    store = open_store('temp', backend='json')
+    assert sorted(store.ids()) == ['a', 'b']
+    assert not os.path.exists(os.path.join('temp', DB_FILE))
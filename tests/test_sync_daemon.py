@@ -0,0 +1,78 @@
+import json
+import base64
+import threading
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer
+import pytest
+from sync_daemon import verify_push
+
+def test_push_refused_without_configuration():
+    assert not verify_push('anything', 'Bearer x', secret=None, audience=None)
+
+def test_push_shared_token():
+    assert verify_push('s3cret', None, secret='s3cret', audience=None)
+    assert not verify_push('wrong', None, secret='s3cret', audience=None)
+    assert not verify_push(None, None, secret='s3cret', audience=None)
+
+def test_push_oidc_token(monkeypatch):
+    from google.oauth2 import id_token
+    seen = []
+
+    def verify(jwt, request, audience):
+        seen.append((jwt, audience))
+        if jwt != 'good':
+            raise ValueError('bad signature')
+        return {'email': 'push@project.iam.gserviceaccount.com', 'email_verified': True}
+
+    monkeypatch.setattr(id_token, 'verify_oauth2_token', verify)
+    assert verify_push(None, 'Bearer good', secret=None, audience='https://example.com/gmail/push')
+    assert seen == [('good', 'https://example.com/gmail/push')]
+    assert not verify_push(None, 'Bearer forged', secret=None, audience='aud')
+    assert not verify_push(None, None, secret=None, audience='aud')
+    assert not verify_push(None, 'Bearer good', secret=None, audience='aud', service_account='other@example.com')
+    # Both configured: both have to pass
+    assert not verify_push(None, 'Bearer good', secret='s3cret', audience='aud')
+    assert verify_push('s3cret', 'Bearer good', secret='s3cret', audience='aud')
+
+class FakeDaemon:
+    email_address = 'me@example.com'
+
+    def __init__(self):
+        self.notifications = []
+
+    def notify(self, notification):
+        self.notifications.append(notification)
+        return True
+
+@pytest.fixture
+def push_server(monkeypatch):
+    ed = pytest.importorskip('ed')
+    daemon = FakeDaemon()
+    monkeypatch.setattr(ed, 'daemons', {'default': daemon})
+    monkeypatch.setattr(ed, 'verify_push', lambda token, authorization: verify_push(
+        token, authorization, secret='s3cret', audience=None))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ed.RequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", daemon
+    server.shutdown()
+    server.server_close()
+
+def post_push(url):
+    data = base64.b64encode(json.dumps({'emailAddress': 'me@example.com', 'historyId': 42}).encode()).decode()
+    body = json.dumps({'message': {'data': data}}).encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def test_push_endpoint_rejects_unauthenticated(push_server):
+    base, daemon = push_server
+    assert post_push(base + '/gmail/push') == 403
+    assert post_push(base + '/gmail/push?token=wrong') == 403
+    assert daemon.notifications == []
+    assert post_push(base + '/gmail/push?token=s3cret') == 200
+    assert daemon.notifications == [{'emailAddress': 'me@example.com', 'historyId': 42}]
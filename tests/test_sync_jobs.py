@@ -0,0 +1,25 @@
+import threading
+from sync_jobs import SyncJob, JobManager
+
+def test_append_not_blocked_by_stalled_follower():
+    job = SyncJob('default', {})
+    job.begin()
+    follower = job.follow(timeout=0.01)
+    # The client takes the keepalive and then stalls before asking for more
+    assert next(follower) is None
+    appended = threading.Thread(target=job.append, args=("Downloaded email 1\n",))
+    appended.start()
+    appended.join(timeout=2)
+    assert not appended.is_alive()
+    assert next(follower) == "Downloaded email 1\n"
+    job.finish()
+    assert list(follower) == []
+
+def test_follow_returns_every_line_then_ends():
+    lines = [f"Downloaded email {i}\n".encode() for i in range(5)]
+    jobs = JobManager(lambda job: iter(lines))
+    job, created = jobs.start('default', {})
+    assert created
+    assert [line for line in job.follow(timeout=0.05) if line is not None] == [l.decode() for l in lines]
+    assert job.wait(timeout=2)
+    assert job.status == 'done' and job.counts['downloaded'] == 5